@@ -0,0 +1,54 @@
+"""
+Compares two result files written by benchmarks.suite, benchmark by benchmark.
+
+    python -m benchmarks.compare BASELINE.json CANDIDATE.json [--metric median_ms] [--threshold 10]
+
+Exits with status 1 if any benchmark got slower by more than the threshold percentage.
+"""
+import argparse
+import json
+import sys
+
+
+def compare(baseline, candidate, metric='median_ms', threshold=10.0):
+    """
+    :param baseline: results dict from benchmarks.suite
+    :param candidate: results dict from benchmarks.suite
+    :param metric: summary statistic to compare
+    :param threshold: percentage slowdown counted as a regression
+    :return: list of (name, baseline value, candidate value, percentage change, regressed), one per benchmark in both
+    """
+    rows = []
+    for name in sorted(set(baseline['results']) & set(candidate['results'])):
+        before = baseline['results'][name][metric]
+        after = candidate['results'][name][metric]
+        change = (after - before) / before * 100 if before else 0.0
+        rows.append((name, before, after, change, change > threshold))
+    return rows
+
+
+def _load(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--metric', default='median_ms', choices=['mean_ms', 'median_ms', 'p95_ms', 'min_ms'])
+    parser.add_argument('--threshold', type=float, default=10.0, help='percentage slowdown that fails the comparison')
+    args = parser.parse_args()
+    baseline = _load(args.baseline)
+    candidate = _load(args.candidate)
+    if baseline['workload'] != candidate['workload']:
+        print('warning: the runs used different workloads')
+    print('%-26s %12s %12s %9s' % ('benchmark', 'baseline', 'candidate', 'change'))
+    rows = compare(baseline, candidate, args.metric, args.threshold)
+    for name, before, after, change, regressed in rows:
+        print('%-26s %12.3f %12.3f %+8.1f%%%s' % (name, before, after, change, '  REGRESSION' if regressed else ''))
+    sys.exit(1 if any(row[4] for row in rows) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Compares the old per-member unread fan-out loop with the set-based statement post_to_channel uses now.
+
+    python -m benchmarks.fanout [--sizes 100 1000 10000] [--posts 20]
+
+WARNING: this drops and rebuilds the chat tables in the database configured in config/db.yml
+"""
+import argparse
+import time
+
+from src.chat import rebuild_tables, post_to_channel, POST_FAN_OUT
+from src.swen344_db_utils import transaction
+
+COMMUNITY = 'BenchCommunity'
+CHANNEL = 'general'
+POSTER = 'bench_user_000000'
+TIME_SENT = '2020-01-01 00:00:00'
+
+
+def seed(members):
+    """
+    builds one community with one channel and the given number of members
+    :param members: number of users in the community
+    """
+    rebuild_tables()
+    with transaction() as cur:
+        cur.execute("INSERT INTO users (user_id, name, phone_number, email) "
+                    "SELECT 'bench_user_' || lpad(n::TEXT, 6, '0'), 'Bench', '5855550000', n || '@bench.edu' "
+                    "FROM generate_series(0, %s - 1) AS n", (members,))
+        cur.execute('INSERT INTO communities (name) VALUES (%s)', (COMMUNITY,))
+        cur.execute('INSERT INTO channels (name, community_name) VALUES (%s, %s)', (CHANNEL, COMMUNITY))
+        cur.execute('INSERT INTO memberships (user_id, community_name) SELECT user_id, %s FROM users', (COMMUNITY,))
+
+
+def per_member_fan_out(message):
+    """the fan-out as post_to_channel did it before: one INSERT per member and per mention"""
+    with transaction() as cur:
+        cur.execute('SELECT user_id FROM memberships WHERE community_name = %s', (COMMUNITY,))
+        members = [row[0] for row in cur.fetchall()]
+        members.remove(POSTER)
+        cur.execute('SELECT id FROM channels WHERE community_name = %s AND name = %s', (COMMUNITY, CHANNEL))
+        channel_id = cur.fetchall()[0][0]
+        cur.execute('INSERT INTO channel_posts (channel_id, text, user_id, time_sent) VALUES (%s,%s,%s,%s) '
+                    'RETURNING id', (channel_id, message, POSTER, TIME_SENT))
+        post_id = cur.fetchall()[0][0]
+        for user_id in members:
+            cur.execute('INSERT INTO unread_posts (user_id,post_id) VALUES (%s,%s)', (user_id, post_id))
+
+
+def set_based_fan_out(message):
+    """the same writes done by the single statement used by post_to_channel"""
+    with transaction() as cur:
+        cur.execute(POST_FAN_OUT, {'community': COMMUNITY, 'channel': CHANNEL, 'message': message,
+                                   'poster_id': POSTER, 'time_sent': TIME_SENT, 'mentioned': []})
+
+
+def end_to_end(message):
+    """post_to_channel including its existence, membership and suspension checks"""
+    post_to_channel(POSTER, CHANNEL, COMMUNITY, message, TIME_SENT)
+
+
+def time_per_post(func, posts):
+    start = time.perf_counter()
+    for i in range(posts):
+        func('benchmark post %d' % i)
+    return (time.perf_counter() - start) / posts * 1000
+
+
+def run(sizes, posts):
+    """
+    :return: list of (members, per-member ms/post, set-based ms/post, post_to_channel ms/post)
+    """
+    results = []
+    for members in sizes:
+        timings = [members]
+        for func in (per_member_fan_out, set_based_fan_out, end_to_end):
+            seed(members)
+            timings.append(time_per_post(func, posts))
+        results.append(tuple(timings))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--posts', type=int, default=20)
+    args = parser.parse_args()
+    print('%10s %18s %16s %20s' % ('members', 'per-member ms', 'set-based ms', 'post_to_channel ms'))
+    for members, per_member, set_based, full in run(args.sizes, args.posts):
+        print('%10d %18.2f %16.2f %20.2f' % (members, per_member, set_based, full))
+
+
+if __name__ == '__main__':
+    main()
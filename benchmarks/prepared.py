@@ -0,0 +1,84 @@
+"""
+Measures the per-call latency saved by running the hot chat statements as server-side prepared statements.
+
+Each statement is run with arguments drawn from a synthetic workload, once as plain SQL (parsed and planned by the
+server on every call) and once with EXECUTE, alternating in the same transaction so both see the same data.
+
+    python -m benchmarks.prepared [--calls 2000] [workload options]
+
+WARNING: this drops and rebuilds the chat tables in the database configured in config/db.yml
+"""
+import argparse
+import random
+import time
+
+from benchmarks.suite import BENCH_TIME
+from benchmarks.workload import add_workload_arguments, email, generate, workload_from_args
+from src import chat
+from src.swen344_db_utils import transaction
+
+
+def _cases(data, rng):
+    """
+    :return: list of (PreparedStatement, function of i returning its arguments)
+    """
+    def member(i):
+        community = rng.choice(sorted(data.members))
+        return community, rng.choice(data.members[community])
+
+    def channel(i):
+        community, user = member(i)
+        return rng.choice(data.channels[community]), community
+
+    def post(i):
+        community, user = member(i)
+        return {'community': community, 'channel': rng.choice(data.channels[community]),
+                'message': 'prepared benchmark %d' % i, 'poster_id': user, 'time_sent': BENCH_TIME, 'mentioned': []}
+
+    return [
+        (chat._USER_BY_EMAIL, lambda i: (email(rng.randrange(len(data.users))),)),
+        (chat._EMAIL_BY_ID, lambda i: (rng.choice(data.users),)),
+        (chat._CHANNEL, channel),
+        (chat._MEMBERSHIP, lambda i: tuple(reversed(member(i)))),
+        (chat._ROSTER, lambda i: (member(i)[0],)),
+        (chat._UNREAD_MESSAGE_ROWS, lambda i: (rng.choice(data.users),)),
+        (chat._POST_STATEMENTS[chat.get_unread_mode()], post),
+    ]
+
+
+def run(workload, calls):
+    """
+    :return: list of (statement name, plain ms/call, prepared ms/call)
+    """
+    data = generate(workload)
+    rng = random.Random(workload.seed)
+    results = []
+    with transaction() as cur:
+        for statement, arguments in _cases(data, rng):
+            # the first EXECUTE also prepares, so it is left out of the timings
+            statement.execute(cur, arguments(0))
+            plain = prepared = 0.0
+            for i in range(calls):
+                args = arguments(i)
+                start = time.perf_counter()
+                cur.execute(statement.sql, args)
+                plain += time.perf_counter() - start
+                start = time.perf_counter()
+                statement.execute(cur, args)
+                prepared += time.perf_counter() - start
+            results.append((statement.name, plain / calls * 1000, prepared / calls * 1000))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=2000)
+    add_workload_arguments(parser)
+    args = parser.parse_args()
+    print('%-24s %12s %14s %9s' % ('statement', 'plain ms', 'prepared ms', 'saved'))
+    for name, plain, prepared in run(workload_from_args(args), args.calls):
+        print('%-24s %12.4f %14.4f %8.1f%%' % (name, plain, prepared, (plain - prepared) / plain * 100))
+
+
+if __name__ == '__main__':
+    main()
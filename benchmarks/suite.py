@@ -0,0 +1,261 @@
+"""
+Micro-benchmarks for the public functions in src/chat.py, run against a synthetic workload.
+
+Each benchmark calls one function with arguments drawn (with a fixed seed) from the generated rows, so every run
+on every commit makes the same calls against the same data. Results are written as JSON for benchmarks.compare.
+
+    python -m benchmarks.suite [--iterations N] [--only NAME ...] [--output FILE] [workload options]
+
+WARNING: this drops and rebuilds the chat tables in the database configured in config/db.yml
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from benchmarks.workload import BASE_TIME, WORDS, add_workload_arguments, email, generate, workload_from_args
+from src import chat
+from src.cache import clear_caches
+from src.swen344_db_utils import exec_get_one
+
+# time_sent for writes made by the benchmarks: after every generated row and outside every suspension
+BENCH_TIME = '2030-01-01 00:00:00'
+# inside the suspensions written by the workload
+SUSPENDED_TIME = BASE_TIME.replace(month=6).strftime('%Y-%m-%d %H:%M:%S')
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+# name, chat function, and a function of (dataset, rng, count) returning the argument tuples for each call
+Benchmark = namedtuple('Benchmark', ['name', 'func', 'arguments'])
+
+
+def _membership(data, rng):
+    community = rng.choice(sorted(data.members))
+    return community, rng.choice(data.members[community])
+
+
+def _channel_member(data, rng):
+    community, user = _membership(data, rng)
+    return user, rng.choice(data.channels[community]), community
+
+
+def _conversation(data, rng):
+    message_id, sender, receiver = rng.choice(data.messages)
+    return receiver, sender
+
+
+def _post_arguments(data, rng, count):
+    calls = []
+    for i in range(count):
+        user, channel, community = _channel_member(data, rng)
+        calls.append((user, channel, community, 'benchmark post %d @%s' % (i, rng.choice(data.members[community])),
+                      BENCH_TIME))
+    return calls
+
+
+def _direct_message_arguments(data, rng, count):
+    first_id = (chat.get_last_message_id() or 0) + 1
+    return [(first_id + i,) + tuple(rng.sample(data.users, 2)) + (BENCH_TIME, 'benchmark message %d' % i)
+            for i in range(count)]
+
+
+def _suspension_arguments(data, rng, count):
+    calls = []
+    for i in range(count):
+        if i % 2:
+            user, community = rng.choice(data.suspended)
+        else:
+            community, user = _membership(data, rng)
+        calls.append((user, rng.choice(data.channels[community]), SUSPENDED_TIME, community))
+    return calls
+
+
+def _rename_arguments(data, rng, count):
+    # a user can only be renamed once in six months, so every call renames a different user
+    if count > len(data.users):
+        raise ValueError('change_username needs a user per iteration, use more users or fewer iterations')
+    return [(user, 'renamed_%06d' % i, BENCH_TIME) for i, user in enumerate(rng.sample(data.users, count))]
+
+
+# reads first, then writes. change_username comes last because renamed users drop out of every other table
+BENCHMARKS = [
+    Benchmark('user_exists', chat.user_exists,
+              lambda data, rng, count: [(email(rng.randrange(len(data.users))),) for i in range(count)]),
+    Benchmark('get_email_by_id', chat.get_email_by_id,
+              lambda data, rng, count: [(rng.choice(data.users),) for i in range(count)]),
+    Benchmark('channel_exists', chat.channel_exists,
+              lambda data, rng, count: [_channel_member(data, rng)[1:] for i in range(count)]),
+    Benchmark('get_users_in_community', chat.get_users_in_community,
+              lambda data, rng, count: [(rng.choice(sorted(data.members)),) for i in range(count)]),
+    Benchmark('get_unread_messages', chat.get_unread_messages,
+              lambda data, rng, count: [(rng.choice(data.users),) for i in range(count)]),
+    Benchmark('get_unread_messages_page', chat.get_unread_messages_page,
+              lambda data, rng, count: [(rng.choice(data.users), 50) for i in range(count)]),
+    Benchmark('get_messages_from', chat.get_messages_from,
+              lambda data, rng, count: [_conversation(data, rng) for i in range(count)]),
+    Benchmark('get_messages_from_page', chat.get_messages_from_page,
+              lambda data, rng, count: [_conversation(data, rng) + (50,) for i in range(count)]),
+    Benchmark('get_unread_posts', chat.get_unread_posts,
+              lambda data, rng, count: [(_membership(data, rng)[1],) for i in range(count)]),
+    Benchmark('get_unread_posts_page', chat.get_unread_posts_page,
+              lambda data, rng, count: [(_membership(data, rng)[1], 50) for i in range(count)]),
+    Benchmark('get_mentions', chat.get_mentions,
+              lambda data, rng, count: [(_membership(data, rng)[1],) for i in range(count)]),
+    Benchmark('get_mentions_page', chat.get_mentions_page,
+              lambda data, rng, count: [(_membership(data, rng)[1], 50) for i in range(count)]),
+    Benchmark('get_inbox', chat.get_inbox,
+              lambda data, rng, count: [(rng.choice(data.users), 20) for i in range(count)]),
+    Benchmark('get_channel_history', chat.get_channel_history,
+              lambda data, rng, count: [_channel_member(data, rng)[1:] + (50,) for i in range(count)]),
+    Benchmark('get_unread_counts', chat.get_unread_counts,
+              lambda data, rng, count: [(rng.choice(data.users),) for i in range(count)]),
+    Benchmark('search_channel_posts', chat.search_channel_posts,
+              lambda data, rng, count: [(_membership(data, rng)[1], rng.choice(WORDS)) for i in range(count)]),
+    Benchmark('search_direct_messages', chat.search_direct_messages,
+              lambda data, rng, count: [(rng.choice(data.users), rng.choice(WORDS)) for i in range(count)]),
+    Benchmark('is_suspended', chat.is_suspended, _suspension_arguments),
+    Benchmark('get_last_message_id', chat.get_last_message_id, lambda data, rng, count: [()] * count),
+    Benchmark('post_to_channel', chat.post_to_channel, _post_arguments),
+    Benchmark('create_direct_message', chat.create_direct_message, _direct_message_arguments),
+    Benchmark('read_message', chat.read_message,
+              lambda data, rng, count: [(message[0], message[2]) for message in
+                                        (rng.choice(data.messages) for i in range(count))]),
+    Benchmark('mark_channel_read', chat.mark_channel_read,
+              lambda data, rng, count: [_channel_member(data, rng) for i in range(count)]),
+    Benchmark('mark_conversation_read', chat.mark_conversation_read,
+              lambda data, rng, count: [_conversation(data, rng) for i in range(count)]),
+    Benchmark('mark_all_read', chat.mark_all_read,
+              lambda data, rng, count: [(rng.choice(data.users),) for i in range(count)]),
+    Benchmark('change_username', chat.change_username, _rename_arguments),
+]
+
+
+def summarize(timings):
+    """
+    :param timings: list of call durations in seconds
+    :return: dict of summary statistics in milliseconds
+    """
+    ordered = sorted(timings)
+    return {
+        'iterations': len(ordered),
+        'mean_ms': statistics.mean(ordered) * 1000,
+        'median_ms': statistics.median(ordered) * 1000,
+        'p95_ms': ordered[int(round(0.95 * (len(ordered) - 1)))] * 1000,
+        'min_ms': ordered[0] * 1000,
+        'max_ms': ordered[-1] * 1000,
+        'ops_per_s': len(ordered) / max(sum(ordered), 1e-9),
+    }
+
+
+def run_benchmark(benchmark, dataset, iterations, warmup=5, cold=False, seed=0):
+    """
+    :param benchmark: Benchmark to run
+    :param dataset: Dataset returned by generate()
+    :param iterations: timed calls
+    :param warmup: untimed calls made first
+    :param cold: clear the lookup caches before every call
+    :param seed: seed for choosing arguments
+    :return: summarize() of the timed calls
+    """
+    calls = benchmark.arguments(dataset, random.Random('%s:%s' % (seed, benchmark.name)), warmup + iterations)
+    timings = []
+    for i, args in enumerate(calls):
+        if cold:
+            clear_caches()
+        start = time.perf_counter()
+        benchmark.func(*args)
+        elapsed = time.perf_counter() - start
+        if i >= warmup:
+            timings.append(elapsed)
+    return summarize(timings)
+
+
+def _git(*args):
+    try:
+        return subprocess.run(('git',) + args, cwd=os.path.dirname(__file__), stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    """
+    :return: dict describing the code and servers the results came from
+    """
+    status = _git('status', '--porcelain', '--untracked-files=no')
+    return {
+        'commit': _git('rev-parse', 'HEAD'),
+        'dirty': bool(status) if status is not None else None,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'postgres': exec_get_one('SHOW server_version')[0],
+        'unread_mode': chat.get_unread_mode(),
+    }
+
+
+def run(workload, iterations=100, warmup=5, only=None, cold=False, report=print):
+    """
+    generates the workload and runs the benchmarks against it
+    :param workload: Workload to generate
+    :param iterations: timed calls per benchmark
+    :param warmup: untimed calls per benchmark
+    :param only: names of the benchmarks to run, defaults to all of them
+    :param cold: clear the lookup caches before every call
+    :param report: called with a line per finished benchmark
+    :return: JSON-serializable dict of the environment, workload and results
+    """
+    unknown = set(only or ()) - {benchmark.name for benchmark in BENCHMARKS}
+    if unknown:
+        raise ValueError('unknown benchmarks: ' + ', '.join(sorted(unknown)))
+    dataset = generate(workload)
+    report('Generated workload in %.1f s' % dataset.seconds)
+    results = {}
+    for benchmark in BENCHMARKS:
+        if only and benchmark.name not in only:
+            continue
+        results[benchmark.name] = run_benchmark(benchmark, dataset, iterations, warmup, cold, workload.seed)
+        report('%-26s %10.3f ms median %10.3f ms p95 %10.0f ops/s'
+               % (benchmark.name, results[benchmark.name]['median_ms'], results[benchmark.name]['p95_ms'],
+                  results[benchmark.name]['ops_per_s']))
+    return {
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'environment': environment(),
+        'workload': dict(workload._asdict()),
+        'generate_seconds': dataset.seconds,
+        'iterations': iterations,
+        'warmup': warmup,
+        'cold_caches': cold,
+        'results': results,
+    }
+
+
+def default_output(results):
+    commit = (results['environment']['commit'] or 'unknown')[:12]
+    stamp = results['started_at'].replace(':', '').replace('-', '')
+    return os.path.join(RESULTS_DIR, '%s-%s.json' % (stamp, commit))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--only', nargs='+', choices=[benchmark.name for benchmark in BENCHMARKS])
+    parser.add_argument('--cold', action='store_true', help='clear the lookup caches before every call')
+    parser.add_argument('--output', help='JSON file for the results, defaults to benchmarks/results/')
+    add_workload_arguments(parser)
+    args = parser.parse_args()
+    results = run(workload_from_args(args), args.iterations, args.warmup, args.only, args.cold)
+    output = args.output or default_output(results)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+    print('Wrote ' + output)
+
+
+if __name__ == '__main__':
+    main()
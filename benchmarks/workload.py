@@ -0,0 +1,169 @@
+"""
+Deterministic synthetic workloads for the benchmarks.
+
+generate() rebuilds the chat tables and fills them with users, communities, channels, memberships, channel posts
+(with their mentions and unread rows), direct messages and the unread counters. The same Workload always produces the
+same rows, ids and timestamps, so runs on different commits measure the same data.
+
+    python -m benchmarks.workload [--users N] [--communities N] [--channels N] [--members N] [--posts N] [--dms N]
+
+WARNING: this drops and rebuilds the chat tables in the database configured in config/db.yml
+"""
+import argparse
+import random
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from psycopg2.extras import execute_values
+
+from src.cache import clear_caches
+from src.chat import add_channels, add_users_to_community, create_users, get_unread_mode, rebuild_tables, \
+    reconcile_unread_counts
+from src.importer import sync_message_id_sequence
+from src.mentions import MentionIndex
+from src.swen344_db_utils import transaction
+
+Workload = namedtuple('Workload', ['users', 'communities', 'channels', 'members', 'posts', 'dms', 'mention_rate',
+                                   'read_rate', 'suspended', 'seed'],
+                      defaults=(1000, 10, 5, 100, 2000, 5000, 0.2, 0.5, 20, 344))
+# what generate() wrote, for picking benchmark arguments that hit real rows
+Dataset = namedtuple('Dataset', ['workload', 'users', 'members', 'channels', 'messages', 'suspended', 'seconds'])
+
+# every generated row is timestamped from here, one second apart
+BASE_TIME = datetime(2020, 1, 1)
+# suspensions cover the first year after BASE_TIME
+SUSPENSION_DAYS = 365
+WORDS = ('who', 'is', 'on', 'first', 'what', 'second', 'i', 'dont', 'know', 'third', 'base', 'the', 'team',
+         'player', 'name', 'ball', 'pitcher', 'catcher', 'today', 'tomorrow', 'because', 'shortstop', 'naturally')
+
+
+def user_id(n):
+    return 'user_%06d' % n
+
+
+def email(n):
+    return 'user_%06d@bench.edu' % n
+
+
+def community_name(n):
+    return 'community_%03d' % n
+
+
+def channel_name(n):
+    return 'channel_%03d' % n
+
+
+def _text(rng, words=8):
+    return ' '.join(rng.choice(WORDS) for i in range(words))
+
+
+def _timestamp(n):
+    return BASE_TIME + timedelta(seconds=n)
+
+
+def _seed_posts(cur, rng, workload, members, channels):
+    cur.execute('SELECT community_name, name, id FROM channels')
+    channel_ids = {(row[0], row[1]): row[2] for row in cur.fetchall()}
+    communities = sorted(members)
+    rosters = {community: MentionIndex(members[community]) for community in communities}
+    posts = []
+    for n in range(workload.posts):
+        community = rng.choice(communities)
+        poster = rng.choice(members[community])
+        text = _text(rng)
+        if rng.random() < workload.mention_rate:
+            text += ' @' + rng.choice(members[community])
+        posts.append((community, channel_ids[(community, rng.choice(channels[community]))], text, poster,
+                      _timestamp(n)))
+    ids = execute_values(cur, 'INSERT INTO channel_posts (channel_id, text, user_id, time_sent) VALUES %s '
+                              'RETURNING id', [post[1:] for post in posts], page_size=1000, fetch=True)
+    mentions = [(mentioned, str(post_id[0]))
+                for post, post_id in zip(posts, ids) for mentioned in rosters[post[0]].extract(post[2])]
+    execute_values(cur, 'INSERT INTO mentions (user_id, post_id) VALUES %s', mentions, page_size=1000)
+    if get_unread_mode() == 'fanout':
+        # the rows post_to_channel would have written for every other member
+        cur.execute('INSERT INTO unread_posts (user_id, post_id) '
+                    'SELECT memberships.user_id, channel_posts.id::VARCHAR FROM channel_posts '
+                    'JOIN channels ON channels.id = channel_posts.channel_id '
+                    'JOIN memberships ON memberships.community_name = channels.community_name '
+                    'WHERE memberships.user_id <> channel_posts.user_id')
+
+
+def _seed_direct_messages(cur, rng, workload, users):
+    messages = []
+    rows = []
+    for n in range(workload.dms):
+        sender, receiver = rng.sample(users, 2)
+        messages.append((n + 1, sender, receiver))
+        rows.append((n + 1, sender, receiver, _timestamp(n), _text(rng), rng.random() < workload.read_rate))
+    execute_values(cur, 'INSERT INTO direct_messages (message_id, sender_id, receiver_id, time_sent, message, '
+                        'is_read) VALUES %s', rows, page_size=1000)
+    sync_message_id_sequence(cur)
+    return messages
+
+
+def _seed_suspensions(cur, rng, workload, members):
+    memberships = [(user, community) for community in sorted(members) for user in members[community]]
+    suspended = rng.sample(memberships, min(workload.suspended, len(memberships)))
+    execute_values(cur, 'INSERT INTO suspensions (user_id, suspended_since, suspended_till, community_name) '
+                        'VALUES %s',
+                   [(user, BASE_TIME, BASE_TIME + timedelta(days=SUSPENSION_DAYS), community)
+                    for user, community in suspended])
+    return suspended
+
+
+def generate(workload=Workload()):
+    """
+    rebuilds the tables and fills them with a synthetic workload
+    :param workload: Workload giving the size of each table and the random seed
+    :return: Dataset describing the rows written
+    """
+    if workload.users < 2:
+        raise ValueError('a workload needs at least two users')
+    started = time.monotonic()
+    rng = random.Random(workload.seed)
+    users = [user_id(n) for n in range(workload.users)]
+    members = {}
+    channels = {}
+    rebuild_tables()
+    with transaction() as cur:
+        create_users([(user_id(n), 'User %d' % n, '585555%04d' % (n % 10000), email(n), _timestamp(0))
+                      for n in range(workload.users)])
+        for c in range(workload.communities):
+            community = community_name(c)
+            cur.execute('INSERT INTO communities (name) VALUES (%s)', (community,))
+            channels[community] = [channel_name(n) for n in range(workload.channels)]
+            add_channels(channels[community], community)
+            members[community] = sorted(rng.sample(users, min(workload.members, workload.users)))
+            add_users_to_community(members[community], community)
+        _seed_posts(cur, rng, workload, members, channels)
+        messages = _seed_direct_messages(cur, rng, workload, users)
+        suspended = _seed_suspensions(cur, rng, workload, members)
+        reconcile_unread_counts()
+        cur.execute('ANALYZE')
+    clear_caches()
+    return Dataset(workload, users, members, channels, messages, suspended, time.monotonic() - started)
+
+
+def add_workload_arguments(parser):
+    """adds a --flag for every Workload field to an argparse parser"""
+    defaults = Workload()
+    for field in Workload._fields:
+        default = getattr(defaults, field)
+        parser.add_argument('--' + field.replace('_', '-'), type=type(default), default=default)
+
+
+def workload_from_args(args):
+    return Workload(**{field: getattr(args, field) for field in Workload._fields})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_workload_arguments(parser)
+    dataset = generate(workload_from_args(parser.parse_args()))
+    print('Generated %s in %.1f s' % (dict(dataset.workload._asdict()), dataset.seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Measures write throughput with one commit per write against group commit through src.write_behind.
+
+The same direct messages and channel posts, drawn from a synthetic workload, are written once by calling the chat
+functions directly and once through a write-behind queue, each from the same number of client threads.
+
+    python -m benchmarks.write_behind [--writes 2000] [--threads 4] [--workers 1] [--max-batch 100]
+                                      [--max-delay-ms 5] [--async-commit] [workload options]
+
+WARNING: this drops and rebuilds the chat tables in the database configured in config/db.yml
+"""
+import argparse
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.suite import BENCH_TIME, _channel_member
+from benchmarks.workload import add_workload_arguments, generate, workload_from_args
+from src import chat
+from src.write_behind import WriteBehindQueue
+
+
+def _writes(data, rng, count, first_id):
+    """
+    :return: list of (chat write function, arguments), alternating direct messages and posts
+    """
+    writes = []
+    for i in range(count):
+        if i % 2:
+            user, channel, community = _channel_member(data, rng)
+            writes.append((chat.post_to_channel, (user, channel, community, 'group commit %d' % i, BENCH_TIME)))
+        else:
+            sender, receiver = rng.sample(data.users, 2)
+            writes.append((chat.create_direct_message, (first_id + i, sender, receiver, BENCH_TIME, 'dm %d' % i)))
+    return writes
+
+
+def _direct(writes, threads):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(lambda write: write[0](*write[1]), writes))
+    return time.perf_counter() - start
+
+
+def _write_behind(writes, threads, queue):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        futures = list(pool.map(lambda write: queue.submit(write[0], *write[1]), writes))
+    for future in futures:
+        future.result()
+    return time.perf_counter() - start
+
+
+def run(workload, count, threads, workers, max_batch, max_delay_ms, synchronous_commit):
+    """
+    :return: (direct writes/s, write-behind writes/s, write-behind queue stats)
+    """
+    data = generate(workload)
+    rng = random.Random(workload.seed)
+    direct = _direct(_writes(data, rng, count, (chat.get_last_message_id() or 0) + 1), threads)
+    queue = WriteBehindQueue(max_batch=max_batch, max_delay_ms=max_delay_ms, workers=workers,
+                             synchronous_commit=synchronous_commit)
+    try:
+        batched = _write_behind(_writes(data, rng, count, (chat.get_last_message_id() or 0) + 1), threads, queue)
+    finally:
+        queue.close()
+    return count / direct, count / batched, queue.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--writes', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=1, help='write-behind worker threads')
+    parser.add_argument('--max-batch', type=int, default=100)
+    parser.add_argument('--max-delay-ms', type=float, default=5)
+    parser.add_argument('--async-commit', action='store_true', help='commit batches with synchronous_commit off')
+    add_workload_arguments(parser)
+    args = parser.parse_args()
+    direct, batched, stats = run(workload_from_args(args), args.writes, args.threads, args.workers, args.max_batch,
+                                 args.max_delay_ms, not args.async_commit)
+    print('one commit per write %10.0f writes/s' % direct)
+    print('write-behind         %10.0f writes/s  (%.1fx)' % (batched, batched / direct))
+    print('%d batches, mean %.1f writes, largest %d, deepest queue %d'
+          % (stats['batches'], stats['mean_batch'], stats['max_batch'], stats['peak_queue_depth']))
+
+
+if __name__ == '__main__':
+    main()
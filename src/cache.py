@@ -0,0 +1,127 @@
+"""
+In-process LRU caches with a time to live, for lookups that chat operations repeat over and over.
+Write paths invalidate the keys they change. The TTL bounds how stale a value can be when another process
+made the change.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from src.swen344_db_utils import after_transaction
+
+DEFAULT_MAXSIZE = 10000
+DEFAULT_TTL = 60  # seconds
+
+_MISSING = object()
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class LRUCache:
+    """
+    thread-safe mapping that evicts the least recently used entry once it holds maxsize entries
+    and treats entries older than ttl seconds as missing
+    """
+
+    def __init__(self, name, maxsize=DEFAULT_MAXSIZE, ttl=DEFAULT_TTL, clock=time.monotonic):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()  # key -> (expires_at, value), least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                if entry[0] > self._clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (self._clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, loader):
+        """
+        :param key: cache key
+        :param loader: called with no arguments to produce the value on a miss
+        :return: the cached or freshly loaded value
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = loader()
+            self.set(key, value)
+        return value
+
+    def _discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate(self, key):
+        """
+        drops key now, and again when the current transaction ends so a value read before it committed
+        (or from writes that were rolled back) is not kept
+        """
+        self._discard(key)
+        after_transaction(lambda: self._discard(key))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+def get_cache(name, maxsize=DEFAULT_MAXSIZE, ttl=DEFAULT_TTL):
+    """
+    :return: the cache registered under name, creating it on first use
+    """
+    with _caches_lock:
+        if name not in _caches:
+            _caches[name] = LRUCache(name, maxsize, ttl)
+        return _caches[name]
+
+
+def register_cache(cache):
+    """
+    adds a cache that is not an LRUCache to cache_stats() and clear_caches()
+    :param cache: object with name, clear() and stats()
+    :return: cache
+    """
+    with _caches_lock:
+        _caches[cache.name] = cache
+    return cache
+
+
+def cache_stats():
+    """
+    :return: dict of cache name -> its stats(): hits, misses, evictions, size and maxsize for an LRUCache
+    """
+    with _caches_lock:
+        caches = list(_caches.values())
+    return {cache.name: cache.stats() for cache in caches}
+
+
+def clear_caches():
+    """empties every cache, for when the tables are rebuilt or written to behind the chat API's back"""
+    with _caches_lock:
+        caches = list(_caches.values())
+    for cache in caches:
+        cache.clear()
+    after_transaction(lambda: [cache.clear() for cache in caches])
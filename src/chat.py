@@ -1,139 +1,193 @@
-import csv
-import string
+from collections import namedtuple
 from datetime import datetime
 
 from dateutil.relativedelta import relativedelta
+from psycopg2.extras import execute_values
+
+from src import history, notifications, partitions, suspensions
+from src.cache import get_cache, clear_caches
+from src.importer import UPDATE_CONVERSATION, WHOS_ON_FIRST_SPEAKERS, count_received, import_conversation, \
+    sync_message_id_sequence
+from src.mentions import MentionIndex
+from src.migrations import SEARCH_CONFIG, drop_schema, migrate
+from src.swen344_db_utils import exec_get_all, exec_get_one, exec_commit, exec_stream, load_config, prepare, \
+    transaction, transactional
+
+# 'fanout' writes an unread_posts row per member on every post.
+# 'watermark' keeps one last-read post id per user and channel and works out unread posts when they are read
+UNREAD_MODES = ('fanout', 'watermark')
+_unread_mode = None
+
+# lookups repeated within and across operations. Write paths below invalidate the keys they change
+_users_by_email = get_cache('users_by_email')
+_emails_by_id = get_cache('emails_by_id')
+_communities = get_cache('communities')
+_channels = get_cache('channels')
+_rosters = get_cache('rosters')
+
+# the hot lookups and writes, prepared once per pooled connection
+_USER_BY_EMAIL = prepare('user_by_email', 'SELECT email FROM users WHERE email = %s')
+_EMAIL_BY_ID = prepare('email_by_id', 'SELECT email FROM users WHERE user_id = %s')
+_COMMUNITY = prepare('community_by_name', 'SELECT name FROM communities WHERE name = %s')
+_CHANNEL = prepare('channel_by_name', 'SELECT id FROM channels WHERE name = %s AND community_name = %s')
+_ROSTER = prepare('community_roster', 'SELECT user_id FROM memberships WHERE community_name = %s')
+_MEMBERSHIP = prepare('membership', 'SELECT 1 FROM memberships WHERE user_id = %s AND community_name = %s')
+_CHANNEL_COMMUNITIES = prepare('channel_communities', 'SELECT community_name FROM channels WHERE name = %s')
+# a direct message is unread until it is read on its own or its conversation's read watermark passes it. Watermarks
+# are positions in arrival order (seq), not message ids, which callers choose and so can arrive out of order
+_DM_UNREAD = 'direct_messages.is_read = FALSE AND direct_messages.seq > COALESCE(' \
+             '(SELECT last_read_seq FROM conversation_reads ' \
+             ' WHERE conversation_reads.receiver_id = direct_messages.receiver_id ' \
+             ' AND conversation_reads.sender_id = direct_messages.sender_id), 0)'
+# every write that changes what is unread also moves the unread_counts of the users it affects, in the same statement.
+# The receiver's side of a conversation summary is unread_a when the receiver is user_a, the lesser id. Statements
+# lock the receiver's unread_counts row before any conversations rows, and those in (user_a, user_b) order.
+# A new message is only counted in either when it is above its conversation's read watermark, as _DM_UNREAD has it
+_INSERT_DIRECT_MESSAGE = prepare('insert_direct_message', """
+    WITH sent AS (
+        INSERT INTO direct_messages(message_id, sender_id, receiver_id, time_sent, message) VALUES (%s,%s,%s,%s,%s)
+        RETURNING message_id, sender_id, receiver_id, time_sent, seq
+    ), received AS (
+        SELECT sent.*, (sent.seq > COALESCE(conversation_reads.last_read_seq, 0))::INT AS unread FROM sent
+        LEFT JOIN conversation_reads ON conversation_reads.receiver_id = sent.receiver_id
+            AND conversation_reads.sender_id = sent.sender_id
+    ), counted AS (
+        INSERT INTO unread_counts (user_id, unread_messages) SELECT receiver_id, unread FROM received
+        ON CONFLICT (user_id) DO UPDATE SET unread_messages = unread_counts.unread_messages + EXCLUDED.unread_messages
+        RETURNING user_id
+    ), conversed AS (
+        INSERT INTO conversations (user_a, user_b, last_message_id, last_time_sent, unread_a, unread_b)
+        SELECT LEAST(sender_id, receiver_id), GREATEST(sender_id, receiver_id), message_id, time_sent,
+               CASE WHEN receiver_id <= sender_id THEN unread ELSE 0 END,
+               CASE WHEN receiver_id > sender_id THEN unread ELSE 0 END
+        FROM received, counted""" + UPDATE_CONVERSATION + """
+        RETURNING user_a
+    )
+    SELECT pg_notify('""" + notifications.CHANNEL + """', jsonb_build_object('type', 'message', 'id', message_id,
+        'user', sender_id, 'receiver', receiver_id)::TEXT)
+    FROM sent, conversed""")
+# takes {messages} off the receiver's side of the conversations joined to {source}, which has a sender_id column
+_CONVERSATIONS_READ = """UPDATE conversations SET
+        unread_a = CASE WHEN conversations.user_a = %(receiver_id)s::VARCHAR
+                        THEN GREATEST(conversations.unread_a - {messages}, 0) ELSE conversations.unread_a END,
+        unread_b = CASE WHEN conversations.user_a = %(receiver_id)s::VARCHAR
+                        THEN conversations.unread_b ELSE GREATEST(conversations.unread_b - {messages}, 0) END
+        FROM {source}
+        WHERE conversations.user_a = LEAST(%(receiver_id)s::VARCHAR, {source}.sender_id)
+        AND conversations.user_b = GREATEST(%(receiver_id)s::VARCHAR, {source}.sender_id)"""
+_READ_MESSAGE = prepare('read_message', """
+    WITH target AS (
+        SELECT message_id, sender_id, message, """ + _DM_UNREAD + """ AS unread FROM direct_messages
+        WHERE message_id = %(message_id)s AND receiver_id = %(receiver_id)s FOR UPDATE
+    ), marked AS (
+        UPDATE direct_messages SET is_read = TRUE FROM target WHERE direct_messages.message_id = target.message_id
+    ), counted AS (
+        UPDATE unread_counts SET unread_messages = GREATEST(unread_messages - 1, 0) FROM target
+        WHERE unread_counts.user_id = %(receiver_id)s AND target.unread
+        RETURNING target.sender_id
+    ), conversation_read AS (
+        """ + _CONVERSATIONS_READ.format(messages=1, source='counted') + """
+    )
+    SELECT message FROM target
+""")
+_UNREAD_MESSAGE_ROWS = prepare('unread_messages',
+                               'SELECT message_id, sender_id, receiver_id, time_sent, message, is_read '
+                               'FROM direct_messages WHERE receiver_id = %s AND ' + _DM_UNREAD)
+# takes the unread messages a watermark move covered, between the locked previous watermark and the new one,
+# off the receiver's unread count and then off the conversations they belong to
+_COUNT_CONVERSATIONS_READ = """, covered AS (
+        SELECT advanced.sender_id, COUNT(*) AS messages FROM advanced
+        LEFT JOIN previous ON previous.sender_id = advanced.sender_id
+        JOIN direct_messages ON direct_messages.receiver_id = %(receiver_id)s
+            AND direct_messages.sender_id = advanced.sender_id AND direct_messages.is_read = FALSE
+            AND direct_messages.seq > COALESCE(previous.last_read_seq, 0)
+            AND direct_messages.seq <= advanced.last_read_seq
+        GROUP BY advanced.sender_id
+    ), locked AS (
+        SELECT covered.sender_id, covered.messages FROM covered
+        JOIN conversations ON conversations.user_a = LEAST(%(receiver_id)s::VARCHAR, covered.sender_id)
+            AND conversations.user_b = GREATEST(%(receiver_id)s::VARCHAR, covered.sender_id)
+        ORDER BY conversations.user_a, conversations.user_b FOR UPDATE OF conversations
+    ), conversations_read AS (
+        """ + _CONVERSATIONS_READ.format(messages='locked.messages', source='locked') + """
+    )
+    UPDATE unread_counts SET unread_messages = GREATEST(unread_messages - total.messages, 0)
+    FROM (SELECT SUM(messages) AS messages FROM covered) AS total
+    WHERE unread_counts.user_id = %(receiver_id)s AND total.messages > 0
+"""
+_MARK_CONVERSATION_READ = prepare('mark_conversation_read', """
+    WITH previous AS (
+        SELECT sender_id, last_read_seq FROM conversation_reads
+        WHERE receiver_id = %(receiver_id)s AND sender_id = %(sender_id)s FOR UPDATE
+    ), advanced AS (
+        INSERT INTO conversation_reads (receiver_id, sender_id, last_read_seq)
+        SELECT %(receiver_id)s::VARCHAR, %(sender_id)s::VARCHAR, COALESCE(MAX(seq), 0)
+        FROM direct_messages WHERE sender_id = %(sender_id)s AND receiver_id = %(receiver_id)s
+        AND (%(up_to)s::INT IS NULL OR message_id <= %(up_to)s::INT)
+        ON CONFLICT (receiver_id, sender_id) DO UPDATE
+        SET last_read_seq = GREATEST(conversation_reads.last_read_seq, EXCLUDED.last_read_seq)
+        RETURNING sender_id, last_read_seq
+    )""" + _COUNT_CONVERSATIONS_READ)
+_MARK_ALL_READ = prepare('mark_all_read', """
+    WITH previous AS (
+        SELECT sender_id, last_read_seq FROM conversation_reads WHERE receiver_id = %(receiver_id)s FOR UPDATE
+    ), advanced AS (
+        INSERT INTO conversation_reads (receiver_id, sender_id, last_read_seq)
+        SELECT receiver_id, sender_id, MAX(seq) FROM direct_messages WHERE receiver_id = %(receiver_id)s
+        GROUP BY receiver_id, sender_id
+        ON CONFLICT (receiver_id, sender_id) DO UPDATE
+        SET last_read_seq = GREATEST(conversation_reads.last_read_seq, EXCLUDED.last_read_seq)
+        RETURNING sender_id, last_read_seq
+    )""" + _COUNT_CONVERSATIONS_READ)
+_CONVERSATION = prepare('conversation',
+                        'SELECT message FROM direct_messages WHERE sender_id = %s AND receiver_id = %s')
+_UNREAD_POST_IDS = prepare('unread_post_ids', 'SELECT post_id FROM unread_posts WHERE user_id = %s')
+_USER_MENTIONS = prepare('user_mentions', 'SELECT * FROM mentions WHERE user_id = %s')
+
+
+def get_unread_mode():
+    """
+    :return: the unread tracking mode, read from unread_mode in db.yml unless set_unread_mode() was called
+    """
+    global _unread_mode
+    if _unread_mode is None:
+        _unread_mode = load_config().get('unread_mode', 'fanout')
+    return _unread_mode
+
 
-from src.swen344_db_utils import connect, exec_get_all, exec_commit
+def set_unread_mode(mode):
+    """
+    switches how unread posts are tracked. Use migrate_unread_posts_to_watermarks() before moving a
+    populated database from 'fanout' to 'watermark'
+    :param mode: one of UNREAD_MODES
+    """
+    global _unread_mode
+    if mode not in UNREAD_MODES:
+        raise ValueError('unread mode must be one of ' + ', '.join(UNREAD_MODES))
+    _unread_mode = mode
 
 
 def rebuild_tables():
     """
-    drops tables if necessary and builds all the tables from scratch
+    drops tables if necessary and builds all the tables from scratch by replaying the migrations
     :return:
     """
-    conn = connect()
-    cur = conn.cursor()
-    drop_users = """
-            DROP TABLE IF EXISTS users
-        """
-    drop_communities = """
-            DROP TABLE IF EXISTS communities
-        """
-    drop_memberships = """
-            DROP TABLE IF EXISTS memberships
-        """
-    drop_channels = """
-            DROP TABLE IF EXISTS channels
-        """
-    drop_channel_posts = """
-            DROP TABLE IF EXISTS channel_posts
-        """
-    drop_unread_posts = """
-            DROP TABLE IF EXISTS unread_posts
-        """
-    drop_mentions = """
-            DROP TABLE IF EXISTS mentions
-        """
-    drop_direct_messages = """
-            DROP TABLE IF EXISTS direct_messages
-        """
-    drop_suspensions = """
-            DROP TABLE IF EXISTS suspensions
-        """
-    create_schema = """
-        CREATE TABLE users(
-            user_id              VARCHAR(30) PRIMARY KEY NOT NULL,
-            name                 VARCHAR(30) NOT NULL,
-            phone_number         VARCHAR(10) NOT NULL,
-            email                VARCHAR(40) NOT NULL,
-            userid_set           TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-            userid_reset         TIMESTAMP DEFAULT NULL,
-            suspended_since      TIMESTAMP,
-            suspended_till       TIMESTAMP,
-            UNIQUE(email)
-        );
-        CREATE TABLE direct_messages(
-            message_id          SERIAL PRIMARY KEY NOT NULL,
-            sender_id           VARCHAR(30) NOT NULL,
-            receiver_id         VARCHAR(30) NOT NULL,
-            time_sent           TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-            message             TEXT NOT NULL,
-            is_read             BOOLEAN DEFAULT FALSE
-        );
-        CREATE TABLE communities(
-            name     VARCHAR(40) PRIMARY KEY NOT NULL
-        );
-        CREATE TABLE memberships(
-            user_id        VARCHAR(30) NOT NULL,
-            community_name VARCHAR(40) NOT NULL,
-            PRIMARY KEY(user_id, community_name)
-        );
-        CREATE TABLE unread_posts(
-            user_id      VARCHAR(30) NOT NULL,
-            post_id      VARCHAR(40) NOT NULL,
-            PRIMARY KEY(user_id, post_id)
-        );
-        CREATE TABLE channels(
-            id             SERIAL PRIMARY KEY,
-            name           VARCHAR(40) NOT NULL,
-            community_name VARCHAR(40) NOT NULL,
-            UNIQUE(name, community_name)
-        );
-        CREATE TABLE channel_posts(
-            id           SERIAL PRIMARY KEY NOT NULL,
-            channel_id   INT NOT NULL,
-            text         TEXT NOT NULL,
-            user_id      VARCHAR(30) NOT NULL,
-            time_sent    TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
-        );
-        CREATE TABLE mentions(
-            user_id      VARCHAR(30) NOT NULL,
-            post_id      VARCHAR(40) NOT NULL,
-            PRIMARY KEY(user_id, post_id)
-        );
-        CREATE TABLE suspensions(
-            user_id         VARCHAR(30) NOT NULL,
-            suspended_since TIMESTAMP DEFAULT NULL,
-            suspended_till  TIMESTAMP DEFAULT NULL,
-            community_name  VARCHAR(40) NOT NULL,
-            PRIMARY KEY(user_id, community_name)
-        ); 
-    """
-    cur.execute(drop_users)
-    cur.execute(drop_direct_messages)
-    cur.execute(drop_communities)
-    cur.execute(drop_channels)
-    cur.execute(drop_channel_posts)
-    cur.execute(drop_memberships)
-    cur.execute(drop_unread_posts)
-    cur.execute(drop_mentions)
-    cur.execute(drop_suspensions)
-    cur.execute(create_schema)
-    conn.commit()
-    conn.close()
+    with transaction():
+        drop_schema()
+        migrate()
+        if partitions.configured():
+            partitions.partition_tables()
+        clear_caches()
 
 
 def rebuild_direct_messages():
-    conn = connect()
-    cur = conn.cursor()
-    drop_direct_messages = """
-            DROP TABLE IF EXISTS direct_messages
-        """
-    create_direct_messages = """
-            CREATE TABLE direct_messages(
-                message_id          SERIAL PRIMARY KEY NOT NULL,
-                sender_id           VARCHAR(30) NOT NULL,
-                receiver_id         VARCHAR(30) NOT NULL,
-                time_sent           TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                message             TEXT NOT NULL,
-                is_read             BOOLEAN DEFAULT FALSE
-            );
-        """
-    cur.execute(drop_direct_messages)
-    cur.execute(create_direct_messages)
-    conn.commit()
-    conn.close()
+    """
+    empties direct_messages and restarts its message ids, keeping the table's indexes
+    """
+    with transaction() as cur:
+        # conversation watermarks would otherwise mark the reused ids as read
+        cur.execute('TRUNCATE direct_messages, conversation_reads, conversations RESTART IDENTITY')
+        cur.execute('UPDATE unread_counts SET unread_messages = 0 WHERE unread_messages <> 0')
 
 
 def user_exists(email):
@@ -142,15 +196,25 @@ def user_exists(email):
     :param email:
     :return:
     """
-    matches = exec_get_all('SELECT email FROM users WHERE email = %s', (email,))
-    return len(matches) == 1
+    return _users_by_email.get_or_load(
+        _email_key(email), lambda: len(exec_get_all(_USER_BY_EMAIL, (_email_key(email),))) == 1)
+
+
+def _email_key(email):
+    # callers pass either an email or the (email,) row returned by get_email_by_id
+    return email[0] if isinstance(email, tuple) else email
 
 
 def get_email_by_id(user_id):
-    matches = exec_get_all('SELECT email FROM users WHERE user_id = %s', (user_id,))
-    return matches[0]
+    email = _emails_by_id.get(user_id)
+    if email is None:
+        matches = exec_get_all(_EMAIL_BY_ID, (user_id,))
+        email = matches[0]
+        _emails_by_id.set(user_id, email)
+    return email
 
 
+@transactional
 def create_user(user_id: str, name: str, phone_number: int, email: str, userid_set: datetime,
                 userid_reset: None, suspended_since: None, suspended_till: None) -> str:
     """
@@ -177,9 +241,12 @@ def create_user(user_id: str, name: str, phone_number: int, email: str, userid_s
              f'VALUES (\'{user_id}\',\'{name}\', {phone_number},' \
              f'\'{email}\', \'{userid_set}\', NULL, NULL, NULL)'
     exec_commit(string)
+    _users_by_email.invalidate(email)
+    _emails_by_id.invalidate(user_id)
     return "User added successfully"
 
 
+@transactional
 def change_username(user_id, new_name, change_time=None):
     """
     changes username (user_id in db) if it has not been changed in the last six months
@@ -205,23 +272,24 @@ def change_username(user_id, new_name, change_time=None):
     six_months_later = relativedelta(months=6)
 
     if not change_date or (change_date + six_months_later <= new_time):
-        exec_commit('UPDATE users SET userid_reset = %s WHERE email = %s', (new_time, email))
-        exec_commit('UPDATE users SET user_id = %s WHERE email = %s', (new_name, email))
+        exec_commit('UPDATE users SET userid_reset = %s, user_id = %s WHERE email = %s', (new_time, new_name, email))
+        _emails_by_id.invalidate(user_id)
+        _emails_by_id.invalidate(new_name)
         return "User successfully changed username to " + new_name
     return "User changed their username in the last 6 months"
 
 
 def community_exists(community_name):
-    matching_communities = exec_get_all('SELECT name FROM communities WHERE name = %s', (community_name,))
-    return len(matching_communities) == 1
+    return _communities.get_or_load(community_name, lambda: len(
+        exec_get_all(_COMMUNITY, (community_name,))) == 1)
 
 
 def channel_exists(channel_name, community_name):
-    matching_channels = exec_get_all('SELECT id FROM channels WHERE name = %s AND community_name = %s',
-                                     (channel_name, community_name))
-    return len(matching_channels) == 1
+    return _channels.get_or_load((channel_name, community_name), lambda: len(
+        exec_get_all(_CHANNEL, (channel_name, community_name))) == 1)
 
 
+@transactional
 def add_channel(channel, community_name):
     if channel_exists(channel, community_name):
         return channel + " exists"
@@ -231,9 +299,11 @@ def add_channel(channel, community_name):
 
     exec_commit('INSERT INTO channels (name,community_name) VALUES (%s,%s)',
                 (channel, community_name))
+    _channels.invalidate((channel, community_name))
     return channel + " was added to " + community_name
 
 
+@transactional
 def add_community(community_name, channels=[]):
     """
     This function will add a new community and a list of channels to it if specified
@@ -243,12 +313,14 @@ def add_community(community_name, channels=[]):
 
     exec_commit('INSERT INTO communities (name) VALUES (%s)',
                 (community_name,))
+    _communities.invalidate(community_name)
     print("Creating community " + community_name)
     for channel in channels:
         print(add_channel(channel, community_name) + " ")
     return community_name + " was added "
 
 
+@transactional
 def add_user_to_community(user_id, community):
     """
     This will add a user to a community
@@ -259,9 +331,17 @@ def add_user_to_community(user_id, community):
         return "The user doesn't exist"
     exec_commit('INSERT INTO memberships (user_id,community_name) VALUES (%s,%s)',
                 (user_id, community))
+    _rosters.invalidate(community)
+    # posts from before the user joined are never unread for them
+    exec_commit('INSERT INTO channel_reads (user_id, channel_id, last_read_post_id, posts_read) '
+                'SELECT %s, channels.id, COALESCE(MAX(channel_posts.id), 0), COUNT(channel_posts.id) FROM channels '
+                'LEFT JOIN channel_posts ON channel_posts.channel_id = channels.id '
+                'WHERE channels.community_name = %s GROUP BY channels.id '
+                'ON CONFLICT (user_id, channel_id) DO NOTHING', (user_id, community))
     return user_id + " is now a member of " + community
 
 
+@transactional
 def get_users_in_community(community):
     """
     This function will get the list of all users that are in the given channel
@@ -269,54 +349,110 @@ def get_users_in_community(community):
     if not community_exists(community):
         return []
 
-    user_list = exec_get_all('SELECT user_id FROM memberships WHERE community_name = %s', (community,))
+    return list(_roster(community).member_list)
 
-    return [user[0] for user in user_list]
 
-
-def post_to_channel(poster_id, channel, community, message,
-                    time_sent=datetime.now().strftime("%Y-%m-%d %H:%M:%S")):
+def _roster(community):
+    """
+    :return: cached MentionIndex over the community's members
+    """
+    return _rosters.get_or_load(community, lambda: MentionIndex(
+        user[0] for user in exec_get_all(_ROSTER, (community,))))
+
+
+_INSERT_POST = """
+    WITH post AS (
+        INSERT INTO channel_posts (channel_id, text, user_id, time_sent)
+        SELECT id, %(message)s, %(poster_id)s, %(time_sent)s FROM channels
+        WHERE community_name = %(community)s AND name = %(channel)s
+        RETURNING id, channel_id, time_sent
+    ), mentioned AS (
+        INSERT INTO mentions (user_id, post_id)
+        SELECT unnest(%(mentioned)s::VARCHAR[]), post.id FROM post
+    )"""
+# every other member gets an unread post, and mentioned members a mention
+_MEMBER_COUNTS = """, counts AS (
+        SELECT memberships.user_id, post.channel_id, (memberships.user_id <> %(poster_id)s)::INT AS unread_posts,
+            (memberships.user_id = ANY(%(mentioned)s::VARCHAR[]))::INT AS mentions
+        FROM memberships, post WHERE memberships.community_name = %(community)s
+        AND (memberships.user_id <> %(poster_id)s OR memberships.user_id = ANY(%(mentioned)s::VARCHAR[]))
+    )"""
+# the channel's post counter and the poster's read posts go up by one, and mentioned members get a mention. Each
+# member's unread posts are the channel's posts less the ones they have read, so no other member's row is written
+_CHANNEL_COUNTS = """, posted AS (
+        INSERT INTO channel_post_counts (channel_id, posts) SELECT channel_id, 1 FROM post
+        ON CONFLICT (channel_id) DO UPDATE SET posts = channel_post_counts.posts + 1
+    ), own AS (
+        INSERT INTO channel_reads (user_id, channel_id, posts_read) SELECT %(poster_id)s, channel_id, 1 FROM post
+        ON CONFLICT (user_id, channel_id) DO UPDATE SET posts_read = channel_reads.posts_read + 1
+    ), counts AS (
+        SELECT memberships.user_id, post.channel_id, 0 AS unread_posts, 1 AS mentions
+        FROM memberships, post WHERE memberships.community_name = %(community)s
+        AND memberships.user_id = ANY(%(mentioned)s::VARCHAR[])
+    )"""
+_COUNT_POST = """, channel_counted AS (
+        INSERT INTO channel_unread_counts (user_id, channel_id, unread_posts, mentions)
+        SELECT user_id, channel_id, unread_posts, mentions FROM counts ORDER BY user_id
+        ON CONFLICT (user_id, channel_id) DO UPDATE
+        SET unread_posts = channel_unread_counts.unread_posts + EXCLUDED.unread_posts,
+            mentions = channel_unread_counts.mentions + EXCLUDED.mentions
+    ), counted AS (
+        INSERT INTO unread_counts (user_id, unread_posts, mentions)
+        SELECT user_id, unread_posts, mentions FROM counts ORDER BY user_id
+        ON CONFLICT (user_id) DO UPDATE
+        SET unread_posts = unread_counts.unread_posts + EXCLUDED.unread_posts,
+            mentions = unread_counts.mentions + EXCLUDED.mentions
+    )"""
+_FAN_OUT_UNREAD = """, unread AS (
+        INSERT INTO unread_posts (user_id, post_id)
+        SELECT memberships.user_id, post.id FROM memberships, post
+        WHERE memberships.community_name = %(community)s AND memberships.user_id <> %(poster_id)s
+    )"""
+# returns the post, and sends its event to subscribers when the statement's transaction commits
+_NOTIFY_POST = """
+    SELECT id, channel_id, time_sent,
+        pg_notify('""" + notifications.CHANNEL + """', jsonb_strip_nulls(jsonb_build_object('type', 'post',
+        'id', id, 'user', %(poster_id)s::VARCHAR, 'community', %(community)s::VARCHAR,
+        'channel', %(channel)s::VARCHAR, 'mentioned', CASE WHEN cardinality(%(mentioned)s::VARCHAR[]) <= """ + \
+    str(notifications.MAX_NOTIFY_MENTIONS) + """ THEN to_jsonb(%(mentioned)s::VARCHAR[]) END))::TEXT)
+    FROM post
+"""
+# writes the post, its mentions, the members' unread counters and an unread row for every other member
+# in one statement. Counter rows are written in user_id order so concurrent posts cannot deadlock on them
+POST_FAN_OUT = _INSERT_POST + _MEMBER_COUNTS + _COUNT_POST + _FAN_OUT_UNREAD + _NOTIFY_POST
+# watermark mode writes the post, its mentions, the channel's counters and the mentioned members' counters, so
+# posting costs the same whatever the size of the community
+POST_WATERMARK = _INSERT_POST + _CHANNEL_COUNTS + _COUNT_POST + _NOTIFY_POST
+_POST_STATEMENTS = {'fanout': prepare('post_fan_out', POST_FAN_OUT),
+                    'watermark': prepare('post_watermark', POST_WATERMARK)}
+
+
+@transactional
+def post_to_channel(poster_id, channel, community, message, time_sent=None):
     """
     This function will let a user send a message on a channel
     """
+    if time_sent is None:
+        time_sent = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     if not (channel_exists(channel, community)):
         return "The channel doesn't exist"
-    community_ids = get_users_in_community(community)
-    if not poster_id in community_ids:
+    roster = _roster(community)
+    if poster_id not in roster.members:
         return "User is not a part of the community"
-    if is_suspended(poster_id, channel, time_sent):
+    if is_suspended(poster_id, channel, time_sent, community):
         return "User is suspended"
-    mentioned_users = []
-    split_message = message.split("@")
-
-    for i in range(len(split_message)):
-        if i % 2 == 1:
-            first_word_after_symbol = split_message[i].translate(string.punctuation).split()[0]
-            for user_id in community_ids:
-                if user_id == first_word_after_symbol:
-                    mentioned_users.append(user_id)
-                    break
-    mentioned_users = list(set(mentioned_users))
-    community_ids.remove(poster_id)
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute('SELECT id FROM channels WHERE community_name = %s AND name = %s', (community, channel))
-    channel_id = cur.fetchall()[0][0]
-    cur.execute('INSERT INTO channel_posts (channel_id, text, user_id, time_sent) VALUES (%s,%s,%s,%s) RETURNING id',
-                (channel_id, message, poster_id, time_sent))
-    post_id = cur.fetchall()[0][0]
-    for user_id in community_ids:
-        cur.execute('INSERT INTO unread_posts (user_id,post_id) VALUES (%s,%s)',
-                    (user_id, post_id))
-
-    for user_id in mentioned_users:
-        cur.execute('INSERT INTO mentions (user_id,post_id) VALUES (%s,%s)',
-                    (user_id, post_id))
-    conn.commit()
-    conn.close()
+    mentioned_users = roster.extract(message)
+    # the post, its unread rows for every other member and its mentions are written by one statement,
+    # so the cost of posting no longer grows with the number of statements per member
+    post = exec_get_one(_POST_STATEMENTS[get_unread_mode()], {'community': community, 'channel': channel,
+                                                              'message': message, 'poster_id': poster_id,
+                                                              'time_sent': time_sent, 'mentioned': mentioned_users})
+    if post is not None:
+        history.posted((community, channel), history.PostRecord(post[0], post[1], message, poster_id, post[2]))
     return "Message sent to channel"
 
 
+@transactional
 def create_direct_message(message_id: int, sender_id: str,
                           receiver_id: str, time_sent: None, message: str) -> str:
     """
@@ -335,25 +471,20 @@ def create_direct_message(message_id: int, sender_id: str,
     if not user_exists(receiver_email):
         return "User" + receiver_email + "doesn't exist"
     init_time = datetime.now()
-    init_time = str(init_time)
     if time_sent:
         init_time = datetime.strptime(time_sent, '%Y-%m-%d %H:%M:%S')
 
-    suspension_dates = exec_get_all('SELECT suspended_since, suspended_till FROM users WHERE email = %s',
-                                    (sender_email,))
-    suspended_since = suspension_dates[0][0]
-    suspended_till = suspension_dates[0][1]
-    if suspended_since and suspended_till:
-        if suspended_since < init_time < suspended_till:
-            return sender_email + " is currently suspended until " + suspended_till.strftime("%Y/%m/%d %H:%M:%S")
+    suspended_till = suspensions.suspended_until(sender_id, suspensions.GLOBAL, init_time)
+    if suspended_till:
+        return _email_key(sender_email) + " is currently suspended until " + \
+            suspended_till.strftime("%Y/%m/%d %H:%M:%S")
 
     # If no time was given it will default to the current time
-    exec_commit(f'INSERT INTO direct_messages(message_id, sender_id, receiver_id, time_sent, message)'
-                f' VALUES (%s,%s,%s,%s,%s)',
-                (message_id, sender_id, receiver_id, init_time, message))
+    exec_commit(_INSERT_DIRECT_MESSAGE, (message_id, sender_id, receiver_id, init_time, message))
     return "Message sent successfully"
 
 
+@transactional
 def read_message(message_id, receiver_id):
     """
     marks message as read
@@ -361,13 +492,12 @@ def read_message(message_id, receiver_id):
     :param receiver_id:
     :return: text content
     """
-    texts = exec_get_all('SELECT message FROM direct_messages WHERE message_id = %s AND receiver_id = %s',
-                         (message_id, receiver_id))
+    texts = exec_get_all(_READ_MESSAGE, {'message_id': message_id, 'receiver_id': receiver_id})
     if len(texts) == 1:
-        exec_commit('UPDATE direct_messages SET is_read = TRUE WHERE message_id = %s', (message_id,))
         return texts[0][0]
 
 
+@transactional
 def get_unread_messages(receiver_id):
     """
     can be used to view unread texts as well as count number of unread texts
@@ -376,10 +506,47 @@ def get_unread_messages(receiver_id):
     """
     if not user_exists(get_email_by_id(receiver_id)):
         return []
-    unreads = exec_get_all('SELECT * FROM direct_messages WHERE is_read = FALSE AND receiver_id = %s', (receiver_id,))
+    unreads = exec_get_all(_UNREAD_MESSAGE_ROWS, (receiver_id,))
     return unreads
 
 
+def _user_id_exists(user_id):
+    if _emails_by_id.get(user_id) is not None:
+        return True
+    return len(exec_get_all(_EMAIL_BY_ID, (user_id,))) == 1
+
+
+@transactional
+def mark_conversation_read(receiver_id, sender_id, up_to=None):
+    """
+    moves the receiver's read watermark for messages from sender forward, marking every message up to it as read
+    without touching the messages themselves. Messages that arrive afterwards stay unread whatever their ids
+    :param receiver_id:
+    :param sender_id:
+    :param up_to: id of the last message read, defaults to the newest message from sender. The watermark moves to
+    the last arrival among the messages with ids up to it
+    :return:
+    """
+    if not _user_id_exists(receiver_id) or not _user_id_exists(sender_id):
+        return "User doesn't exist"
+    exec_commit(_MARK_CONVERSATION_READ, {'receiver_id': receiver_id, 'sender_id': sender_id, 'up_to': up_to})
+    return "Messages from " + sender_id + " marked as read"
+
+
+@transactional
+def mark_all_read(receiver_id):
+    """
+    marks every message the receiver has been sent as read, with one watermark write per conversation
+    :param receiver_id:
+    :return:
+    """
+    if not _user_id_exists(receiver_id):
+        return "User doesn't exist"
+    exec_commit(_MARK_ALL_READ, {'receiver_id': receiver_id})
+    return "All messages marked as read"
+
+
+@transactional
 def get_messages_from(receiver_id, sender_id):
     """
     this will return messages between two given people
@@ -393,30 +560,792 @@ def get_messages_from(receiver_id, sender_id):
         return "User" + sender_email + "doesn't exist"
     if not user_exists(receiver_email):
         return "User" + receiver_email + "doesn't exist"
-    return exec_get_all('SELECT message FROM direct_messages WHERE sender_id = %s AND receiver_id = %s',
-                        (sender_id, receiver_id))
+    return exec_get_all(_CONVERSATION, (sender_id, receiver_id))
+
 
+_UNREAD_SINCE_WATERMARK_FROM = """
+    FROM memberships
+    JOIN channels ON channels.community_name = memberships.community_name
+    JOIN channel_posts ON channel_posts.channel_id = channels.id
+    LEFT JOIN channel_reads ON channel_reads.user_id = memberships.user_id AND channel_reads.channel_id = channels.id
+    WHERE memberships.user_id = %(user_id)s AND channel_posts.user_id <> %(user_id)s
+    AND channel_posts.id > COALESCE(channel_reads.last_read_post_id, 0)
+"""
+UNREAD_SINCE_WATERMARK = 'SELECT channel_posts.id::VARCHAR ' + _UNREAD_SINCE_WATERMARK_FROM + \
+                         ' ORDER BY channel_posts.id'
+_UNREAD_SINCE_WATERMARK_STATEMENT = prepare('unread_since_watermark', UNREAD_SINCE_WATERMARK)
 
+
+@transactional
 def get_unread_posts(user_id):
     """
     This function will return the list of all unread posts
     """
     if not user_exists(get_email_by_id(user_id)):
         return [], 0
-    unread_list = exec_get_all('SELECT post_id FROM unread_posts WHERE user_id = %s', (user_id,))
+    if get_unread_mode() == 'fanout':
+        unread_list = exec_get_all(_UNREAD_POST_IDS, (user_id,))
+    else:
+        unread_list = exec_get_all(_UNREAD_SINCE_WATERMARK_STATEMENT, {'user_id': user_id})
     return [message_id[0] for message_id in unread_list], len(unread_list)
 
 
+_ADVANCE_CHANNEL_READ = prepare('advance_channel_read', """
+    WITH channel AS (
+        SELECT id FROM channels WHERE name = %(channel)s AND community_name = %(community)s
+    ), previous AS (
+        SELECT last_read_post_id FROM channel_reads, channel
+        WHERE channel_reads.user_id = %(user_id)s AND channel_reads.channel_id = channel.id FOR UPDATE OF channel_reads
+    ), advanced AS (
+        INSERT INTO channel_reads (user_id, channel_id, last_read_post_id)
+        SELECT %(user_id)s::VARCHAR, channel.id,
+            COALESCE(%(up_to)s::INT, (SELECT MAX(id) FROM channel_posts WHERE channel_id = channel.id), 0)
+        FROM channel
+        ON CONFLICT (user_id, channel_id) DO UPDATE
+        SET last_read_post_id = GREATEST(channel_reads.last_read_post_id, EXCLUDED.last_read_post_id)
+        RETURNING channel_id, last_read_post_id
+    )
+    SELECT channel_id, COALESCE((SELECT last_read_post_id FROM previous), 0), last_read_post_id FROM advanced
+""")
+# takes the posts that became read off the user's unread counters for the channel and overall
+_COUNT_POSTS_READ = """, read_count AS (
+        SELECT COUNT(*) AS posts FROM read
+    ), channel_counted AS (
+        UPDATE channel_unread_counts SET unread_posts = GREATEST(unread_posts - read_count.posts, 0) FROM read_count
+        WHERE user_id = %(user_id)s AND channel_id = %(channel_id)s AND read_count.posts > 0
+    )
+    UPDATE unread_counts SET unread_posts = GREATEST(unread_posts - read_count.posts, 0) FROM read_count
+    WHERE user_id = %(user_id)s AND read_count.posts > 0
+"""
+# the posts read by moving the watermark from previous to up_to: unread_posts rows in fanout mode, taken off the
+# counters; other members' posts in between in watermark mode, added to the user's read posts in the channel
+_READ_POSTS = {
+    'fanout': prepare('delete_read_posts', """
+        WITH read AS (
+            DELETE FROM unread_posts USING channel_posts
+            WHERE unread_posts.user_id = %(user_id)s AND channel_posts.id = unread_posts.post_id::INT
+            AND channel_posts.channel_id = %(channel_id)s AND channel_posts.id <= %(up_to)s
+            RETURNING channel_posts.id
+        )""" + _COUNT_POSTS_READ),
+    'watermark': prepare('count_read_posts', """
+        WITH read_count AS (
+            SELECT COUNT(*) AS posts FROM channel_posts
+            WHERE channel_id = %(channel_id)s AND id > %(previous)s AND id <= %(up_to)s AND user_id <> %(user_id)s
+        )
+        UPDATE channel_reads SET posts_read = posts_read + read_count.posts FROM read_count
+        WHERE user_id = %(user_id)s AND channel_id = %(channel_id)s AND read_count.posts > 0
+    """),
+}
+
+
+@transactional
+def mark_channel_read(user_id, channel, community, up_to=None):
+    """
+    moves the user's read watermark for a channel forward, marking every post up to it as read
+    :param user_id:
+    :param channel:
+    :param community:
+    :param up_to: id of the last post read, defaults to the newest post in the channel
+    :return:
+    """
+    if not channel_exists(channel, community):
+        return "The channel doesn't exist"
+    if not exec_get_one(_MEMBERSHIP, (user_id, community)):
+        return "User is not a part of the community"
+    args = {'user_id': user_id, 'channel': channel, 'community': community, 'up_to': up_to}
+    channel_id, previous, watermark = exec_get_one(_ADVANCE_CHANNEL_READ, args)
+    exec_commit(_READ_POSTS[get_unread_mode()],
+                {'user_id': user_id, 'channel_id': channel_id, 'previous': previous, 'up_to': watermark})
+    return channel + " marked as read"
+
+
+@transactional
+def migrate_unread_posts_to_watermarks():
+    """
+    builds channel_reads from the unread_posts rows written in 'fanout' mode, then empties unread_posts
+    and switches this process to 'watermark' mode.
+    Unread posts in a channel are always its newest ones, so the watermark is the post just before the oldest unread
+    :return: number of watermarks written
+    """
+    watermarks = exec_get_all(
+        'INSERT INTO channel_reads (user_id, channel_id, last_read_post_id) '
+        'SELECT memberships.user_id, channels.id, COALESCE( '
+        '    (SELECT MIN(channel_posts.id) - 1 FROM unread_posts '
+        '     JOIN channel_posts ON channel_posts.id = unread_posts.post_id::INT '
+        '     WHERE unread_posts.user_id = memberships.user_id AND channel_posts.channel_id = channels.id), '
+        '    (SELECT MAX(id) FROM channel_posts WHERE channel_id = channels.id), 0) '
+        'FROM memberships JOIN channels ON channels.community_name = memberships.community_name '
+        'ON CONFLICT (user_id, channel_id) DO UPDATE SET last_read_post_id = EXCLUDED.last_read_post_id '
+        'RETURNING user_id')
+    exec_commit('TRUNCATE unread_posts')
+    set_unread_mode('watermark')
+    reconcile_unread_counts()
+    return len(watermarks)
+
+
+@transactional
 def get_mentions(user_id):
     """
     This will get a list of all unread post and return the list and the number of them
     """
     if not user_exists(get_email_by_id(user_id)):
         return [], 0
-    mention_list = exec_get_all('SELECT * FROM mentions WHERE user_id = %s', (user_id,))
+    mention_list = exec_get_all(_USER_MENTIONS, (user_id,))
     return [message_id[0] for message_id in mention_list], len(mention_list)
 
 
+# Badge counts. unread_counts and channel_unread_counts are moved by the writes above in the statements that change
+# what is unread, so reading them never scans messages or posts. reconcile_unread_counts() rebuilds them from the
+# source tables if they drift, e.g. after rows were written around these functions
+
+UnreadCounts = namedtuple('UnreadCounts', ['messages', 'posts', 'mentions'])
+
+# a member's unread posts in a channel in watermark mode: the channel's posts less those they have read
+_WATERMARK_UNREAD_POSTS = 'GREATEST(COALESCE(channel_post_counts.posts, 0) - COALESCE(channel_reads.posts_read, 0), 0)'
+_MEMBER_CHANNEL_COUNTS = """
+    FROM memberships JOIN channels ON channels.community_name = memberships.community_name
+    LEFT JOIN channel_post_counts ON channel_post_counts.channel_id = channels.id
+    LEFT JOIN channel_reads ON channel_reads.user_id = memberships.user_id AND channel_reads.channel_id = channels.id
+"""
+_UNREAD_COUNTS = {
+    'fanout': prepare('unread_counts',
+                      'SELECT unread_messages, unread_posts, mentions FROM unread_counts WHERE user_id = %(user_id)s'),
+    'watermark': prepare('unread_counts_watermark', """
+        SELECT COALESCE(unread_counts.unread_messages, 0), posts.unread, COALESCE(unread_counts.mentions, 0)
+        FROM (SELECT COALESCE(SUM(""" + _WATERMARK_UNREAD_POSTS + """), 0) AS unread""" + _MEMBER_CHANNEL_COUNTS + """
+              WHERE memberships.user_id = %(user_id)s) AS posts
+        LEFT JOIN unread_counts ON unread_counts.user_id = %(user_id)s
+    """),
+}
+_CHANNEL_UNREAD_COUNTS = {
+    'fanout': prepare(
+        'channel_unread_counts',
+        'SELECT channels.community_name, channels.name, channel_unread_counts.unread_posts, '
+        'channel_unread_counts.mentions '
+        'FROM channel_unread_counts JOIN channels ON channels.id = channel_unread_counts.channel_id '
+        'WHERE channel_unread_counts.user_id = %(user_id)s AND (unread_posts > 0 OR mentions > 0) '
+        'ORDER BY channels.community_name, channels.name'),
+    'watermark': prepare('channel_unread_counts_watermark', """
+        SELECT channels.community_name, channels.name, counts.unread_posts, counts.mentions FROM (
+            SELECT channels.id, """ + _WATERMARK_UNREAD_POSTS + """ AS unread_posts,
+                COALESCE(channel_unread_counts.mentions, 0) AS mentions""" + _MEMBER_CHANNEL_COUNTS + """
+            LEFT JOIN channel_unread_counts ON channel_unread_counts.user_id = memberships.user_id
+                AND channel_unread_counts.channel_id = channels.id
+            WHERE memberships.user_id = %(user_id)s
+        ) AS counts JOIN channels ON channels.id = counts.id
+        WHERE counts.unread_posts > 0 OR counts.mentions > 0
+        ORDER BY channels.community_name, channels.name
+    """),
+}
+# unread posts per (user, channel) as get_unread_posts sees them in fanout mode. Watermark mode works them out from
+# channel_post_counts and channel_reads instead, which reconcile_unread_counts() rebuilds on their own
+_FRESH_UNREAD_POSTS = 'SELECT unread_posts.user_id, channel_posts.channel_id, COUNT(*), 0 ' \
+                      'FROM unread_posts JOIN channel_posts ON channel_posts.id = unread_posts.post_id::INT ' \
+                      'GROUP BY unread_posts.user_id, channel_posts.channel_id'
+_FRESH_MENTIONS = 'SELECT mentions.user_id, channel_posts.channel_id, 0, COUNT(*) ' \
+                  'FROM mentions JOIN channel_posts ON channel_posts.id = mentions.post_id::INT ' \
+                  'GROUP BY mentions.user_id, channel_posts.channel_id'
+_FRESH_CHANNEL_COUNTS = {'fanout': _FRESH_UNREAD_POSTS + ' UNION ALL ' + _FRESH_MENTIONS, 'watermark': _FRESH_MENTIONS}
+_RECONCILE_CHANNEL_COUNTS = 'INSERT INTO channel_unread_counts (user_id, channel_id, unread_posts, mentions) ' \
+                            'SELECT user_id, channel_id, SUM(unread_posts), SUM(mentions) FROM ({counts}) ' \
+                            'AS counts (user_id, channel_id, unread_posts, mentions) GROUP BY user_id, channel_id'
+# the (user, channel) pairs with unread posts in watermark mode, as the counters have them
+_WATERMARK_UNREAD = 'SELECT memberships.user_id, channels.id, ' + _WATERMARK_UNREAD_POSTS + _MEMBER_CHANNEL_COUNTS + \
+                    'WHERE ' + _WATERMARK_UNREAD_POSTS + ' > 0'
+_RECONCILE_POST_COUNTS = 'INSERT INTO channel_post_counts (channel_id, posts) ' \
+                         'SELECT channel_id, COUNT(*) FROM channel_posts GROUP BY channel_id'
+# a member has read the posts up to their watermark and their own
+_RECONCILE_POSTS_READ = """
+    INSERT INTO channel_reads (user_id, channel_id, posts_read)
+    SELECT memberships.user_id, channels.id, COUNT(channel_posts.id) FILTER (
+            WHERE channel_posts.id <= COALESCE(channel_reads.last_read_post_id, 0)
+            OR channel_posts.user_id = memberships.user_id)
+    FROM memberships JOIN channels ON channels.community_name = memberships.community_name
+    LEFT JOIN channel_reads ON channel_reads.user_id = memberships.user_id AND channel_reads.channel_id = channels.id
+    LEFT JOIN channel_posts ON channel_posts.channel_id = channels.id
+    GROUP BY memberships.user_id, channels.id, channel_reads.user_id
+    HAVING channel_reads.user_id IS NOT NULL OR COUNT(channel_posts.id) FILTER (
+        WHERE channel_posts.user_id = memberships.user_id) > 0
+    ON CONFLICT (user_id, channel_id) DO UPDATE SET posts_read = EXCLUDED.posts_read
+    WHERE channel_reads.posts_read <> EXCLUDED.posts_read
+"""
+# writes only the rows that were wrong, and returns them
+_RECONCILE_USER_COUNTS = """
+    WITH fresh AS (
+        SELECT users.user_id, COALESCE(messages.unread, 0) AS unread_messages,
+            COALESCE(posts.unread, 0) AS unread_posts, COALESCE(posts.mentions, 0) AS mentions
+        FROM users
+        LEFT JOIN (SELECT receiver_id, COUNT(*) AS unread FROM direct_messages WHERE """ + _DM_UNREAD + """
+                   GROUP BY receiver_id) AS messages ON messages.receiver_id = users.user_id
+        LEFT JOIN (SELECT user_id, SUM(unread_posts) AS unread, SUM(mentions) AS mentions FROM channel_unread_counts
+                   GROUP BY user_id) AS posts ON posts.user_id = users.user_id
+    ), removed AS (
+        DELETE FROM unread_counts WHERE NOT EXISTS (SELECT 1 FROM users WHERE users.user_id = unread_counts.user_id)
+        RETURNING user_id
+    ), corrected AS (
+        INSERT INTO unread_counts (user_id, unread_messages, unread_posts, mentions)
+        SELECT user_id, unread_messages, unread_posts, mentions FROM fresh
+        WHERE unread_messages + unread_posts + mentions > 0
+        OR EXISTS (SELECT 1 FROM unread_counts WHERE unread_counts.user_id = fresh.user_id)
+        ON CONFLICT (user_id) DO UPDATE
+        SET unread_messages = EXCLUDED.unread_messages, unread_posts = EXCLUDED.unread_posts,
+            mentions = EXCLUDED.mentions
+        WHERE (unread_counts.unread_messages, unread_counts.unread_posts, unread_counts.mentions)
+            IS DISTINCT FROM (EXCLUDED.unread_messages, EXCLUDED.unread_posts, EXCLUDED.mentions)
+        RETURNING user_id
+    )
+    SELECT user_id FROM removed UNION SELECT user_id FROM corrected
+"""
+# the newest message and unread messages of each pair, applied over summaries zeroed first. Summaries of pairs whose
+# messages have all been archived keep their last message
+_RECONCILE_CONVERSATIONS = """
+    INSERT INTO conversations (user_a, user_b, last_message_id, last_time_sent, unread_a, unread_b)
+    SELECT latest.user_a, latest.user_b, latest.message_id, latest.time_sent,
+        COALESCE(unread.unread_a, 0), COALESCE(unread.unread_b, 0)
+    FROM (SELECT DISTINCT ON (1, 2) LEAST(sender_id, receiver_id) AS user_a, GREATEST(sender_id, receiver_id) AS user_b,
+              message_id, time_sent
+          FROM direct_messages ORDER BY 1, 2, time_sent DESC, message_id DESC) AS latest
+    LEFT JOIN (SELECT LEAST(sender_id, receiver_id) AS user_a, GREATEST(sender_id, receiver_id) AS user_b,
+                   COUNT(*) FILTER (WHERE receiver_id <= sender_id) AS unread_a,
+                   COUNT(*) FILTER (WHERE receiver_id > sender_id) AS unread_b
+               FROM direct_messages WHERE """ + _DM_UNREAD + """ GROUP BY 1, 2) AS unread
+        ON unread.user_a = latest.user_a AND unread.user_b = latest.user_b
+    ON CONFLICT (user_a, user_b) DO UPDATE
+    SET last_message_id = EXCLUDED.last_message_id, last_time_sent = EXCLUDED.last_time_sent,
+        unread_a = EXCLUDED.unread_a, unread_b = EXCLUDED.unread_b
+"""
+
+
+@transactional
+def get_unread_counts(user_id):
+    """
+    the numbers behind a user's badges, read from one counter row
+    :param user_id:
+    :return: UnreadCounts(messages, posts, mentions): unread direct messages, unread channel posts, and mentions
+    """
+    counts = exec_get_one(_UNREAD_COUNTS[get_unread_mode()], {'user_id': user_id})
+    return UnreadCounts(*counts) if counts else UnreadCounts(0, 0, 0)
+
+
+@transactional
+def get_channel_unread_counts(user_id):
+    """
+    :param user_id:
+    :return: list of (community, channel, unread posts, mentions) for the channels with anything to show
+    """
+    return exec_get_all(_CHANNEL_UNREAD_COUNTS[get_unread_mode()], {'user_id': user_id})
+
+
+@transactional
+def reconcile_unread_counts():
+    """
+    rebuilds the unread counters and conversation summaries from direct_messages, the read watermarks, the unread
+    posts and mentions. In watermark mode the channel post counters and each member's read posts are rebuilt too.
+    The counter tables are locked against writes while they are rebuilt, so no update made meanwhile is lost
+    :return: sorted list of the users whose counts were wrong
+    """
+    mode = get_unread_mode()
+    drifted = set()
+    with transaction() as cur:
+        cur.execute('LOCK TABLE unread_counts, channel_unread_counts, conversations IN EXCLUSIVE MODE')
+        if mode == 'watermark':
+            cur.execute('LOCK TABLE channel_post_counts, channel_reads IN EXCLUSIVE MODE')
+            cur.execute(_WATERMARK_UNREAD)
+            before = set(cur.fetchall())
+            cur.execute('DELETE FROM channel_post_counts')
+            cur.execute(_RECONCILE_POST_COUNTS)
+            cur.execute(_RECONCILE_POSTS_READ)
+            cur.execute(_WATERMARK_UNREAD)
+            drifted.update(row[0] for row in before.symmetric_difference(cur.fetchall()))
+        cur.execute('DELETE FROM channel_unread_counts')
+        cur.execute(_RECONCILE_CHANNEL_COUNTS.format(counts=_FRESH_CHANNEL_COUNTS[mode]))
+        cur.execute('UPDATE conversations SET unread_a = 0, unread_b = 0 WHERE unread_a <> 0 OR unread_b <> 0')
+        cur.execute(_RECONCILE_CONVERSATIONS)
+        cur.execute(_RECONCILE_USER_COUNTS)
+        drifted.update(row[0] for row in cur.fetchall())
+        return sorted(drifted)
+
+
+# Bulk operations. Each validates its whole batch with set-based queries, writes it with multi-row statements in
+# one transaction and returns one result per item, using the same messages as the single-item functions wherever
+# those return one
+
+
+def _existing(cur, sql, values):
+    cur.execute(sql, (list(values),))
+    return {row[0] for row in cur.fetchall()}
+
+
+@transactional
+def create_users(users):
+    """
+    creates many users at once
+    :param users: list of (user_id, name, phone_number, email) or (user_id, name, phone_number, email, userid_set)
+    :return: list with the create_user result for each user
+    """
+    users = [tuple(user) + (None,) * (5 - len(user)) for user in users]
+    with transaction() as cur:
+        taken_emails = _existing(cur, 'SELECT email FROM users WHERE email = ANY(%s)', {user[3] for user in users})
+        taken_ids = _existing(cur, 'SELECT user_id FROM users WHERE user_id = ANY(%s)', {user[0] for user in users})
+        results = []
+        rows = []
+        now = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+        for user_id, name, phone_number, email, userid_set in users:
+            if email in taken_emails or user_id in taken_ids:
+                results.append("User already exists")
+            elif len(user_id) < 6 or len(user_id) > 30:
+                results.append("Username needs to be between 8 to 30 characters")
+            else:
+                taken_emails.add(email)
+                taken_ids.add(user_id)
+                rows.append((user_id, name, str(phone_number), email, userid_set or now))
+                results.append("User added successfully")
+        execute_values(cur, 'INSERT INTO users (user_id, name, phone_number, email, userid_set) VALUES %s', rows,
+                       page_size=1000)
+    for user_id, name, phone_number, email, userid_set in rows:
+        _users_by_email.invalidate(email)
+        _emails_by_id.invalidate(user_id)
+    return results
+
+
+@transactional
+def add_users_to_community(user_ids, community):
+    """
+    adds many users to one community at once
+    :param user_ids: list of user ids
+    :param community: community name
+    :return: list with the add_user_to_community result for each user
+    """
+    if not community_exists(community):
+        return ["The community doesn't exist"] * len(user_ids)
+    with transaction() as cur:
+        known = _existing(cur, 'SELECT user_id FROM users WHERE user_id = ANY(%s)', set(user_ids))
+        cur.execute('SELECT user_id FROM memberships WHERE community_name = %s AND user_id = ANY(%s)',
+                    (community, list(set(user_ids))))
+        members = {row[0] for row in cur.fetchall()}
+        results = []
+        joining = []
+        for user_id in user_ids:
+            if user_id not in known:
+                results.append("The user doesn't exist")
+            elif user_id in members:
+                results.append(user_id + " is already a member of " + community)
+            else:
+                members.add(user_id)
+                joining.append(user_id)
+                results.append(user_id + " is now a member of " + community)
+        if joining:
+            cur.execute('INSERT INTO memberships (user_id, community_name) SELECT unnest(%s::VARCHAR[]), %s',
+                        (joining, community))
+            # posts from before the users joined are never unread for them
+            cur.execute('INSERT INTO channel_reads (user_id, channel_id, last_read_post_id, posts_read) '
+                        'SELECT joining.user_id, latest.id, latest.last_post_id, latest.posts '
+                        'FROM unnest(%s::VARCHAR[]) AS joining(user_id), '
+                        '(SELECT channels.id, COALESCE(MAX(channel_posts.id), 0) AS last_post_id, '
+                        ' COUNT(channel_posts.id) AS posts FROM channels '
+                        ' LEFT JOIN channel_posts ON channel_posts.channel_id = channels.id '
+                        ' WHERE channels.community_name = %s GROUP BY channels.id) AS latest '
+                        'ON CONFLICT (user_id, channel_id) DO NOTHING', (joining, community))
+            _rosters.invalidate(community)
+    return results
+
+
+@transactional
+def add_channels(channels, community_name):
+    """
+    adds many channels to one community at once
+    :param channels: list of channel names
+    :param community_name: community name
+    :return: list with the add_channel result for each channel
+    """
+    if not community_exists(community_name):
+        return ["The community doesn't exist"] * len(channels)
+    with transaction() as cur:
+        cur.execute('SELECT name FROM channels WHERE community_name = %s AND name = ANY(%s)',
+                    (community_name, list(set(channels))))
+        taken = {row[0] for row in cur.fetchall()}
+        results = []
+        adding = []
+        for channel in channels:
+            if channel in taken:
+                results.append(channel + " exists")
+            else:
+                taken.add(channel)
+                adding.append(channel)
+                results.append(channel + " was added to " + community_name)
+        cur.execute('INSERT INTO channels (name, community_name) SELECT unnest(%s::VARCHAR[]), %s',
+                    (adding, community_name))
+    for channel in adding:
+        _channels.invalidate((channel, community_name))
+    return results
+
+
+@transactional
+def create_direct_messages(messages):
+    """
+    sends many direct messages at once
+    :param messages: list of (message_id, sender_id, receiver_id, time_sent, message). A message_id of None
+                     takes the next id from the sequence, past every id given explicitly in the batch, and a
+                     time_sent of None means now
+    :return: list with the create_direct_message result for each message, except that a sender or receiver who
+             doesn't exist is reported as "User <user_id> doesn't exist" and a message_id that is already taken,
+             by a stored message or an earlier one in the batch, as "Message <message_id> already exists", where
+             create_direct_message raises
+    """
+    now = datetime.now()
+    with transaction() as cur:
+        user_ids = {message[1] for message in messages} | {message[2] for message in messages}
+        cur.execute('SELECT user_id, email FROM users WHERE user_id = ANY(%s)', (list(user_ids),))
+        users = {row[0]: row[1] for row in cur.fetchall()}
+        # checked here, as a partitioned direct_messages has no primary key on message_id alone to reject them
+        taken_ids = _existing(cur, 'SELECT message_id FROM direct_messages WHERE message_id = ANY(%s)',
+                              {message[0] for message in messages if message[0] is not None})
+        index = suspensions.get_index()
+        results = []
+        rows = []
+        for message_id, sender_id, receiver_id, time_sent, message in messages:
+            sent = datetime.strptime(time_sent, '%Y-%m-%d %H:%M:%S') if time_sent else now
+            missing = [user_id for user_id in (sender_id, receiver_id) if user_id not in users]
+            if missing:
+                results.append("User " + missing[0] + " doesn't exist")
+                continue
+            suspended_till = index.suspended_until(sender_id, suspensions.GLOBAL, sent)
+            if suspended_till:
+                results.append(users[sender_id] + " is currently suspended until " +
+                               suspended_till.strftime("%Y/%m/%d %H:%M:%S"))
+                continue
+            if message_id is not None:
+                if message_id in taken_ids:
+                    results.append("Message " + str(message_id) + " already exists")
+                    continue
+                taken_ids.add(message_id)
+            rows.append((message_id, sender_id, receiver_id, sent, message))
+            results.append("Message sent successfully")
+        if any(row[0] is None for row in rows):
+            sync_message_id_sequence(cur, [row[0] for row in rows if row[0] is not None])
+        execute_values(cur, 'INSERT INTO direct_messages (message_id, sender_id, receiver_id, time_sent, message) '
+                            'VALUES %s', rows,
+                       template="(COALESCE(%s::INT, nextval(pg_get_serial_sequence('direct_messages', "
+                                "'message_id'))), %s, %s, %s, %s)",
+                       page_size=1000)
+        count_received(cur, [row[1:3] for row in rows])
+    return results
+
+
+# Paginated and streaming history. Pages are ordered oldest first by (time_sent, id) and a page's cursor is the
+# (time_sent, id) of its last row, so fetching the next page is an index range scan however deep it is
+
+DM_COLUMNS = 'direct_messages.message_id, direct_messages.sender_id, direct_messages.receiver_id, ' \
+             'direct_messages.time_sent, direct_messages.message, NOT (' + _DM_UNREAD + ') AS is_read'
+POST_COLUMNS = 'channel_posts.id, channel_posts.channel_id, channel_posts.text, channel_posts.user_id, ' \
+               'channel_posts.time_sent'
+_MESSAGES_FROM = 'SELECT ' + DM_COLUMNS + ' FROM direct_messages ' \
+                 'WHERE sender_id = %(sender_id)s AND receiver_id = %(receiver_id)s'
+_UNREAD_MESSAGES = 'SELECT ' + DM_COLUMNS + ' FROM direct_messages ' \
+                   'WHERE receiver_id = %(receiver_id)s AND ' + _DM_UNREAD
+_UNREAD_POSTS_FANOUT = 'SELECT ' + POST_COLUMNS + ' FROM unread_posts ' \
+                       'JOIN channel_posts ON channel_posts.id = unread_posts.post_id::INT ' \
+                       'WHERE unread_posts.user_id = %(user_id)s'
+_UNREAD_POSTS_WATERMARK = 'SELECT ' + POST_COLUMNS + _UNREAD_SINCE_WATERMARK_FROM
+_MENTIONS = 'SELECT ' + POST_COLUMNS + ' FROM mentions ' \
+            'JOIN channel_posts ON channel_posts.id = mentions.post_id::INT ' \
+            'WHERE mentions.user_id = %(user_id)s'
+_DM_ORDER = ('direct_messages.time_sent', 'direct_messages.message_id')
+_POST_ORDER = ('channel_posts.time_sent', 'channel_posts.id')
+
+
+def _dm_cursor(row):
+    return row[3], row[0]
+
+
+def _post_cursor(row):
+    return row[4], row[0]
+
+
+def _check_limit(limit):
+    if limit < 1:
+        raise ValueError('limit must be at least 1')
+
+
+def _page(sql, args, order, cursor_of, limit, cursor):
+    """
+    :param sql: query ending in a WHERE clause
+    :param order: (time column, id column) to order and page by
+    :param cursor_of: function returning the cursor of a row
+    :return: (rows, cursor of the next page or None on the last page)
+    """
+    _check_limit(limit)
+    after_time, after_id = cursor if cursor else (None, None)
+    page_sql = (sql + ' AND (%(after_id)s IS NULL OR ({0}, {1}) > (%(after_time)s, %(after_id)s))'
+                ' ORDER BY {0}, {1} LIMIT %(limit)s').format(*order)
+    rows = exec_get_all(page_sql, dict(args, after_time=after_time, after_id=after_id, limit=limit + 1))
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, cursor_of(rows[-1])
+
+
+def _stream(sql, args, order, batch_size):
+    return exec_stream(sql + ' ORDER BY {0}, {1}'.format(*order), args, batch_size)
+
+
+def _unread_posts_sql():
+    return _UNREAD_POSTS_FANOUT if get_unread_mode() == 'fanout' else _UNREAD_POSTS_WATERMARK
+
+
+@transactional
+def get_messages_from_page(receiver_id, sender_id, limit=50, cursor=None):
+    """
+    one page of the messages sent by sender_id to receiver_id
+    :param limit: most rows to return
+    :param cursor: cursor returned with the previous page, None for the first page
+    :return: (direct_messages rows, cursor of the next page or None)
+    """
+    for user_id in (sender_id, receiver_id):
+        if not user_exists(get_email_by_id(user_id)):
+            return [], None
+    return _page(_MESSAGES_FROM, {'sender_id': sender_id, 'receiver_id': receiver_id}, _DM_ORDER, _dm_cursor,
+                 limit, cursor)
+
+
+@transactional
+def get_unread_messages_page(receiver_id, limit=50, cursor=None):
+    """
+    :return: (unread direct_messages rows, cursor of the next page or None)
+    """
+    if not user_exists(get_email_by_id(receiver_id)):
+        return [], None
+    return _page(_UNREAD_MESSAGES, {'receiver_id': receiver_id}, _DM_ORDER, _dm_cursor, limit, cursor)
+
+
+@transactional
+def get_unread_posts_page(user_id, limit=50, cursor=None):
+    """
+    :return: (unread channel_posts rows, cursor of the next page or None)
+    """
+    if not user_exists(get_email_by_id(user_id)):
+        return [], None
+    return _page(_unread_posts_sql(), {'user_id': user_id}, _POST_ORDER, _post_cursor, limit, cursor)
+
+
+@transactional
+def get_mentions_page(user_id, limit=50, cursor=None):
+    """
+    :return: (channel_posts rows mentioning the user, cursor of the next page or None)
+    """
+    if not user_exists(get_email_by_id(user_id)):
+        return [], None
+    return _page(_MENTIONS, {'user_id': user_id}, _POST_ORDER, _post_cursor, limit, cursor)
+
+
+def iter_messages_from(receiver_id, sender_id, batch_size=1000):
+    """
+    streams every message sent by sender_id to receiver_id from a server-side cursor
+    :return: generator of direct_messages rows, oldest first
+    """
+    return _stream(_MESSAGES_FROM, {'sender_id': sender_id, 'receiver_id': receiver_id}, _DM_ORDER, batch_size)
+
+
+def iter_unread_messages(receiver_id, batch_size=1000):
+    """
+    :return: generator of unread direct_messages rows, oldest first
+    """
+    return _stream(_UNREAD_MESSAGES, {'receiver_id': receiver_id}, _DM_ORDER, batch_size)
+
+
+def iter_unread_posts(user_id, batch_size=1000):
+    """
+    :return: generator of unread channel_posts rows, oldest first
+    """
+    return _stream(_unread_posts_sql(), {'user_id': user_id}, _POST_ORDER, batch_size)
+
+
+def iter_mentions(user_id, batch_size=1000):
+    """
+    :return: generator of channel_posts rows mentioning the user, oldest first
+    """
+    return _stream(_MENTIONS, {'user_id': user_id}, _POST_ORDER, batch_size)
+
+
+# Channel history, read back from the newest post. A page holds the posts before its cursor, oldest first, and its
+# cursor is the (time_sent, id) of its first row. The newest posts of each channel read are kept by src.history
+
+_CHANNEL_POSTS = 'SELECT ' + POST_COLUMNS + ' FROM channel_posts ' \
+                 'JOIN channels ON channels.id = channel_posts.channel_id ' \
+                 'WHERE channels.name = %(channel)s AND channels.community_name = %(community)s'
+_NEWEST_FIRST = ' ORDER BY channel_posts.time_sent DESC, channel_posts.id DESC LIMIT %(limit)s'
+_NEWEST_POSTS = prepare('newest_channel_posts', _CHANNEL_POSTS + _NEWEST_FIRST)
+_POSTS_BEFORE = prepare('channel_posts_before', _CHANNEL_POSTS + ' AND (channel_posts.time_sent, channel_posts.id) '
+                        '< (%(before_time)s::TIMESTAMP, %(before_id)s::INT)' + _NEWEST_FIRST)
+
+
+def _channel_posts(channel, community, limit, before):
+    """
+    :return: up to limit channel_posts rows before the cursor, newest first
+    """
+    args = {'channel': channel, 'community': community, 'limit': limit}
+    if before is None:
+        return exec_get_all(_NEWEST_POSTS, args)
+    return exec_get_all(_POSTS_BEFORE, dict(args, before_time=before[0], before_id=before[1]))
+
+
+def get_channel_history(channel, community, limit=50, before=None):
+    """
+    one page of a channel's posts, served from memory when they are among the channel's newest
+    :param limit: most rows to return
+    :param before: cursor returned with the previous page, None for the newest posts
+    :return: (channel_posts rows oldest first, cursor of the next older page or None)
+    """
+    _check_limit(limit)
+    if not channel_exists(channel, community):
+        return [], None
+    key = (community, channel)
+    cached = history.get_history()
+    # a transaction that has posted to the channel reads it from the database, where its posts are visible
+    if not history.is_pending(key):
+        page = cached.page(key, limit, before)
+        if page is None and before is None:
+            version = cached.version(key)
+            cached.load(key, _channel_posts(channel, community, cached.capacity + 1, None), version)
+            page = cached.page(key, limit, before, counted=False)
+        if page is not None:
+            return page
+    rows = _channel_posts(channel, community, limit + 1, before)
+    page = rows[:limit][::-1]
+    return page, _post_cursor(page[0]) if len(rows) > limit else None
+
+
+# The inbox: a user's conversations, the most recently active first, one row per conversation partner read from the
+# conversation summaries. A page's cursor is the (last_time_sent, last_message_id) of its last row. The user is
+# user_a of some summaries and user_b of the others, so a page merges a range scan of each side's index
+
+Conversation = namedtuple('Conversation', ['other_user', 'last_message_id', 'last_sender', 'last_time_sent',
+                                           'last_message', 'unread'])
+
+_INBOX_SIDE = """
+        (SELECT {other} AS other_user, last_message_id, last_time_sent, {unread} AS unread FROM conversations
+         WHERE {side} = %(user_id)s{exclude}
+         AND (%(after_id)s::INT IS NULL
+              OR (last_time_sent, last_message_id) < (%(after_time)s::TIMESTAMP, %(after_id)s::INT))
+         ORDER BY last_time_sent DESC, last_message_id DESC LIMIT %(limit)s)"""
+# the last message is joined on the partition key too, and is NULL once it has been archived
+_INBOX = prepare('inbox', """
+    SELECT inbox.other_user, inbox.last_message_id, direct_messages.sender_id, inbox.last_time_sent,
+           direct_messages.message, inbox.unread
+    FROM (""" + _INBOX_SIDE.format(other='user_b', unread='unread_a', side='user_a', exclude='') + """
+        UNION ALL""" + _INBOX_SIDE.format(other='user_a', unread='unread_b', side='user_b',
+                                          exclude=' AND user_a <> user_b') + """
+    ) AS inbox
+    LEFT JOIN direct_messages ON direct_messages.message_id = inbox.last_message_id
+        AND direct_messages.time_sent = inbox.last_time_sent
+    ORDER BY inbox.last_time_sent DESC, inbox.last_message_id DESC LIMIT %(limit)s
+""")
+
+
+@transactional
+def get_inbox(user_id, limit=50, cursor=None):
+    """
+    one page of the user's conversations, the most recently active first
+    :param limit: most conversations to return
+    :param cursor: cursor returned with the previous page, None for the first page
+    :return: (list of Conversation, cursor of the next page or None). unread is the number of messages from
+             other_user the user has not read
+    """
+    _check_limit(limit)
+    if not _user_id_exists(user_id):
+        return [], None
+    after_time, after_id = cursor if cursor else (None, None)
+    rows = exec_get_all(_INBOX, {'user_id': user_id, 'after_time': after_time, 'after_id': after_id,
+                                 'limit': limit + 1})
+    page = [Conversation(*row) for row in rows[:limit]]
+    if len(rows) <= limit:
+        return page, None
+    return page, (page[-1].last_time_sent, page[-1].last_message_id)
+
+
+# Full-text search over the GIN-indexed search_vector columns. Queries use web search syntax ("quoted phrases",
+# or, -excluded). Results are limited to what the user can see and ranked best first. A page's cursor is the
+# (rank, id) of its last row; ranks are rounded so the cursor compares exactly with the rows it came from
+
+_SEARCH_RANK = 'ROUND(ts_rank({0}.search_vector, search.query)::NUMERIC, 6) AS rank'
+_SEARCH_PAGE = """
+    ) AS matches
+    WHERE %(after_id)s::INT IS NULL OR (rank, {0}) < (%(after_rank)s, %(after_id)s)
+    ORDER BY rank DESC, {0} DESC LIMIT %(limit)s"""
+# posts in the channels of every community the user belongs to
+_SEARCH_POSTS = prepare('search_channel_posts', """
+    SELECT * FROM (
+        SELECT """ + POST_COLUMNS + ', ' + _SEARCH_RANK.format('channel_posts') + """
+        FROM channel_posts
+        JOIN channels ON channels.id = channel_posts.channel_id
+        JOIN memberships ON memberships.community_name = channels.community_name
+                        AND memberships.user_id = %(user_id)s,
+        websearch_to_tsquery('""" + SEARCH_CONFIG + """', %(query)s) AS search(query)
+        WHERE channel_posts.search_vector @@ search.query
+        AND (%(community)s::VARCHAR IS NULL OR channels.community_name = %(community)s)
+        AND (%(channel)s::VARCHAR IS NULL OR channels.name = %(channel)s)""" + _SEARCH_PAGE.format('id'))
+# messages the user sent or received
+_SEARCH_MESSAGES = prepare('search_direct_messages', """
+    SELECT * FROM (
+        SELECT """ + DM_COLUMNS + ', ' + _SEARCH_RANK.format('direct_messages') + """
+        FROM direct_messages,
+        websearch_to_tsquery('""" + SEARCH_CONFIG + """', %(query)s) AS search(query)
+        WHERE direct_messages.search_vector @@ search.query
+        AND (direct_messages.sender_id = %(user_id)s OR direct_messages.receiver_id = %(user_id)s)
+        AND (%(other_user)s::VARCHAR IS NULL OR direct_messages.sender_id = %(other_user)s
+             OR direct_messages.receiver_id = %(other_user)s)""" + _SEARCH_PAGE.format('message_id'))
+
+
+def _search_cursor(row):
+    return row[-1], row[0]
+
+
+def _search_page(statement, args, limit, cursor):
+    _check_limit(limit)
+    after_rank, after_id = cursor if cursor else (None, None)
+    rows = exec_get_all(statement, dict(args, after_rank=after_rank, after_id=after_id, limit=limit + 1))
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, _search_cursor(rows[-1])
+
+
+@transactional
+def search_channel_posts(user_id, query, community=None, channel=None, limit=20, cursor=None):
+    """
+    searches the posts in the user's communities
+    :param user_id: user searching
+    :param query: search terms, in web search syntax
+    :param community: only search this community
+    :param channel: only search channels with this name
+    :param limit: most rows to return
+    :param cursor: cursor returned with the previous page, None for the first page
+    :return: (channel_posts rows followed by their rank, best match first, cursor of the next page or None)
+    """
+    if not user_exists(get_email_by_id(user_id)):
+        return [], None
+    return _search_page(_SEARCH_POSTS, {'user_id': user_id, 'query': query, 'community': community,
+                                        'channel': channel}, limit, cursor)
+
+
+@transactional
+def search_direct_messages(user_id, query, other_user=None, limit=20, cursor=None):
+    """
+    searches the direct messages the user sent or received
+    :param user_id: user searching
+    :param query: search terms, in web search syntax
+    :param other_user: only search the conversation with this user
+    :param limit: most rows to return
+    :param cursor: cursor returned with the previous page, None for the first page
+    :return: (direct_messages rows followed by their rank, best match first, cursor of the next page or None)
+    """
+    if not user_exists(get_email_by_id(user_id)):
+        return [], None
+    return _search_page(_SEARCH_MESSAGES, {'user_id': user_id, 'query': query, 'other_user': other_user},
+                        limit, cursor)
+
+
+@transactional
 def suspend_user(user_id, community_name, end_suspension, start_suspension=None):
     """
     suspends a user from a commmunity
@@ -432,18 +1361,16 @@ def suspend_user(user_id, community_name, end_suspension, start_suspension=None)
         return "Community does not exist"
 
     if not start_suspension:
-        start_suspension = datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S")
-    suspension_list = exec_commit('SELECT user_id FROM suspensions WHERE user_id = %s AND community_name = %s',
-                                  (user_id, community_name))
-    if not suspension_list:
-        exec_commit('INSERT INTO suspensions (user_id, suspended_since, suspended_till, community_name) VALUES(%s, '
-                    '%s, %s, %s)', (user_id, start_suspension, end_suspension, community_name))
-    else:
-        exec_commit('UPDATE suspensions SET suspended_since = %s AND suspended_till = %s WHERE user_id = %s AND '
-                    'community_name = %s', (start_suspension, end_suspension, user_id, community_name))
+        start_suspension = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+    exec_commit('INSERT INTO suspensions (user_id, suspended_since, suspended_till, community_name) '
+                'VALUES (%s, %s, %s, %s) ON CONFLICT (user_id, community_name) DO UPDATE '
+                'SET suspended_since = EXCLUDED.suspended_since, suspended_till = EXCLUDED.suspended_till',
+                (user_id, start_suspension, end_suspension, community_name))
+    suspensions.invalidate()
     return user_id + " is suspended from " + start_suspension + " until " + end_suspension + " on " + community_name
 
 
+@transactional
 def resume_user(user_id, community_name):
     """
     discontinues suspension for a user
@@ -454,43 +1381,36 @@ def resume_user(user_id, community_name):
         return "User doesn't exist"
     if not community_exists(community_name):
         return "Community does not exist"
-    exec_commit(
-        'UPDATE suspensions SET suspended_since = NULL AND suspended_till = NULL'
-        ' WHERE user_id = %s AND community_name = %s',
-        (user_id, community_name))
+    exec_commit('UPDATE suspensions SET suspended_since = NULL, suspended_till = NULL '
+                'WHERE user_id = %s AND community_name = %s', (user_id, community_name))
+    suspensions.invalidate()
     return user_id + " is no longer suspended on " + community_name
 
 
-def is_suspended(email, channel_name, sending_time):
+def is_suspended(user_id, channel_name, sending_time, community_name=None):
     """
-    This will tell us if the user is suspended or not on the channel
+    This will tell us if the user is suspended or not on the channel, globally or in its community.
+    Answered from the in-memory suspension index
+    :param sending_time: datetime or 'YYYY-MM-DD HH:MM:SS'
+    :param community_name: community of the channel. Without it every community with a channel of that name
+                           is checked
     """
-    sending_time = datetime.strptime(sending_time, '%Y-%m-%d %H:%M:%S')
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute('SELECT community_name FROM channels WHERE name = %s', (channel_name,))
-    community_name = cur.fetchall()[0][0]
-    cur.execute('SELECT suspended_since, suspended_till FROM suspensions WHERE user_id = %s AND community_name = %s',
-                (email, community_name))
-    suspension_dates = cur.fetchall()
-    conn.close()
-    if not suspension_dates:
-        return False
-    suspended_since = suspension_dates[0][0]
-    suspended_till = suspension_dates[0][1]
-    if suspended_since and suspended_till:
-        if suspended_since < sending_time < suspended_till:
-            return True
-    return False
+    if community_name is not None:
+        return suspensions.is_suspended(user_id, community_name, sending_time)
+    communities = [row[0] for row in exec_get_all(_CHANNEL_COMMUNITIES, (channel_name,))]
+    return any(suspensions.is_suspended(user_id, community, sending_time) for community in communities) or \
+        suspensions.is_suspended(user_id, suspensions.GLOBAL, sending_time)
 
 
 def get_last_message_id():
     """
     this will get us the last sent direct message on the app
-    :return:
+    :return: message id, or None if there are no messages
     """
-    msg_id = exec_commit('SELECT message_id FROM direct_messages ORDER BY message_id DESC LIMIT 1')
-    return msg_id
+    msg_id = exec_get_one('SELECT message_id FROM direct_messages ORDER BY message_id DESC LIMIT 1')
+    if msg_id:
+        return msg_id[0]
+    return None
 
 
 def read_csv(filename):
@@ -503,25 +1423,11 @@ def read_csv(filename):
     Return:
     None
     """
-    with open(filename) as file:
-        reader = csv.reader(file, delimiter=",")
-        next(reader, None)
-        msg_id = get_last_message_id()
-        if not msg_id:
-            msg_id = 1
-        else:
-            msg_id += 1
-        for row in reader:
-            if row[0] == 'Abbott':
-                create_direct_message(msg_id, 'Abbott1234', 'Costello1234', None, row[1])
-            else:
-                create_direct_message(msg_id, 'Costello1234', 'Abbott1234', None, row[1])
-            msg_id += 1
+    import_conversation(filename, WHOS_ON_FIRST_SPEAKERS)
 
 
+@transactional
 def populate_tables_db1():
-    conn = connect()
-    cur = conn.cursor()
     # check why this is necessary in CI
     rebuild_tables()
     add_users = """
@@ -537,7 +1443,6 @@ def populate_tables_db1():
                         ('Curly1234', 'Curly', '1234567894', 'curly@rit.edu', 
                         '1989-01-01 00:00:00', NULL, '1990-01-01 00:00:00', '2000-01-01 00:00:00');
                 """
-    cur.execute(add_users)
     add_messages = """
                     INSERT INTO direct_messages(message_id, sender_id, receiver_id, time_sent, message, is_read) VALUES
                         (1, 'Abbott1234', 'Costello1234', '2000-02-12 11:00:00', 'C! How are you?', TRUE),
@@ -549,11 +1454,15 @@ def populate_tables_db1():
                         'Abbott! So long. How are you?', FALSE),
                         (7, 'Moe1234', 'Abbott1234', '2020-02-12 11:10:00', 'Abbott, this is Moe. Hi!', FALSE);  
                 """
-    cur.execute(add_messages)
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute(add_users)
+        cur.execute(add_messages)
+        clear_caches()
+    # the seed rows are written directly, so their counters are built afterwards
+    reconcile_unread_counts()
 
 
+@transactional
 def populate_tables_db2():
     rebuild_tables()
     create_user('DrMarvin', 'Marvin', 5855556656, 'drmarvin@rit.edu', '1991-05-16 00:00:00', None, None, None)
@@ -563,6 +1472,7 @@ def populate_tables_db2():
     change_username('BabySteps2Door', 'BabySteps2Elevator', '1991-05-20 00:00:00')
 
 
+@transactional
 def populate_tables_db3():
     rebuild_tables()
     populate_tables_db1()
@@ -571,8 +1481,7 @@ def populate_tables_db3():
     add_community('Metropolis', ['DailyPlanet', 'Random'])
     add_community('Comedy', ['ArgumentClinic', 'Dialogs'])
     user_list = exec_get_all('SELECT user_id FROM users')
-    for user in user_list:
-        add_user_to_community(user[0], 'Comedy')
+    add_users_to_community([user[0] for user in user_list], 'Comedy')
     create_user('clarknotsuperman', 'Clark', 5855556434, 'clark@rit.edu', '1991-05-16 00:00:00', None, None, None)
     create_user('lex12345', 'Lex', 5855556234, 'lex@rit.edu', '1991-05-16 00:00:00', None, None, None)
     add_user_to_community('clarknotsuperman', 'Metropolis')
@@ -0,0 +1,154 @@
+"""
+asyncio counterparts of the public functions in src/chat.py.
+
+Every call is handed to a thread pool sized to the connection pool, so the event loop never waits on
+database I/O. Each call is still one transaction on one pooled connection, and returns exactly what the
+sync function returns. Lookups that do not depend on each other run concurrently on separate connections.
+"""
+import asyncio
+import functools
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from src import chat
+from src.swen344_db_utils import get_pool
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    :return: the thread pool calls are offloaded to, with one thread per pooled connection
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=get_pool().max_size, thread_name_prefix='chat-async')
+    return _executor
+
+
+def shutdown(wait=True):
+    """stops the thread pool. The next call starts a new one"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=wait)
+            _executor = None
+
+
+async def run_sync(func, *args, **kwargs):
+    """
+    runs a blocking function on the thread pool
+    :return: what func returns
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def _offload(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_sync(func, *args, **kwargs)
+    return wrapper
+
+
+def _offload_iter(func):
+    @functools.wraps(func)
+    async def wrapper(*args, batch_size=1000, **kwargs):
+        # hop to the thread pool once per batch rather than once per row
+        rows = func(*args, batch_size=batch_size, **kwargs)
+        try:
+            while True:
+                batch = await run_sync(lambda: list(itertools.islice(rows, batch_size)))
+                if not batch:
+                    return
+                for row in batch:
+                    yield row
+        finally:
+            # closing the generator returns its connection to the pool
+            await run_sync(rows.close)
+    return wrapper
+
+
+user_exists = _offload(chat.user_exists)
+get_email_by_id = _offload(chat.get_email_by_id)
+create_user = _offload(chat.create_user)
+change_username = _offload(chat.change_username)
+community_exists = _offload(chat.community_exists)
+channel_exists = _offload(chat.channel_exists)
+add_channel = _offload(chat.add_channel)
+add_community = _offload(chat.add_community)
+add_user_to_community = _offload(chat.add_user_to_community)
+get_users_in_community = _offload(chat.get_users_in_community)
+read_message = _offload(chat.read_message)
+get_unread_messages = _offload(chat.get_unread_messages)
+get_unread_posts = _offload(chat.get_unread_posts)
+mark_channel_read = _offload(chat.mark_channel_read)
+mark_conversation_read = _offload(chat.mark_conversation_read)
+mark_all_read = _offload(chat.mark_all_read)
+get_mentions = _offload(chat.get_mentions)
+get_unread_counts = _offload(chat.get_unread_counts)
+get_channel_unread_counts = _offload(chat.get_channel_unread_counts)
+reconcile_unread_counts = _offload(chat.reconcile_unread_counts)
+create_users = _offload(chat.create_users)
+add_users_to_community = _offload(chat.add_users_to_community)
+add_channels = _offload(chat.add_channels)
+create_direct_messages = _offload(chat.create_direct_messages)
+get_messages_from_page = _offload(chat.get_messages_from_page)
+get_unread_messages_page = _offload(chat.get_unread_messages_page)
+get_unread_posts_page = _offload(chat.get_unread_posts_page)
+get_mentions_page = _offload(chat.get_mentions_page)
+get_inbox = _offload(chat.get_inbox)
+get_channel_history = _offload(chat.get_channel_history)
+iter_messages_from = _offload_iter(chat.iter_messages_from)
+iter_unread_messages = _offload_iter(chat.iter_unread_messages)
+iter_unread_posts = _offload_iter(chat.iter_unread_posts)
+iter_mentions = _offload_iter(chat.iter_mentions)
+search_channel_posts = _offload(chat.search_channel_posts)
+search_direct_messages = _offload(chat.search_direct_messages)
+suspend_user = _offload(chat.suspend_user)
+resume_user = _offload(chat.resume_user)
+is_suspended = _offload(chat.is_suspended)
+get_last_message_id = _offload(chat.get_last_message_id)
+
+
+async def _warm_user(user_id):
+    await user_exists(await get_email_by_id(user_id))
+
+
+async def _warm_users(*user_ids):
+    """
+    resolves users side by side: each user's email, then whether the email exists. The results land in the lookup
+    caches, so the sync function that follows finds them without another round trip. A missing user is left for
+    that function to report
+    """
+    await asyncio.gather(*(_warm_user(user_id) for user_id in user_ids), return_exceptions=True)
+
+
+async def create_direct_message(message_id, sender_id, receiver_id, time_sent, message):
+    """
+    async create_direct_message. The sender and receiver checks run concurrently
+    """
+    await _warm_users(sender_id, receiver_id)
+    return await run_sync(chat.create_direct_message, message_id, sender_id, receiver_id, time_sent, message)
+
+
+async def get_messages_from(receiver_id, sender_id):
+    """
+    async get_messages_from. Both users are resolved concurrently
+    """
+    await _warm_users(receiver_id, sender_id)
+    return await run_sync(chat.get_messages_from, receiver_id, sender_id)
+
+
+async def post_to_channel(poster_id, channel, community, message, time_sent=None):
+    """
+    async post_to_channel. The channel check and roster load run concurrently
+    """
+    await asyncio.gather(channel_exists(channel, community), get_users_in_community(community))
+    if time_sent is None:
+        return await run_sync(chat.post_to_channel, poster_id, channel, community, message)
+    return await run_sync(chat.post_to_channel, poster_id, channel, community, message, time_sent)
@@ -0,0 +1,276 @@
+"""
+In-memory history of the newest posts in each channel, for the channel history reads that dominate traffic.
+
+Each channel read is given a ring buffer of its newest posts, up to capacity of them, loaded from channel_posts on
+first read. post_to_channel adds new posts to the ring once they commit, so the newest pages are served without a
+query. Older pages, and channels whose ring is missing or expired, are read from the database. Whole channels are
+evicted, least recently used first, once the rings together outgrow max_bytes.
+
+Settings come from the optional history section of config/db.yml:
+
+    history:
+      capacity: 200           # newest posts kept per channel
+      max_bytes: 67108864     # memory budget for every channel's ring together
+      ttl: 60                 # seconds before a ring is reloaded, bounding how stale posts from other processes are
+
+Like the caches in src.cache, it is emptied by clear_caches() and reported by cache_stats().
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+
+from src.cache import register_cache
+from src.swen344_db_utils import after_commit, after_transaction, load_config
+
+# defaults for the optional "history" section of config/db.yml
+HISTORY_DEFAULTS = {
+    'capacity': 200,
+    'max_bytes': 64 * 1024 * 1024,
+    'ttl': 60,
+}
+
+_local = threading.local()
+_history = None
+_history_lock = threading.Lock()
+
+
+class PostRecord:
+    """
+    one cached post, holding the columns of a channel_posts row
+    """
+    __slots__ = ('id', 'channel_id', 'text', 'user_id', 'time_sent')
+
+    def __init__(self, id, channel_id, text, user_id, time_sent):
+        self.id = id
+        self.channel_id = channel_id
+        self.text = text
+        self.user_id = user_id
+        self.time_sent = time_sent
+
+    def key(self):
+        """:return: the post's (time_sent, id), the order history is kept in and its page cursor"""
+        return self.time_sent, self.id
+
+    def row(self):
+        """:return: the post as a channel_posts row"""
+        return self.id, self.channel_id, self.text, self.user_id, self.time_sent
+
+    def size(self):
+        """:return: bytes the record and its values take up"""
+        return sys.getsizeof(self) + sys.getsizeof(self.text) + sys.getsizeof(self.user_id) + \
+            sys.getsizeof(self.time_sent)
+
+
+class _Ring:
+    """
+    the newest posts of one channel, oldest first
+    """
+    __slots__ = ('posts', 'complete', 'expires_at', 'bytes')
+
+    def __init__(self, capacity, expires_at):
+        self.posts = deque(maxlen=capacity)
+        # whether the channel has no posts older than the ring's
+        self.complete = True
+        self.expires_at = expires_at
+        self.bytes = sys.getsizeof(self.posts)
+
+
+def _position(posts, key):
+    """
+    :return: index of the first post at or after key
+    """
+    low, high = 0, len(posts)
+    while low < high:
+        middle = (low + high) // 2
+        if posts[middle].key() < key:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+class ChannelHistory:
+    """
+    thread-safe ring buffers of recent posts, keyed by (community, channel), evicted whole in LRU order once they
+    take up more than max_bytes
+    """
+
+    def __init__(self, capacity=200, max_bytes=64 * 1024 * 1024, ttl=60, clock=time.monotonic):
+        if capacity < 1 or max_bytes < 1:
+            raise ValueError('capacity and max_bytes must be at least 1')
+        self.name = 'channel_history'
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._clock = clock
+        self._rings = OrderedDict()  # (community, channel) -> _Ring, least recently used first
+        # writes seen per channel, and clears, so a load that raced a write or a clear is not kept
+        self._writes = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def version(self, key):
+        """
+        :return: token to pass to load() along with rows read after calling this
+        """
+        with self._lock:
+            return self._generation, self._writes.get(key, 0)
+
+    def page(self, key, limit, before=None, counted=True):
+        """
+        :param before: (time_sent, id) cursor, None for the newest posts
+        :param counted: count the read in the hit rate. A read retried after a load was already counted as a miss
+        :return: (channel_posts rows oldest first, cursor of the next older page or None), or None if the ring cannot
+        answer and the page has to be read from the database
+        """
+        with self._lock:
+            ring = self._rings.get(key)
+            if ring is not None and ring.expires_at <= self._clock():
+                self._drop(key)
+                ring = None
+            if ring is None:
+                self.misses += counted
+                return None
+            posts = ring.posts
+            end = len(posts) if before is None else _position(posts, tuple(before))
+            start = max(end - limit, 0)
+            if end - start < limit and not ring.complete:
+                self.misses += counted
+                return None
+            self._rings.move_to_end(key)
+            self.hits += counted
+            rows = [posts[i].row() for i in range(start, end)]
+            more = start > 0 or not ring.complete
+            return rows, posts[start].key() if rows and more else None
+
+    def load(self, key, rows, version):
+        """
+        caches a channel's newest posts
+        :param rows: up to capacity + 1 channel_posts rows, newest first
+        :param version: version() from before the rows were read
+        """
+        with self._lock:
+            if version != (self._generation, self._writes.get(key, 0)):
+                return
+            self._drop(key)
+            ring = _Ring(self.capacity, self._clock() + self.ttl)
+            ring.complete = len(rows) <= self.capacity
+            for row in reversed(rows[:self.capacity]):
+                record = PostRecord(*row)
+                ring.posts.append(record)
+                ring.bytes += record.size()
+            self._rings[key] = ring
+            self.bytes += ring.bytes
+            self._evict()
+
+    def add(self, key, record):
+        """
+        adds a committed post to its channel's ring, if the channel is cached and the post is within the ring
+        """
+        with self._lock:
+            self._writes[key] = self._writes.get(key, 0) + 1
+            ring = self._rings.get(key)
+            if ring is None:
+                return
+            posts = ring.posts
+            position = len(posts)
+            if posts and record.key() <= posts[-1].key():
+                # posts written with an earlier time_sent go in their place, if they fall within the ring
+                position = _position(posts, record.key())
+                if position < len(posts) and posts[position].key() == record.key():
+                    return
+                if position == 0 and (not ring.complete or len(posts) == posts.maxlen):
+                    ring.complete = False
+                    return
+            if len(posts) == posts.maxlen:
+                self._shrink(ring, posts.popleft())
+                ring.complete = False
+                position -= 1
+            posts.insert(position, record)
+            size = record.size()
+            ring.bytes += size
+            self.bytes += size
+            self._rings.move_to_end(key)
+            self._evict()
+
+    def discard(self, key):
+        """drops a channel's ring, and any load of it already under way"""
+        with self._lock:
+            self._writes[key] = self._writes.get(key, 0) + 1
+            self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._rings.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            reads = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / reads if reads else 0.0,
+                    'evictions': self.evictions, 'channels': len(self._rings),
+                    'posts': sum(len(ring.posts) for ring in self._rings.values()),
+                    'bytes': self.bytes, 'max_bytes': self.max_bytes}
+
+    def _shrink(self, ring, record):
+        size = record.size()
+        ring.bytes -= size
+        self.bytes -= size
+
+    def _drop(self, key):
+        ring = self._rings.pop(key, None)
+        if ring is not None:
+            self.bytes -= ring.bytes
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self._rings:
+            key, ring = self._rings.popitem(last=False)
+            self.bytes -= ring.bytes
+            self.evictions += 1
+
+
+def get_history():
+    """
+    :return: the process-wide ChannelHistory, built from config on first use
+    """
+    global _history
+    if _history is None:
+        with _history_lock:
+            if _history is None:
+                settings = dict(HISTORY_DEFAULTS)
+                settings.update(load_config().get('history') or {})
+                _history = register_cache(ChannelHistory(**settings))
+    return _history
+
+
+def _pending():
+    if not hasattr(_local, 'pending'):
+        _local.pending = set()
+    return _local.pending
+
+
+def posted(key, record):
+    """
+    adds a new post to its channel's ring once the post commits. Until then, reads of the channel in the writing
+    transaction skip the ring so they see the post
+    :param key: (community, channel)
+    """
+    history = get_history()
+    pending = _pending()
+    if key not in pending:
+        pending.add(key)
+        after_transaction(lambda: pending.discard(key))
+    after_commit(lambda: history.add(key, record))
+
+
+def is_pending(key):
+    """
+    :return: whether this thread's open transaction has posted to the channel
+    """
+    return key in _pending()
@@ -0,0 +1,224 @@
+"""
+Streams conversation transcripts (CSV files shaped like data/whos_on_first.csv) into direct_messages.
+Rows are loaded with COPY FROM STDIN in bounded chunks, so memory use stays flat however long the transcript is.
+
+    python -m src.importer data/whos_on_first.csv --speaker Abbott=Abbott1234:Costello1234 ...
+"""
+import argparse
+import csv
+import io
+import itertools
+from datetime import datetime
+
+from src import suspensions
+from src.notifications import CHANNEL
+from src.swen344_db_utils import transaction
+
+# speaker name in the transcript -> (sender_id, receiver_id)
+WHOS_ON_FIRST_SPEAKERS = {
+    'Abbott': ('Abbott1234', 'Costello1234'),
+    'Costello': ('Costello1234', 'Abbott1234'),
+    # read_csv always sent lines spoken by both of them as Costello
+    'Both': ('Costello1234', 'Abbott1234'),
+}
+DEFAULT_CHUNK_SIZE = 5000
+COPY_DIRECT_MESSAGES = 'COPY direct_messages (sender_id, receiver_id, time_sent, message) FROM STDIN WITH (FORMAT csv)'
+# adds newly received, unread messages to their receivers' unread counters
+COUNT_RECEIVED = 'INSERT INTO unread_counts (user_id, unread_messages) ' \
+                 'SELECT receiver_id, COUNT(*) FROM unnest(%s::VARCHAR[]) AS received(receiver_id) ' \
+                 'GROUP BY receiver_id ORDER BY receiver_id ' \
+                 'ON CONFLICT (user_id) DO UPDATE ' \
+                 'SET unread_messages = unread_counts.unread_messages + EXCLUDED.unread_messages'
+# one event per sender and receiver pair, since the ids of copied messages are not known
+NOTIFY_RECEIVED = "SELECT pg_notify('" + CHANNEL + "', jsonb_build_object('type', 'messages', " \
+                  "'user', sender_id, 'receiver', receiver_id)::TEXT) " \
+                  "FROM (SELECT DISTINCT sender_id, receiver_id " \
+                  "      FROM unnest(%s::VARCHAR[], %s::VARCHAR[]) AS sent(sender_id, receiver_id) " \
+                  "      ORDER BY sender_id, receiver_id) AS pairs"
+# merges a new message, or the newest of a batch, into a conversation summary
+UPDATE_CONVERSATION = """
+    ON CONFLICT (user_a, user_b) DO UPDATE SET
+        last_message_id = CASE WHEN (EXCLUDED.last_time_sent, EXCLUDED.last_message_id)
+                                    > (conversations.last_time_sent, conversations.last_message_id)
+                               THEN EXCLUDED.last_message_id ELSE conversations.last_message_id END,
+        last_time_sent = GREATEST(conversations.last_time_sent, EXCLUDED.last_time_sent),
+        unread_a = conversations.unread_a + EXCLUDED.unread_a,
+        unread_b = conversations.unread_b + EXCLUDED.unread_b
+"""
+# message ids are not known after a COPY, so the newest message of each pair is looked up in the conversation index
+SUMMARIZE_CONVERSATIONS = """
+    INSERT INTO conversations (user_a, user_b, last_message_id, last_time_sent, unread_a, unread_b)
+    SELECT pairs.user_a, pairs.user_b, latest.message_id, latest.time_sent, pairs.unread_a, pairs.unread_b
+    FROM (
+        SELECT LEAST(sender_id, receiver_id) AS user_a, GREATEST(sender_id, receiver_id) AS user_b,
+               COUNT(*) FILTER (WHERE receiver_id <= sender_id) AS unread_a,
+               COUNT(*) FILTER (WHERE receiver_id > sender_id) AS unread_b
+        FROM unnest(%s::VARCHAR[], %s::VARCHAR[]) AS sent(sender_id, receiver_id)
+        GROUP BY 1, 2
+    ) AS pairs,
+    LATERAL (
+        SELECT message_id, time_sent FROM (
+            (SELECT message_id, time_sent FROM direct_messages
+             WHERE sender_id = pairs.user_a AND receiver_id = pairs.user_b
+             ORDER BY time_sent DESC, message_id DESC LIMIT 1)
+            UNION ALL
+            (SELECT message_id, time_sent FROM direct_messages
+             WHERE sender_id = pairs.user_b AND receiver_id = pairs.user_a
+             ORDER BY time_sent DESC, message_id DESC LIMIT 1)
+        ) AS newest
+        ORDER BY time_sent DESC, message_id DESC LIMIT 1
+    ) AS latest
+    ORDER BY pairs.user_a, pairs.user_b""" + UPDATE_CONVERSATION
+
+
+class TranscriptError(ValueError):
+    """raised for a transcript row that cannot be imported"""
+
+
+def read_transcript(file, speakers, header=True):
+    """
+    lazily maps transcript rows to direct message rows
+    :param file: open transcript file
+    :param speakers: dict of speaker name -> (sender_id, receiver_id)
+    :param header: skip the first row
+    :return: generator of (sender_id, receiver_id, message)
+    """
+    reader = csv.reader(file, delimiter=",")
+    if header:
+        next(reader, None)
+    for row in reader:
+        if len(row) != 2:
+            raise TranscriptError("Line %d should have a sender and a message" % reader.line_num)
+        if row[0] not in speakers:
+            raise TranscriptError("Line %d has unknown speaker %s" % (reader.line_num, row[0]))
+        sender_id, receiver_id = speakers[row[0]]
+        yield sender_id, receiver_id, row[1]
+
+
+def validate_speakers(cur, speakers, at=None):
+    """
+    checks every user in the speaker mapping once, instead of once per message
+    :param cur: cursor to check with
+    :param speakers: dict of speaker name -> (sender_id, receiver_id)
+    :param at: time the messages are sent, defaults to now
+    :return: error message, or None if every sender may send to every receiver
+    """
+    at = at or datetime.now()
+    user_ids = sorted({user_id for pair in speakers.values() for user_id in pair})
+    cur.execute('SELECT user_id FROM users WHERE user_id = ANY(%s)', (user_ids,))
+    users = {row[0] for row in cur.fetchall()}
+    for user_id in user_ids:
+        if user_id not in users:
+            return "User " + user_id + " doesn't exist"
+    # the same index create_direct_message checks, so both agree on who is suspended
+    index = suspensions.get_index()
+    for sender_id, receiver_id in speakers.values():
+        suspended_till = index.suspended_until(sender_id, suspensions.GLOBAL, at)
+        if suspended_till:
+            return sender_id + " is currently suspended until " + suspended_till.strftime("%Y/%m/%d %H:%M:%S")
+    return None
+
+
+def sync_message_id_sequence(cur, pending=()):
+    """
+    moves the message_id sequence past any ids that were inserted explicitly (the seed data does this),
+    so rows that take their id from the sequence cannot collide with them
+    :param pending: explicit ids about to be inserted alongside rows that take theirs from the sequence
+    """
+    last = max(pending, default=None)
+    cur.execute("SELECT setval(pg_get_serial_sequence('direct_messages', 'message_id'), GREATEST(MAX(message_id), %s)) "
+                "FROM direct_messages HAVING GREATEST(MAX(message_id), %s) IS NOT NULL", (last, last))
+
+
+def copy_direct_messages(cur, rows, time_sent):
+    """
+    loads one chunk of rows with COPY
+    :param cur: cursor to copy with
+    :param rows: list of (sender_id, receiver_id, message)
+    :param time_sent: timestamp for every row
+    :return: number of rows copied
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for sender_id, receiver_id, message in rows:
+        writer.writerow((sender_id, receiver_id, time_sent, message))
+    buffer.seek(0)
+    cur.copy_expert(COPY_DIRECT_MESSAGES, buffer)
+    count_received(cur, [row[:2] for row in rows])
+    return len(rows)
+
+
+def count_received(cur, messages):
+    """
+    updates the unread counters and conversation summaries for new direct messages, and notifies their receivers,
+    in the transaction that writes them
+    :param cur: cursor the messages were written with
+    :param messages: (sender_id, receiver_id) of each new message
+    """
+    if messages:
+        senders, receivers = zip(*messages)
+        cur.execute(COUNT_RECEIVED, (list(receivers),))
+        cur.execute(SUMMARIZE_CONVERSATIONS, (list(senders), list(receivers)))
+        cur.execute(NOTIFY_RECEIVED, (list(senders), list(receivers)))
+
+
+def _import(file, speakers, chunk_size, header):
+    time_sent = datetime.now()
+    with transaction() as cur:
+        error = validate_speakers(cur, speakers, time_sent)
+        if error:
+            return error
+        sync_message_id_sequence(cur)
+        rows = read_transcript(file, speakers, header)
+        imported = 0
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            imported += copy_direct_messages(cur, chunk, time_sent)
+    return "Imported %d messages" % imported
+
+
+def import_conversation(filename, speakers=WHOS_ON_FIRST_SPEAKERS, chunk_size=DEFAULT_CHUNK_SIZE, header=True):
+    """
+    imports a transcript as direct messages in one transaction. Message ids come from the sequence
+    :param filename: path of the CSV transcript
+    :param speakers: dict of speaker name -> (sender_id, receiver_id)
+    :param chunk_size: rows held in memory and sent per COPY
+    :param header: the first row is a header
+    :return: "Imported N messages" or why nothing was imported
+    """
+    # a first pass checks every row, so a malformed transcript is rejected before anything is written
+    try:
+        with open(filename, newline='') as file:
+            for row in read_transcript(file, speakers, header):
+                pass
+    except TranscriptError as error:
+        return str(error)
+    with open(filename, newline='') as file:
+        return _import(file, speakers, chunk_size, header)
+
+
+def parse_speaker(value):
+    """parses NAME=SENDER_ID:RECEIVER_ID from the command line"""
+    try:
+        name, ids = value.split('=', 1)
+        sender_id, receiver_id = ids.split(':')
+    except ValueError:
+        raise argparse.ArgumentTypeError('speakers look like NAME=SENDER_ID:RECEIVER_ID')
+    return name, (sender_id, receiver_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('filename')
+    parser.add_argument('--speaker', type=parse_speaker, action='append',
+                        help='NAME=SENDER_ID:RECEIVER_ID, defaults to the Who\'s on First cast')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+    speakers = dict(args.speaker) if args.speaker else WHOS_ON_FIRST_SPEAKERS
+    print(import_conversation(args.filename, speakers, args.chunk_size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""
+Parallel ingestion of a directory of conversation transcripts (CSV files shaped like data/whos_on_first.csv).
+
+A process pool parses and validates the files and streams their rows, in fixed-size batches, through bounded
+queues to a few writer threads. Each writer loads batches with COPY on its own pooled connection. Every batch of a file
+goes to the same writer, in order, so its rows, which share one time_sent, take message ids in transcript order. A full
+queue blocks the parsers, so memory stays bounded when the database falls behind.
+
+Every committed batch is recorded in ingest_batches in the same transaction as its rows, and finished files in
+ingest_manifest. Running the same command again skips finished files and already committed batches.
+
+    python -m src.ingest DIRECTORY [--processes N] [--writers N] [--batch-size N] [--speaker NAME=SENDER:RECEIVER]
+"""
+import argparse
+import glob
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from src.importer import (WHOS_ON_FIRST_SPEAKERS, DEFAULT_CHUNK_SIZE, TranscriptError, copy_direct_messages,
+                          parse_speaker, read_transcript, sync_message_id_sequence, validate_speakers)
+from src.swen344_db_utils import exec_get_all, transaction
+
+IngestReport = namedtuple('IngestReport', ['files', 'rows', 'seconds', 'failed'])
+
+
+def discover(directory, pattern='*.csv'):
+    """
+    :param directory: directory holding transcripts
+    :param pattern: glob for transcript file names
+    :return: sorted list of absolute transcript paths
+    """
+    return sorted(os.path.abspath(path) for path in glob.glob(os.path.join(directory, pattern)))
+
+
+def parse_file(path, speakers, batch_size, skip_batches, queue, header=True):
+    """
+    runs in a worker process. Validates the whole file, then puts ('batch', path, batch_no, rows) on the queue
+    for every batch that has not been committed yet
+    :return: (path, number of batches, number of rows, error message or None)
+    """
+    try:
+        with open(path, newline='') as file:
+            for row in read_transcript(file, speakers, header):
+                pass
+    except TranscriptError as error:
+        return path, 0, 0, str(error)
+    batches = 0
+    rows = 0
+    with open(path, newline='') as file:
+        transcript = read_transcript(file, speakers, header)
+        while True:
+            batch = list(itertools.islice(transcript, batch_size))
+            if not batch:
+                break
+            if batches not in skip_batches:
+                queue.put(('batch', path, batches, batch))
+            batches += 1
+            rows += len(batch)
+    return path, batches, rows, None
+
+
+class _Progress:
+    """
+    tracks committed batches per file and writes the manifest row once every batch of a file is in
+    """
+
+    def __init__(self, done_batches, report):
+        self.lock = threading.Lock()
+        self.committed = {path: len(batches) for path, batches in done_batches.items()}
+        self.expected = {}
+        self.rows = {}
+        self.started = time.monotonic()
+        self.total_rows = 0
+        self.files = 0
+        self.failed = {}
+        self.report = report
+
+    def batch_committed(self, path, rows):
+        with self.lock:
+            self.committed[path] = self.committed.get(path, 0) + 1
+            self.total_rows += rows
+        self._maybe_complete(path)
+
+    def file_parsed(self, path, batches, rows):
+        with self.lock:
+            self.expected[path] = batches
+            self.rows[path] = rows
+        self._maybe_complete(path)
+
+    def file_failed(self, path, error):
+        with self.lock:
+            self.failed[path] = error
+        self.report('%s: failed, %s' % (path, error))
+
+    def has_failed(self, path):
+        with self.lock:
+            return path in self.failed
+
+    def _maybe_complete(self, path):
+        with self.lock:
+            if path in self.failed or self.expected.get(path) != self.committed.get(path, 0):
+                return
+            # only one caller gets past here for each file
+            del self.expected[path]
+            rows = self.rows[path]
+        with transaction() as cur:
+            cur.execute('INSERT INTO ingest_manifest (path, rows) VALUES (%s, %s) ON CONFLICT (path) DO NOTHING',
+                        (path, rows))
+            cur.execute('DELETE FROM ingest_batches WHERE path = %s', (path,))
+        with self.lock:
+            self.files += 1
+            elapsed = time.monotonic() - self.started
+            total_rows = self.total_rows
+        self.report('%s: %d rows (%d files, %d rows done, %.0f rows/s)'
+                    % (path, rows, self.files, total_rows, total_rows / max(elapsed, 1e-9)))
+
+
+def _write(queue, time_sent, progress):
+    """writer thread: COPYs batches until it takes the None sentinel off the queue"""
+    while True:
+        item = queue.get()
+        if item is None:
+            return
+        path, batch_no, rows = item[1:]
+        if progress.has_failed(path):
+            # the batches after a failed one wait for the next run, which loads them in order after it
+            continue
+        try:
+            with transaction() as cur:
+                copy_direct_messages(cur, rows, time_sent)
+                cur.execute('INSERT INTO ingest_batches (path, batch_no, rows) VALUES (%s, %s, %s)',
+                            (path, batch_no, len(rows)))
+        except Exception as error:
+            # keep draining the queue so the parsers never block on a dead writer
+            progress.file_failed(path, error)
+            continue
+        progress.batch_committed(path, len(rows))
+
+
+def ingest(directory, speakers=WHOS_ON_FIRST_SPEAKERS, processes=None, writers=2, batch_size=DEFAULT_CHUNK_SIZE,
+           queue_size=8, pattern='*.csv', report=print):
+    """
+    loads every transcript in a directory that is not already in the manifest
+    :param directory: directory holding transcripts
+    :param speakers: dict of speaker name -> (sender_id, receiver_id), shared by every file
+    :param processes: parser processes, defaults to the number of cores
+    :param writers: writer threads, each with its own database connection and the files given to it
+    :param batch_size: rows per COPY and per queue item
+    :param queue_size: batches allowed to wait for each writer before the parsers block
+    :param pattern: glob for transcript file names
+    :param report: called with a progress line as each file completes or fails
+    :return: IngestReport, or an error message if the speakers cannot send
+    """
+    started = time.monotonic()
+    time_sent = datetime.now()
+    with transaction() as cur:
+        error = validate_speakers(cur, speakers, time_sent)
+        if error:
+            return error
+        sync_message_id_sequence(cur)
+    completed = {row[0] for row in exec_get_all('SELECT path FROM ingest_manifest')}
+    files = [path for path in discover(directory, pattern) if path not in completed]
+    done_batches = {}
+    for path, batch_no in exec_get_all('SELECT path, batch_no FROM ingest_batches WHERE path = ANY(%s)', (files,)):
+        done_batches.setdefault(path, set()).add(batch_no)
+
+    progress = _Progress(done_batches, report)
+    # spawned rather than forked, so children never inherit pooled connections or locks held by writer threads
+    context = multiprocessing.get_context('spawn')
+    with context.Manager() as manager:
+        # a manager queue hands each batch over before put() returns, so the writers' sentinels always come last
+        queues = [manager.Queue(queue_size) for i in range(writers)]
+        threads = [threading.Thread(target=_write, args=(queue, time_sent, progress), daemon=True)
+                   for queue in queues]
+        for thread in threads:
+            thread.start()
+        try:
+            with ProcessPoolExecutor(processes, mp_context=context) as pool:
+                futures = [pool.submit(parse_file, path, speakers, batch_size, done_batches.get(path, set()),
+                                       queues[i % writers])
+                           for i, path in enumerate(files)]
+                for future in as_completed(futures):
+                    path, batches, rows, error = future.result()
+                    if error:
+                        progress.file_failed(path, error)
+                    else:
+                        progress.file_parsed(path, batches, rows)
+        finally:
+            for queue in queues:
+                queue.put(None)
+            for thread in threads:
+                thread.join()
+    return IngestReport(progress.files, progress.total_rows, time.monotonic() - started, progress.failed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--queue-size', type=int, default=8)
+    parser.add_argument('--pattern', default='*.csv')
+    parser.add_argument('--speaker', type=parse_speaker, action='append',
+                        help='NAME=SENDER_ID:RECEIVER_ID, defaults to the Who\'s on First cast')
+    args = parser.parse_args()
+    speakers = dict(args.speaker) if args.speaker else WHOS_ON_FIRST_SPEAKERS
+    result = ingest(args.directory, speakers, args.processes, args.writers, args.batch_size, args.queue_size,
+                    args.pattern)
+    if isinstance(result, str):
+        print(result)
+        return
+    print('Ingested %d files, %d rows in %.1f s (%.0f rows/s), %d failed'
+          % (result.files, result.rows, result.seconds, result.rows / max(result.seconds, 1e-9), len(result.failed)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""
+Per-operation query instrumentation for the DB helper layer.
+
+Every statement run on a transaction's cursor, with the rows it returned, and every connection opened or borrowed,
+is recorded against the operation active on the thread. Statements are keyed by their normalized text, so the same
+query with different values is counted as one shape. An operation that runs one shape more than the N+1 threshold
+raises a NPlusOneWarning, which is the signature of a per-row loop.
+
+Switch it on for one block:
+
+    with profile('post') as operation:
+        post_to_channel(...)
+    print(operation.report())
+
+or for the whole process with CHAT_PROFILE=1, which reports every public chat function to stderr. The threshold is
+CHAT_N_PLUS_ONE (default 10).
+"""
+import functools
+import os
+import re
+import sys
+import threading
+import time
+import warnings
+from contextlib import contextmanager
+
+PROFILE_ENV = 'CHAT_PROFILE'
+N_PLUS_ONE_ENV = 'CHAT_N_PLUS_ONE'
+DEFAULT_N_PLUS_ONE = 10
+
+_local = threading.local()
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'(?<![\w$])-?\d+(?:\.\d+)?\b')
+_PLACEHOLDER = re.compile(r'%(?:\(\w+\))?s')
+_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_ROWS = re.compile(r'\(\?\.\.\.\)(?:\s*,\s*\(\?\.\.\.\))+')
+_SPACE = re.compile(r'\s+')
+
+
+class NPlusOneWarning(UserWarning):
+    """the same statement shape ran more times in one operation than the N+1 threshold allows"""
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize_sql(sql):
+    """
+    :param sql: statement text, with or without its values inlined
+    :return: the statement with literals and placeholders replaced by ? and whitespace collapsed
+    """
+    if isinstance(sql, bytes):
+        sql = sql.decode()
+    sql = _STRING.sub('?', sql)
+    sql = _PLACEHOLDER.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _SPACE.sub(' ', sql).strip()
+    # VALUES and IN lists of any length are one shape
+    return _ROWS.sub('(?...)', _LIST.sub('(?...)', sql))
+
+
+class StatementStats:
+    """totals for one statement shape. rows counts the rows returned to the client, not the rows a write affected"""
+    __slots__ = ('calls', 'rows', 'seconds', 'max_seconds')
+
+    def __init__(self):
+        self.calls = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def as_dict(self):
+        return {'calls': self.calls, 'rows': self.rows, 'seconds': self.seconds, 'max_seconds': self.max_seconds}
+
+
+class Operation:
+    """
+    the queries, connections and time of one logical operation
+    """
+
+    def __init__(self, name, n_plus_one=None):
+        self.name = name
+        self.n_plus_one = n_plus_one if n_plus_one is not None else n_plus_one_threshold()
+        self.queries = 0
+        self.rows = 0
+        self.connections = 0
+        self.checkouts = 0
+        self.statements = {}
+        self.started = time.perf_counter()
+        self.seconds = None
+
+    def record(self, sql, rows, seconds):
+        key = normalize_sql(sql)
+        stats = self.statements.get(key)
+        if stats is None:
+            stats = self.statements[key] = StatementStats()
+        stats.calls += 1
+        stats.rows += rows
+        stats.seconds += seconds
+        stats.max_seconds = max(stats.max_seconds, seconds)
+        self.queries += 1
+        self.rows += rows
+
+    def record_rows(self, sql, rows):
+        stats = self.statements.get(normalize_sql(sql))
+        if stats is not None:
+            stats.rows += rows
+            self.rows += rows
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self.started
+        for sql, calls in self.repeated():
+            warnings.warn(NPlusOneWarning('%s ran the same statement %d times: %s' % (self.name, calls, sql)),
+                          stacklevel=4)
+
+    def repeated(self):
+        """
+        :return: list of (normalized sql, calls) for shapes that ran more than n_plus_one times
+        """
+        return [(sql, stats.calls) for sql, stats in self.statements.items() if stats.calls > self.n_plus_one]
+
+    def as_dict(self):
+        return {'name': self.name, 'queries': self.queries, 'rows': self.rows, 'connections': self.connections,
+                'checkouts': self.checkouts, 'seconds': self.seconds,
+                'statements': {sql: stats.as_dict() for sql, stats in self.statements.items()}}
+
+    def report(self):
+        """
+        :return: a summary line followed by a line per statement shape, slowest first
+        """
+        lines = ['%s: %d queries, %d rows, %d connections opened, %d borrowed in %.2f ms'
+                 % (self.name, self.queries, self.rows, self.connections, self.checkouts, (self.seconds or 0) * 1000)]
+        for sql, stats in sorted(self.statements.items(), key=lambda item: -item[1].seconds):
+            lines.append('  %4dx %6d rows %9.2f ms  %s' % (stats.calls, stats.rows, stats.seconds * 1000, sql))
+        return '\n'.join(lines)
+
+
+def profiling_enabled():
+    """
+    :return: whether CHAT_PROFILE asks for every operation to be profiled
+    """
+    return os.environ.get(PROFILE_ENV, '').lower() not in ('', '0', 'false', 'no')
+
+
+def n_plus_one_threshold():
+    return int(os.environ.get(N_PLUS_ONE_ENV, DEFAULT_N_PLUS_ONE))
+
+
+def _active():
+    active = getattr(_local, 'operations', None)
+    if active is None:
+        active = _local.operations = []
+    return active
+
+
+def current_operation():
+    """
+    :return: the innermost Operation being recorded on this thread, or None
+    """
+    active = _active()
+    return active[-1] if active else None
+
+
+@contextmanager
+def profile(name='operation', n_plus_one=None):
+    """
+    records every query made on this thread inside the with block, including those of nested operations
+    :param name: label for the report
+    :param n_plus_one: statement repeats allowed before a NPlusOneWarning, defaults to CHAT_N_PLUS_ONE
+    :return: the Operation, complete once the block exits
+    """
+    active = _active()
+    recorded = Operation(name, n_plus_one)
+    active.append(recorded)
+    try:
+        yield recorded
+    finally:
+        active.remove(recorded)
+        recorded.finish()
+
+
+@contextmanager
+def operation(name, n_plus_one=None):
+    """
+    marks a logical operation. Under CHAT_PROFILE it is profiled and reported to stderr unless an enclosing
+    operation is already being recorded
+    :param n_plus_one: statement repeats allowed before a NPlusOneWarning, defaults to CHAT_N_PLUS_ONE
+    """
+    if current_operation() is not None or not profiling_enabled():
+        yield
+        return
+    with profile(name, n_plus_one) as recorded:
+        yield
+    sys.stderr.write(recorded.report() + '\n')
+
+
+def recording():
+    """
+    :return: whether anything is being recorded on this thread, so callers can skip timing when nothing is
+    """
+    return bool(getattr(_local, 'operations', None))
+
+
+def record_statement(sql, rows, seconds):
+    for recorded in _active():
+        recorded.record(sql, rows, seconds)
+
+
+def record_rows(sql, rows):
+    """adds rows fetched after a statement ran, such as those of a server-side cursor, to its returned rows"""
+    for recorded in _active():
+        recorded.record_rows(sql, rows)
+
+
+def record_connection():
+    for recorded in _active():
+        recorded.connections += 1
+
+
+def record_checkout():
+    for recorded in _active():
+        recorded.checkouts += 1
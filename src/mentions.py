@@ -0,0 +1,70 @@
+"""
+Mention extraction for channel posts.
+A mention is an @ followed by a user id that is not part of a longer word, so email addresses never match.
+Candidates are resolved against a hashed set of the community's member ids.
+"""
+import bisect
+import itertools
+import re
+
+# the id may contain dots and dashes inside it, but trailing punctuation ("@Moe1234,") is not part of it
+MENTION_PATTERN = re.compile(r'(?<!\w)@(\w(?:[\w.\-]*\w)?)')
+# joins messages for batch extraction; it is not a word character so it always ends a mention
+_SEPARATOR = '\x00'
+
+
+class MentionIndex:
+    """
+    resolves mentions against one community's members
+    """
+
+    def __init__(self, member_ids):
+        self.member_list = tuple(member_ids)
+        self.members = frozenset(self.member_list)
+
+    def extract(self, message):
+        """
+        :param message: post text
+        :return: list of mentioned member ids, without duplicates, in the order they first appear
+        """
+        members = self.members
+        found = {}
+        for candidate in MENTION_PATTERN.findall(message):
+            if candidate in members:
+                found[candidate] = None
+        return list(found)
+
+    def extract_batch(self, messages):
+        """
+        extracts mentions from many messages with one scan over their joined text
+        :param messages: list of post texts
+        :return: list with the mentioned member ids of each message, in the same order as messages
+        """
+        messages = [message.replace(_SEPARATOR, ' ') for message in messages]
+        # starts[i] is the offset of message i in the joined text
+        starts = [0] + list(itertools.accumulate(len(message) + 1 for message in messages))[:-1]
+        results = [{} for message in messages]
+        members = self.members
+        for match in MENTION_PATTERN.finditer(_SEPARATOR.join(messages)):
+            candidate = match.group(1)
+            if candidate in members:
+                results[bisect.bisect_right(starts, match.start()) - 1][candidate] = None
+        return [list(found) for found in results]
+
+
+def extract_mentions(message, member_ids):
+    """
+    :param message: post text
+    :param member_ids: ids of the community's members
+    :return: list of mentioned member ids
+    """
+    return MentionIndex(member_ids).extract(message)
+
+
+def extract_mentions_batch(messages, member_ids):
+    """
+    :param messages: list of post texts from the same community
+    :param member_ids: ids of the community's members
+    :return: list with the mentioned member ids of each message
+    """
+    return MentionIndex(member_ids).extract_batch(messages)
@@ -0,0 +1,397 @@
+"""
+Versioned migrations for the chat schema.
+Migrations are applied once each, in version order, and recorded in schema_migrations. Every step is idempotent
+(IF NOT EXISTS) so a migration that was interrupted part way can simply be run again.
+
+    python -m src.migrations [--target VERSION] [--concurrently]
+
+--concurrently builds indexes with CREATE INDEX CONCURRENTLY so they can be added to a live database
+without blocking writes.
+"""
+import argparse
+from collections import namedtuple
+
+from src.swen344_db_utils import borrow, current_session, transaction
+
+Migration = namedtuple('Migration', ['version', 'name', 'steps'])
+Index = namedtuple('Index', ['name', 'table', 'columns', 'where', 'unique', 'method'], defaults=(None, False, None))
+
+# arbitrary key for the advisory lock that stops two processes migrating at once
+MIGRATION_LOCK = 344_0001
+
+# text search configuration used to build and query the search_vector columns
+SEARCH_CONFIG = 'english'
+
+# every table the migrations create, dropped by drop_schema()
+TABLES = ['users', 'direct_messages', 'communities', 'memberships', 'unread_posts', 'channels', 'channel_posts',
+          'mentions', 'suspensions', 'channel_reads', 'ingest_batches', 'ingest_manifest', 'conversation_reads',
+          'unread_counts', 'channel_unread_counts', 'partitioned_tables', 'conversations', 'channel_post_counts',
+          'schema_migrations']
+
+MIGRATIONS = [
+    Migration(1, 'base schema', [
+        """
+        CREATE TABLE IF NOT EXISTS users(
+            user_id              VARCHAR(30) PRIMARY KEY NOT NULL,
+            name                 VARCHAR(30) NOT NULL,
+            phone_number         VARCHAR(10) NOT NULL,
+            email                VARCHAR(40) NOT NULL,
+            userid_set           TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            userid_reset         TIMESTAMP DEFAULT NULL,
+            suspended_since      TIMESTAMP,
+            suspended_till       TIMESTAMP,
+            UNIQUE(email)
+        );
+        CREATE TABLE IF NOT EXISTS direct_messages(
+            message_id          SERIAL PRIMARY KEY NOT NULL,
+            sender_id           VARCHAR(30) NOT NULL,
+            receiver_id         VARCHAR(30) NOT NULL,
+            time_sent           TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            message             TEXT NOT NULL,
+            is_read             BOOLEAN DEFAULT FALSE
+        );
+        CREATE TABLE IF NOT EXISTS communities(
+            name     VARCHAR(40) PRIMARY KEY NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS memberships(
+            user_id        VARCHAR(30) NOT NULL,
+            community_name VARCHAR(40) NOT NULL,
+            PRIMARY KEY(user_id, community_name)
+        );
+        CREATE TABLE IF NOT EXISTS unread_posts(
+            user_id      VARCHAR(30) NOT NULL,
+            post_id      VARCHAR(40) NOT NULL,
+            PRIMARY KEY(user_id, post_id)
+        );
+        CREATE TABLE IF NOT EXISTS channels(
+            id             SERIAL PRIMARY KEY,
+            name           VARCHAR(40) NOT NULL,
+            community_name VARCHAR(40) NOT NULL,
+            UNIQUE(name, community_name)
+        );
+        CREATE TABLE IF NOT EXISTS channel_posts(
+            id           SERIAL PRIMARY KEY NOT NULL,
+            channel_id   INT NOT NULL,
+            text         TEXT NOT NULL,
+            user_id      VARCHAR(30) NOT NULL,
+            time_sent    TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE IF NOT EXISTS mentions(
+            user_id      VARCHAR(30) NOT NULL,
+            post_id      VARCHAR(40) NOT NULL,
+            PRIMARY KEY(user_id, post_id)
+        );
+        CREATE TABLE IF NOT EXISTS suspensions(
+            user_id         VARCHAR(30) NOT NULL,
+            suspended_since TIMESTAMP DEFAULT NULL,
+            suspended_till  TIMESTAMP DEFAULT NULL,
+            community_name  VARCHAR(40) NOT NULL,
+            PRIMARY KEY(user_id, community_name)
+        );
+        CREATE TABLE IF NOT EXISTS channel_reads(
+            user_id           VARCHAR(30) NOT NULL,
+            channel_id        INT NOT NULL,
+            last_read_post_id INT NOT NULL DEFAULT 0,
+            PRIMARY KEY(user_id, channel_id)
+        );
+        """,
+    ]),
+    # users.user_id, and the (user_id, ...) lookups on unread_posts, mentions and suspensions,
+    # are already served by their primary keys
+    Migration(2, 'performance indexes', [
+        Index('direct_messages_receiver_read_idx', 'direct_messages', ['receiver_id', 'is_read']),
+        Index('direct_messages_unread_idx', 'direct_messages', ['receiver_id'], where='is_read = FALSE'),
+        Index('direct_messages_sender_receiver_idx', 'direct_messages', ['sender_id', 'receiver_id']),
+        Index('channel_posts_channel_time_idx', 'channel_posts', ['channel_id', 'time_sent']),
+        Index('memberships_community_idx', 'memberships', ['community_name']),
+        Index('channels_name_idx', 'channels', ['name']),
+    ]),
+    # progress of src/ingest.py, so an interrupted ingestion resumes where it stopped
+    Migration(3, 'ingestion manifest', [
+        """
+        CREATE TABLE IF NOT EXISTS ingest_batches(
+            path        TEXT NOT NULL,
+            batch_no    INT NOT NULL,
+            rows        INT NOT NULL,
+            PRIMARY KEY(path, batch_no)
+        );
+        CREATE TABLE IF NOT EXISTS ingest_manifest(
+            path         TEXT PRIMARY KEY NOT NULL,
+            rows         INT NOT NULL,
+            completed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+    ]),
+    # keyset pagination over (time_sent, message_id) for the history APIs
+    Migration(4, 'history keyset indexes', [
+        Index('direct_messages_conversation_time_idx', 'direct_messages',
+              ['sender_id', 'receiver_id', 'time_sent', 'message_id']),
+        Index('direct_messages_unread_time_idx', 'direct_messages', ['receiver_id', 'time_sent', 'message_id'],
+              where='is_read = FALSE'),
+    ]),
+    # search_vector is kept up to date on write by a trigger, so COPY and every other insert path maintain it
+    Migration(5, 'full-text search columns', [
+        """
+        ALTER TABLE channel_posts ADD COLUMN IF NOT EXISTS search_vector TSVECTOR;
+        ALTER TABLE direct_messages ADD COLUMN IF NOT EXISTS search_vector TSVECTOR;
+        DROP TRIGGER IF EXISTS channel_posts_search_vector ON channel_posts;
+        CREATE TRIGGER channel_posts_search_vector BEFORE INSERT OR UPDATE OF text ON channel_posts
+            FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger(search_vector, 'pg_catalog.{config}', text);
+        DROP TRIGGER IF EXISTS direct_messages_search_vector ON direct_messages;
+        CREATE TRIGGER direct_messages_search_vector BEFORE INSERT OR UPDATE OF message ON direct_messages
+            FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger(search_vector, 'pg_catalog.{config}', message);
+        UPDATE channel_posts SET search_vector = to_tsvector('{config}', text) WHERE search_vector IS NULL;
+        UPDATE direct_messages SET search_vector = to_tsvector('{config}', message) WHERE search_vector IS NULL;
+        """.format(config=SEARCH_CONFIG),
+    ]),
+    Migration(6, 'full-text search indexes', [
+        Index('channel_posts_search_idx', 'channel_posts', ['search_vector'], method='gin'),
+        Index('direct_messages_search_idx', 'direct_messages', ['search_vector'], method='gin'),
+    ]),
+    # one read watermark per receiver and sender, so marking a conversation read writes one row however many
+    # messages it holds. Migration 11 replaces the message id kept here with last_read_seq: a direct message is read
+    # once its arrival order (direct_messages.seq) is at or below the watermark
+    Migration(7, 'conversation read watermarks', [
+        """
+        CREATE TABLE IF NOT EXISTS conversation_reads(
+            receiver_id          VARCHAR(30) NOT NULL,
+            sender_id            VARCHAR(30) NOT NULL,
+            last_read_message_id INT NOT NULL DEFAULT 0,
+            PRIMARY KEY(receiver_id, sender_id)
+        );
+        """,
+    ]),
+    # badge counts kept up to date by the writes that change them, so reading them is one primary key lookup.
+    # They start empty; run chat.reconcile_unread_counts() once to fill them for an existing database
+    Migration(8, 'unread counters', [
+        """
+        CREATE TABLE IF NOT EXISTS unread_counts(
+            user_id         VARCHAR(30) PRIMARY KEY NOT NULL,
+            unread_messages INT NOT NULL DEFAULT 0,
+            unread_posts    INT NOT NULL DEFAULT 0,
+            mentions        INT NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS channel_unread_counts(
+            user_id      VARCHAR(30) NOT NULL,
+            channel_id   INT NOT NULL,
+            unread_posts INT NOT NULL DEFAULT 0,
+            mentions     INT NOT NULL DEFAULT 0,
+            PRIMARY KEY(user_id, channel_id)
+        );
+        """,
+    ]),
+    # the tables src/partitions.py has range partitioned by time_sent, and the period each partition covers
+    Migration(9, 'partition settings', [
+        """
+        CREATE TABLE IF NOT EXISTS partitioned_tables(
+            table_name  VARCHAR(63) PRIMARY KEY NOT NULL,
+            granularity VARCHAR(10) NOT NULL
+        );
+        """,
+    ]),
+    # one row per pair of users who have exchanged direct messages, user_a being the lesser id, holding the newest
+    # message and how many messages each side has unread, kept up to date by the writes that change them. It starts
+    # empty; run chat.reconcile_unread_counts() once to fill it for an existing database
+    Migration(10, 'conversation summaries', [
+        """
+        CREATE TABLE IF NOT EXISTS conversations(
+            user_a          VARCHAR(30) NOT NULL,
+            user_b          VARCHAR(30) NOT NULL,
+            last_message_id INT NOT NULL,
+            last_time_sent  TIMESTAMP NOT NULL,
+            unread_a        INT NOT NULL DEFAULT 0,
+            unread_b        INT NOT NULL DEFAULT 0,
+            PRIMARY KEY(user_a, user_b),
+            CHECK (user_a <= user_b)
+        );
+        """,
+        # an inbox page is a range scan of each index, newest first
+        Index('conversations_user_a_latest_idx', 'conversations', ['user_a', 'last_time_sent', 'last_message_id']),
+        Index('conversations_user_b_latest_idx', 'conversations', ['user_b', 'last_time_sent', 'last_message_id']),
+    ]),
+    # callers choose message ids, so a new message can have a lower id than one already read. Read watermarks are
+    # kept in arrival order instead: seq is taken from a sequence on insert, and existing messages are numbered in
+    # id order so every watermark still covers the messages it did. Guarded, as rerunning it would renumber them
+    Migration(11, 'message arrival order', [
+        """
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema()
+                           AND table_name = 'direct_messages' AND column_name = 'seq') THEN
+                ALTER TABLE direct_messages ADD COLUMN seq BIGINT;
+                CREATE SEQUENCE direct_messages_seq_seq OWNED BY direct_messages.seq;
+                UPDATE direct_messages SET seq = numbered.seq
+                FROM (SELECT message_id, time_sent, row_number() OVER (ORDER BY message_id) AS seq
+                      FROM direct_messages) AS numbered
+                WHERE direct_messages.message_id = numbered.message_id
+                AND direct_messages.time_sent = numbered.time_sent;
+                PERFORM setval('direct_messages_seq_seq', COALESCE(MAX(seq), 0) + 1, FALSE) FROM direct_messages;
+                ALTER TABLE direct_messages ALTER COLUMN seq SET DEFAULT nextval('direct_messages_seq_seq'),
+                    ALTER COLUMN seq SET NOT NULL;
+                ALTER TABLE conversation_reads ADD COLUMN last_read_seq BIGINT NOT NULL DEFAULT 0;
+                UPDATE conversation_reads SET last_read_seq = COALESCE(
+                    (SELECT MAX(seq) FROM direct_messages
+                     WHERE direct_messages.receiver_id = conversation_reads.receiver_id
+                     AND direct_messages.sender_id = conversation_reads.sender_id
+                     AND direct_messages.message_id <= conversation_reads.last_read_message_id), 0);
+                ALTER TABLE conversation_reads DROP COLUMN last_read_message_id;
+            END IF;
+        END $$;
+        """,
+    ]),
+    # watermark mode counts each channel's posts, and the posts each member has read in it (those up to their
+    # watermark and their own), instead of moving a counter per member on every post. They start at zero; run
+    # chat.reconcile_unread_counts() once to fill them for an existing database
+    Migration(12, 'channel post counters', [
+        """
+        CREATE TABLE IF NOT EXISTS channel_post_counts(
+            channel_id INT PRIMARY KEY NOT NULL,
+            posts      INT NOT NULL DEFAULT 0
+        );
+        ALTER TABLE channel_reads ADD COLUMN IF NOT EXISTS posts_read INT NOT NULL DEFAULT 0;
+        """,
+    ]),
+]
+
+
+def index_sql(index, concurrently=False):
+    """
+    :param index: Index to build
+    :param concurrently: build without locking out writes. Cannot run inside a transaction
+    :return: CREATE INDEX statement
+    """
+    return 'CREATE {unique}INDEX {concurrently}IF NOT EXISTS {name} ON {table} {method}({columns}){where}'.format(
+        unique='UNIQUE ' if index.unique else '',
+        concurrently='CONCURRENTLY ' if concurrently else '',
+        name=index.name,
+        table=index.table,
+        method='USING ' + index.method + ' ' if index.method else '',
+        columns=', '.join(index.columns),
+        where=' WHERE ' + index.where if index.where else '')
+
+
+def is_partitioned(cur, table):
+    """
+    :return: whether table exists and is a partitioned table
+    """
+    cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = cur.fetchone()
+    return bool(row and row[0])
+
+
+def _drop_invalid_index(cur, name):
+    """a CREATE INDEX CONCURRENTLY that failed leaves an invalid index behind, which IF NOT EXISTS would keep"""
+    cur.execute('SELECT 1 FROM pg_index WHERE indexrelid = to_regclass(%s) AND NOT indisvalid', (name,))
+    if cur.fetchone():
+        cur.execute('DROP INDEX CONCURRENTLY IF EXISTS ' + name)
+
+
+def _ensure_version_table(cur):
+    cur.execute('CREATE TABLE IF NOT EXISTS schema_migrations('
+                '    version    INT PRIMARY KEY NOT NULL,'
+                '    name       VARCHAR(80) NOT NULL,'
+                '    applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP'
+                ')')
+
+
+def _pending(cur, target):
+    cur.execute('SELECT version FROM schema_migrations')
+    applied = {row[0] for row in cur.fetchall()}
+    return [migration for migration in sorted(MIGRATIONS, key=lambda m: m.version)
+            if migration.version not in applied and (target is None or migration.version <= target)]
+
+
+def _apply(cur, migration, concurrently):
+    for step in migration.steps:
+        if isinstance(step, Index):
+            # partitioned tables cannot build indexes concurrently
+            build_concurrently = concurrently and not is_partitioned(cur, step.table)
+            if build_concurrently:
+                _drop_invalid_index(cur, step.name)
+            cur.execute(index_sql(step, build_concurrently))
+        else:
+            cur.execute(step)
+    cur.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s) ON CONFLICT (version) DO NOTHING',
+                (migration.version, migration.name))
+
+
+def applied_versions():
+    """
+    :return: sorted list of the migration versions recorded in the database
+    """
+    with transaction() as cur:
+        _ensure_version_table(cur)
+        cur.execute('SELECT version FROM schema_migrations ORDER BY version')
+        return [row[0] for row in cur.fetchall()]
+
+
+def migrate(target=None, concurrently=False):
+    """
+    applies every pending migration up to and including target
+    :param target: highest version to apply, defaults to all of them
+    :param concurrently: build indexes with CREATE INDEX CONCURRENTLY. Ignored when called inside a transaction
+    :return: list of versions applied
+    """
+    session = current_session()
+    if session is not None:
+        # joining the caller's transaction, so everything commits or rolls back with it
+        cur = session.cursor
+        cur.execute('SELECT pg_advisory_xact_lock(%s)', (MIGRATION_LOCK,))
+        _ensure_version_table(cur)
+        applied = []
+        for migration in _pending(cur, target):
+            _apply(cur, migration, False)
+            applied.append(migration.version)
+        return applied
+
+    with borrow() as conn:
+        # each migration manages its own transaction, which CREATE INDEX CONCURRENTLY needs
+        conn.autocommit = True
+        cur = conn.cursor()
+        try:
+            cur.execute('SELECT pg_advisory_lock(%s)', (MIGRATION_LOCK,))
+            try:
+                _ensure_version_table(cur)
+                applied = []
+                for migration in _pending(cur, target):
+                    run_concurrently = concurrently and any(isinstance(step, Index) for step in migration.steps)
+                    if run_concurrently:
+                        _apply(cur, migration, True)
+                    else:
+                        cur.execute('BEGIN')
+                        try:
+                            _apply(cur, migration, False)
+                        except BaseException:
+                            cur.execute('ROLLBACK')
+                            raise
+                        cur.execute('COMMIT')
+                    applied.append(migration.version)
+                return applied
+            finally:
+                cur.execute('SELECT pg_advisory_unlock(%s)', (MIGRATION_LOCK,))
+        finally:
+            conn.autocommit = False
+
+
+def drop_schema():
+    """
+    drops every chat table, including the migration history
+    """
+    with transaction() as cur:
+        cur.execute('DROP TABLE IF EXISTS ' + ', '.join(TABLES))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', type=int, default=None, help='highest migration version to apply')
+    parser.add_argument('--concurrently', action='store_true', help='build indexes without blocking writes')
+    args = parser.parse_args()
+    applied = migrate(args.target, args.concurrently)
+    if applied:
+        print('Applied migrations ' + ', '.join(str(version) for version in applied))
+    else:
+        print('Schema is up to date')
+
+
+if __name__ == '__main__':
+    main()
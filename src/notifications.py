@@ -0,0 +1,286 @@
+"""
+Push delivery of new posts and direct messages with Postgres LISTEN/NOTIFY.
+
+The write paths NOTIFY the chat_events channel from the statements that write, so events are sent when the write
+commits and never for one that rolls back. Payloads are compact JSON:
+
+    {"type": "post", "id": 12, "user": "lex12345", "community": "Metropolis", "channel": "DailyPlanet",
+     "mentioned": ["clarknotsuperman"]}
+    {"type": "message", "id": 8, "user": "lex12345", "receiver": "Moe1234"}
+    {"type": "messages", "user": "Abbott1234", "receiver": "Costello1234"}    bulk sends and imports, one per pair
+
+A process holds one LISTEN connection however many subscribers it has. Each subscription takes the events for one
+user (their direct messages and the posts mentioning them), one channel, one community, or everything:
+
+    with notifications.subscribe(user='Moe1234') as events:
+        for event in events:
+            print(event.type, event.id)
+
+or pass callback= to have events handed to a function on the listener thread instead. Events sent while the
+connection was down are lost; subscribers get a "reconnected" event afterwards and should read what they missed.
+"""
+import json
+import queue
+import select
+import sys
+import threading
+from collections import namedtuple
+
+import psycopg2
+
+from src.swen344_db_utils import connect
+
+CHANNEL = 'chat_events'
+# NOTIFY payloads must stay under 8000 bytes, so longer mention lists are left out of post events
+MAX_NOTIFY_MENTIONS = 200
+POLL_SECONDS = 0.5
+RECONNECT_SECONDS = 1.0
+# how long subscribe() waits for the LISTEN connection before giving up
+LISTEN_TIMEOUT = 10.0
+MAX_EVENTS = 1000
+
+POST, MESSAGE, MESSAGES, RECONNECTED = 'post', 'message', 'messages', 'reconnected'
+
+Event = namedtuple('Event', ['type', 'id', 'user', 'receiver', 'community', 'channel', 'mentioned'],
+                   defaults=(None,) * 6)
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+class Subscription:
+    """
+    the events matching one filter. Iterate it, or call get(), unless it was made with a callback
+    """
+
+    def __init__(self, listener, callback, user, community, channel, max_events):
+        self.user = user
+        self.community = community
+        self.channel = channel
+        self.dropped = 0
+        self._listener = listener
+        self._callback = callback
+        self._events = queue.Queue(max_events) if callback is None else None
+        self._closed = False
+
+    def _deliver(self, event):
+        if self._callback is not None:
+            try:
+                self._callback(event)
+            except Exception as error:
+                sys.stderr.write('notification callback failed: %r\n' % error)
+            return
+        try:
+            self._events.put_nowait(event)
+        except queue.Full:
+            # a subscriber that falls behind loses events rather than holding up everyone else
+            self.dropped += 1
+
+    def get(self, timeout=None):
+        """
+        :param timeout: seconds to wait, None to wait as long as it takes
+        :return: the next Event, or None if none came in time or the subscription is closed
+        :raises TypeError: for a subscription made with a callback, whose events go to the callback instead
+        """
+        if self._events is None:
+            raise TypeError('events of a callback subscription are handed to its callback, not queued')
+        try:
+            event = self._events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        return event
+
+    def __iter__(self):
+        while not self._closed:
+            event = self.get(POLL_SECONDS)
+            if event is not None:
+                yield event
+
+    def close(self):
+        """stops delivery to this subscription"""
+        self._closed = True
+        self._listener.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Listener:
+    """
+    one LISTEN connection, read by a background thread that hands each event to the subscriptions it matches
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._everything = set()
+        self._by_user = {}
+        self._by_community = {}
+        self._by_channel = {}
+        self._conn = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._listening = threading.Event()
+        # why the last connection attempt failed, reported if subscribe() times out
+        self._error = None
+
+    def subscribe(self, user=None, community=None, channel=None, callback=None, max_events=MAX_EVENTS,
+                  timeout=LISTEN_TIMEOUT):
+        """
+        :param user: deliver the direct messages sent to this user and the posts mentioning them
+        :param community: deliver the posts in this community
+        :param channel: with community, deliver only the posts in this channel
+        :param callback: function called with each Event on the listener thread, in place of queueing them
+        :param max_events: events queued for the subscriber before newer ones are dropped
+        :param timeout: seconds to wait for the LISTEN connection
+        :return: Subscription, listening once this returns
+        :raises TimeoutError: if the connection was not listening within timeout, e.g. as the database is down
+        """
+        if channel is not None and community is None:
+            raise ValueError('a channel subscription needs its community')
+        if user is not None and community is not None:
+            raise ValueError('subscribe to a user or to a community, not both')
+        subscription = Subscription(self, callback, user, community, channel, max_events)
+        with self._lock:
+            self._index(subscription).add(subscription)
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self._run, name='chat-notifications', daemon=True)
+                self._thread.start()
+        if not self._listening.wait(timeout):
+            self.unsubscribe(subscription)
+            raise TimeoutError('not listening for notifications after %s seconds: %s' % (timeout, self._error))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._index(subscription).discard(subscription)
+
+    def close(self):
+        """stops listening and closes the connection"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stopped.set()
+            thread.join()
+
+    def _index(self, subscription):
+        if subscription.user is not None:
+            return self._by_user.setdefault(subscription.user, set())
+        if subscription.channel is not None:
+            return self._by_channel.setdefault((subscription.community, subscription.channel), set())
+        if subscription.community is not None:
+            return self._by_community.setdefault(subscription.community, set())
+        return self._everything
+
+    def _matching(self, event):
+        with self._lock:
+            matched = set(self._everything)
+            if event.type == POST:
+                matched.update(self._by_community.get(event.community, ()))
+                matched.update(self._by_channel.get((event.community, event.channel), ()))
+                if event.mentioned is None:
+                    # the mention list was too long to send, so every user subscriber checks for themselves
+                    for subscriptions in self._by_user.values():
+                        matched.update(subscriptions)
+                else:
+                    for user in event.mentioned:
+                        matched.update(self._by_user.get(user, ()))
+            elif event.type in (MESSAGE, MESSAGES):
+                matched.update(self._by_user.get(event.receiver, ()))
+            else:
+                for index in (self._by_user, self._by_community, self._by_channel):
+                    for subscriptions in index.values():
+                        matched.update(subscriptions)
+        return matched
+
+    def _dispatch(self, event):
+        for subscription in self._matching(event):
+            subscription._deliver(event)
+
+    def _connect(self):
+        conn = connect()
+        conn.autocommit = True
+        conn.cursor().execute('LISTEN ' + CHANNEL)
+        self._conn = conn
+
+    def _disconnect(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except psycopg2.Error:
+                pass
+            self._conn = None
+
+    def _run(self):
+        reconnecting = False
+        try:
+            while not self._stopped.is_set():
+                try:
+                    if self._conn is None:
+                        self._connect()
+                        self._error = None
+                        self._listening.set()
+                        if reconnecting:
+                            self._dispatch(Event(RECONNECTED))
+                            reconnecting = False
+                    if select.select([self._conn], [], [], POLL_SECONDS) == ([], [], []):
+                        continue
+                    self._conn.poll()
+                    while self._conn.notifies:
+                        notify = self._conn.notifies.pop(0)
+                        try:
+                            self._dispatch(parse_event(notify.payload))
+                        except (ValueError, TypeError) as error:
+                            # one bad payload, from another writer on the channel, must not stop the others
+                            sys.stderr.write('ignoring notification %r: %r\n' % (notify.payload, error))
+                except (psycopg2.OperationalError, psycopg2.InterfaceError) as error:
+                    self._error = error
+                    self._listening.clear()
+                    self._disconnect()
+                    reconnecting = True
+                    self._stopped.wait(RECONNECT_SECONDS)
+        finally:
+            self._disconnect()
+            self._listening.clear()
+
+
+def parse_event(payload):
+    """
+    :param payload: JSON payload of a chat_events notification
+    :return: Event, without any keys it does not know
+    :raises ValueError: if the payload is not a JSON object with a type
+    """
+    fields = json.loads(payload)
+    if not isinstance(fields, dict) or not isinstance(fields.get('type'), str):
+        raise ValueError('not an event')
+    return Event(**{name: value for name, value in fields.items() if name in Event._fields})
+
+
+def get_listener():
+    """
+    :return: the process-wide Listener
+    """
+    global _listener
+    if _listener is None:
+        with _listener_lock:
+            if _listener is None:
+                _listener = Listener()
+    return _listener
+
+
+def subscribe(user=None, community=None, channel=None, callback=None, max_events=MAX_EVENTS, timeout=LISTEN_TIMEOUT):
+    """
+    subscribes to the events for a user, a channel or a community, or to every event if none is given.
+    See Listener.subscribe
+    :return: Subscription
+    """
+    return get_listener().subscribe(user, community, channel, callback, max_events, timeout)
+
+
+def shutdown():
+    """stops the listener thread and closes its connection. The next subscribe() starts them again"""
+    if _listener is not None:
+        _listener.close()
@@ -0,0 +1,268 @@
+"""
+Range partitioning of channel_posts and direct_messages by time_sent, with archival of old partitions.
+
+Each table gets a partition per month (or quarter, or year) and a DEFAULT partition that catches rows no period
+partition covers yet. maintain() creates the partitions for the coming periods and splits any rows that landed in
+the default partition out into partitions of their own, so it should run regularly. archive() detaches the
+partitions older than a cutoff, writes each one to a gzipped CSV file and drops it, so queries and vacuum only ever
+see recent history.
+
+Set the partitioning section of config/db.yml to have rebuild_tables() partition new tables:
+
+    partitioning:
+      granularity: month   # month, quarter or year
+      ahead: 3             # future periods to keep a partition ready for
+
+and convert, maintain and archive an existing database with
+
+    python -m src.partitions partition [--granularity month] [--ahead 3]
+    python -m src.partitions maintain [--ahead 3]
+    python -m src.partitions archive --before 2019-01-01 [--directory archive]
+
+The primary keys of partitioned tables include time_sent, so message and post ids are no longer checked for
+uniqueness across periods; ids from their sequences are still unique.
+"""
+import argparse
+import gzip
+import os
+import re
+from collections import namedtuple
+from datetime import datetime
+
+from dateutil.relativedelta import relativedelta
+
+from src.cache import clear_caches
+from src.migrations import MIGRATIONS, SEARCH_CONFIG, Index, index_sql, is_partitioned
+from src.swen344_db_utils import load_config, transaction
+
+# months covered by one partition
+GRANULARITIES = {'month': 1, 'quarter': 3, 'year': 12}
+DEFAULT_GRANULARITY = 'month'
+DEFAULT_AHEAD = 3
+ARCHIVE_DIR = 'archive'
+
+# partitionable table -> (id column, column its search_vector is built from)
+PARTITIONABLE = {'channel_posts': ('id', 'text'), 'direct_messages': ('message_id', 'message')}
+
+ArchivedPartition = namedtuple('ArchivedPartition', ['table', 'partition', 'rows', 'path'])
+
+_BOUNDS = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+# (column, sequence) of each column of a table that takes its default from a sequence it owns
+_SERIAL_COLUMNS = """
+    SELECT column_name, pg_get_serial_sequence(quote_ident(table_name), column_name) FROM information_schema.columns
+    WHERE table_schema = current_schema() AND table_name = %s AND column_default LIKE 'nextval(%%'
+    ORDER BY column_name
+"""
+
+
+def configured():
+    """
+    :return: the partitioning section of db.yml, or None when new tables are not partitioned
+    """
+    return load_config().get('partitioning')
+
+
+def period_start(at, granularity):
+    """
+    :return: start of the period containing at
+    """
+    months = GRANULARITIES[granularity]
+    return datetime(at.year, (at.month - 1) // months * months + 1, 1)
+
+
+def partition_name(table, start, granularity):
+    if granularity == 'year':
+        return '%s_p%d' % (table, start.year)
+    if granularity == 'quarter':
+        return '%s_p%d_q%d' % (table, start.year, (start.month - 1) // 3 + 1)
+    return '%s_p%d_%02d' % (table, start.year, start.month)
+
+
+def partitions(cur, table):
+    """
+    :return: sorted list of (partition name, start, end) for the period partitions of table
+    """
+    cur.execute('SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) FROM pg_inherits '
+                'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+                'WHERE pg_inherits.inhparent = to_regclass(%s)', (table,))
+    found = []
+    for name, bounds in cur.fetchall():
+        match = _BOUNDS.search(bounds)
+        if match:
+            found.append((name,) + tuple(datetime.strptime(value, '%Y-%m-%d %H:%M:%S') for value in match.groups()))
+    return sorted(found, key=lambda partition: partition[1])
+
+
+def _granularities(cur):
+    cur.execute('SELECT table_name, granularity FROM partitioned_tables ORDER BY table_name')
+    return cur.fetchall()
+
+
+def _search_trigger(cur, table, partition):
+    # partitioned tables only take BEFORE ROW triggers from PostgreSQL 13, so every partition gets its own
+    cur.execute("CREATE TRIGGER {partition}_search_vector BEFORE INSERT OR UPDATE OF {column} ON {partition} "
+                "FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger(search_vector, 'pg_catalog.{config}', {column})"
+                .format(partition=partition, column=PARTITIONABLE[table][1], config=SEARCH_CONFIG))
+
+
+def _create_partition(cur, table, start, granularity):
+    """
+    creates the partition for the period starting at start, moving its rows out of the default partition first
+    so the new partition can be attached
+    """
+    end = start + relativedelta(months=GRANULARITIES[granularity])
+    name = partition_name(table, start, granularity)
+    cur.execute('CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS)'.format(name=name, table=table))
+    cur.execute('WITH moved AS (DELETE FROM {table}_default WHERE time_sent >= %s AND time_sent < %s RETURNING *) '
+                'INSERT INTO {name} SELECT * FROM moved'.format(name=name, table=table), (start, end))
+    cur.execute('ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)'
+                .format(name=name, table=table), (start, end))
+    _search_trigger(cur, table, name)
+    return name
+
+
+def _maintain_table(cur, table, granularity, ahead, at):
+    existing = {partition[1] for partition in partitions(cur, table)}
+    cur.execute('SELECT DISTINCT date_trunc(%s, time_sent) FROM {table}_default'.format(table=table), (granularity,))
+    wanted = {row[0] for row in cur.fetchall()}
+    current = period_start(at, granularity)
+    wanted.update(current + relativedelta(months=GRANULARITIES[granularity] * n) for n in range(ahead + 1))
+    return [_create_partition(cur, table, start, granularity) for start in sorted(wanted - existing)]
+
+
+def maintain(ahead=None, at=None):
+    """
+    creates the partitions for the current period and the next ahead periods, and moves rows out of the default
+    partitions into partitions for their periods
+    :param ahead: future periods to create, defaults to the configured ahead
+    :param at: time to count periods from, defaults to now
+    :return: list of the partitions created
+    """
+    ahead = ahead if ahead is not None else (configured() or {}).get('ahead', DEFAULT_AHEAD)
+    at = at or datetime.now()
+    created = []
+    with transaction() as cur:
+        for table, granularity in _granularities(cur):
+            created.extend(_maintain_table(cur, table, granularity, ahead, at))
+    return created
+
+
+def _partition_table(cur, table, granularity):
+    id_column = PARTITIONABLE[table][0]
+    cur.execute('ALTER TABLE {table} RENAME TO {table}_unpartitioned'.format(table=table))
+    cur.execute('CREATE TABLE {table} (LIKE {table}_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (time_sent)'
+                .format(table=table))
+    cur.execute('CREATE TABLE {table}_default PARTITION OF {table} DEFAULT'.format(table=table))
+    cur.execute('INSERT INTO {table} SELECT * FROM {table}_unpartitioned'.format(table=table))
+    # the id sequence, and direct_messages' seq sequence, would otherwise be dropped with the old table
+    cur.execute(_SERIAL_COLUMNS, (table + '_unpartitioned',))
+    for column, sequence in cur.fetchall():
+        cur.execute('ALTER SEQUENCE {sequence} OWNED BY {table}.{column}'
+                    .format(sequence=sequence, table=table, column=column))
+    cur.execute('DROP TABLE {table}_unpartitioned'.format(table=table))
+    cur.execute('ALTER TABLE {table} ADD PRIMARY KEY ({column}, time_sent)'.format(table=table, column=id_column))
+    for migration in MIGRATIONS:
+        for step in migration.steps:
+            if isinstance(step, Index) and step.table == table:
+                cur.execute(index_sql(step))
+    _search_trigger(cur, table, table + '_default')
+    cur.execute('INSERT INTO partitioned_tables (table_name, granularity) VALUES (%s, %s)', (table, granularity))
+
+
+def partition_tables(granularity=None, ahead=None, at=None):
+    """
+    converts channel_posts and direct_messages into tables range partitioned by time_sent, keeping their rows.
+    Tables that are already partitioned are left as they are
+    :param granularity: period of one partition, one of GRANULARITIES. Defaults to the configured granularity
+    :param ahead: future periods to create partitions for, defaults to the configured ahead
+    :param at: time to count periods from, defaults to now
+    :return: list of the partitions created
+    """
+    settings = configured() or {}
+    granularity = granularity or settings.get('granularity', DEFAULT_GRANULARITY)
+    if granularity not in GRANULARITIES:
+        raise ValueError('granularity must be one of ' + ', '.join(GRANULARITIES))
+    with transaction() as cur:
+        for table in PARTITIONABLE:
+            if not is_partitioned(cur, table):
+                _partition_table(cur, table, granularity)
+        return maintain(ahead, at)
+
+
+def _export(cur, partition, path):
+    cur.execute("SELECT column_name FROM information_schema.columns "
+                "WHERE table_schema = current_schema() AND table_name = %s AND column_name <> 'search_vector' "
+                "ORDER BY ordinal_position", (partition,))
+    columns = ', '.join(row[0] for row in cur.fetchall())
+    with gzip.open(path, 'wt', newline='') as file:
+        cur.copy_expert('COPY (SELECT {columns} FROM {partition}) TO STDOUT WITH (FORMAT csv, HEADER)'
+                        .format(columns=columns, partition=partition), file)
+    cur.execute('SELECT COUNT(*) FROM ' + partition)
+    return cur.fetchone()[0]
+
+
+def archive(before, directory=ARCHIVE_DIR):
+    """
+    detaches every partition that ends on or before the cutoff, writes it to DIRECTORY/PARTITION.csv.gz and
+    drops it. The unread rows and mentions of archived posts are deleted with them. Each partition is archived
+    in its own transaction, after its file is written.
+    Run chat.reconcile_unread_counts() afterwards, as archived messages and posts no longer count as unread
+    :param before: datetime or 'YYYY-MM-DD'
+    :param directory: where the archive files are written
+    :return: list of ArchivedPartition
+    """
+    if isinstance(before, str):
+        before = datetime.strptime(before, '%Y-%m-%d')
+    # rows sitting in a default partition are archived too once they have a partition of their own
+    maintain(ahead=0)
+    os.makedirs(directory, exist_ok=True)
+    with transaction() as cur:
+        old = [(table, partition[0]) for table, granularity in _granularities(cur)
+               for partition in partitions(cur, table) if partition[2] <= before]
+    archived = []
+    for table, partition in old:
+        path = os.path.join(directory, partition + '.csv.gz')
+        with transaction() as cur:
+            cur.execute('ALTER TABLE {table} DETACH PARTITION {partition}'.format(table=table, partition=partition))
+            rows = _export(cur, partition, path)
+            if table == 'channel_posts':
+                for dependent in ('unread_posts', 'mentions'):
+                    cur.execute('DELETE FROM {dependent} USING {partition} '
+                                'WHERE {dependent}.post_id = {partition}.id::VARCHAR'
+                                .format(dependent=dependent, partition=partition))
+            cur.execute('DROP TABLE ' + partition)
+        archived.append(ArchivedPartition(table, partition, rows, path))
+    if archived:
+        # cached channel history may hold archived posts
+        clear_caches()
+    return archived
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    partition = commands.add_parser('partition', help='partition channel_posts and direct_messages')
+    partition.add_argument('--granularity', choices=sorted(GRANULARITIES))
+    partition.add_argument('--ahead', type=int)
+    commands.add_parser('maintain', help='create upcoming partitions').add_argument('--ahead', type=int)
+    archiving = commands.add_parser('archive', help='export and drop old partitions')
+    archiving.add_argument('--before', required=True, help='YYYY-MM-DD, partitions ending by then are archived')
+    archiving.add_argument('--directory', default=ARCHIVE_DIR)
+    args = parser.parse_args()
+    if args.command == 'archive':
+        # imported here, as src.chat imports this module
+        from src.chat import reconcile_unread_counts
+        for table, partition, rows, path in archive(args.before, args.directory):
+            print('Archived %d rows of %s to %s' % (rows, partition, path))
+        reconcile_unread_counts()
+        return
+    if args.command == 'partition':
+        created = partition_tables(args.granularity, args.ahead)
+    else:
+        created = maintain(args.ahead)
+    print('Created ' + ', '.join(created) if created else 'No partitions needed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+Suspension checks answered from memory.
+
+Every suspension interval, global (users.suspended_since/till) and per community (the suspensions table), is loaded
+into one SuspensionIndex, which answers "is this user suspended in this community at this time" with a binary search
+and no database round trip. The index is held in a cache entry: suspend_user and resume_user invalidate it, and its
+TTL bounds how long a change made by another process can go unseen.
+"""
+import bisect
+from datetime import datetime
+
+from src.cache import get_cache
+from src.swen344_db_utils import exec_get_all
+
+# scope of the suspensions that apply in every community
+GLOBAL = None
+
+_index_cache = get_cache('suspension_index', maxsize=1)
+
+
+class SuspensionIndex:
+    """
+    suspension intervals by (user_id, community), with GLOBAL as the community of global suspensions.
+    A user is suspended at a time strictly between an interval's start and end
+    """
+
+    def __init__(self, rows):
+        """
+        :param rows: iterable of (user_id, community or GLOBAL, start, end)
+        """
+        intervals = {}
+        for user_id, community, start, end in rows:
+            if start is not None and end is not None and start < end:
+                intervals.setdefault((user_id, community), []).append((start, end))
+        self._starts = {}
+        self._intervals = {}
+        for key, spans in intervals.items():
+            merged = []
+            for start, end in sorted(spans):
+                if merged and start < merged[-1][1]:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+                else:
+                    merged.append((start, end))
+            self._intervals[key] = merged
+            self._starts[key] = [span[0] for span in merged]
+
+    def __len__(self):
+        return sum(len(spans) for spans in self._intervals.values())
+
+    def _covering(self, key, at):
+        spans = self._intervals.get(key)
+        if not spans:
+            return None
+        i = bisect.bisect_left(self._starts[key], at)
+        if i and at < spans[i - 1][1]:
+            return spans[i - 1][1]
+        return None
+
+    def suspended_until(self, user_id, community, at):
+        """
+        :param community: community to check, or GLOBAL for global suspensions only
+        :return: end of the suspension covering at, or None if the user is not suspended then
+        """
+        ends = [end for end in (self._covering((user_id, GLOBAL), at),
+                                self._covering((user_id, community), at) if community is not GLOBAL else None)
+                if end is not None]
+        return max(ends) if ends else None
+
+    def is_suspended(self, user_id, community, at):
+        return self.suspended_until(user_id, community, at) is not None
+
+
+def load_index():
+    """
+    :return: SuspensionIndex over every suspension in the database
+    """
+    return SuspensionIndex(exec_get_all(
+        'SELECT user_id, NULL, suspended_since, suspended_till FROM users '
+        'WHERE suspended_since IS NOT NULL AND suspended_till IS NOT NULL '
+        'UNION ALL '
+        'SELECT user_id, community_name, suspended_since, suspended_till FROM suspensions '
+        'WHERE suspended_since IS NOT NULL AND suspended_till IS NOT NULL'))
+
+
+def get_index():
+    """
+    :return: the cached SuspensionIndex, loading it on first use or after an invalidation
+    """
+    return _index_cache.get_or_load('index', load_index)
+
+
+def invalidate():
+    """drops the index so the next check reloads it. Call after writing suspensions"""
+    _index_cache.invalidate('index')
+
+
+def _time(at):
+    if at is None:
+        return datetime.now()
+    if isinstance(at, str):
+        return datetime.strptime(at, '%Y-%m-%d %H:%M:%S')
+    return at
+
+
+def suspended_until(user_id, community=GLOBAL, at=None):
+    """
+    :param user_id: user to check
+    :param community: community to check, or GLOBAL for global suspensions only
+    :param at: datetime or 'YYYY-MM-DD HH:MM:SS', defaults to now
+    :return: when the suspension covering at ends, or None
+    """
+    return get_index().suspended_until(user_id, community, _time(at))
+
+
+def is_suspended(user_id, community=GLOBAL, at=None):
+    """
+    :return: whether the user is suspended, globally or in community, at the given time (default now)
+    """
+    return suspended_until(user_id, community, at) is not None
+
+
+def suspended_users(user_ids, community=GLOBAL, at=None):
+    """
+    checks many users against one index lookup
+    :param user_ids: iterable of user ids
+    :param community: community to check, or GLOBAL for global suspensions only
+    :param at: datetime or 'YYYY-MM-DD HH:MM:SS', defaults to now
+    :return: dict of user id -> end of their suspension, for the suspended users only
+    """
+    index = get_index()
+    at = _time(at)
+    suspended = {}
+    for user_id in user_ids:
+        end = index.suspended_until(user_id, community, at)
+        if end is not None:
+            suspended[user_id] = end
+    return suspended
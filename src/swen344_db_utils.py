@@ -1,13 +1,82 @@
+import functools
+import itertools
+import os
+import re
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
 import yaml
-import os
+
+from src import instrumentation
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), '../config/db.yml')
+# names a database to use in place of the one in db.yml, e.g. for a parallel test worker and the processes it starts
+DATABASE_ENV = 'CHAT_DATABASE'
+
+# defaults for the optional "pool" section of config/db.yml
+POOL_DEFAULTS = {
+    'min_size': 1,
+    'max_size': 10,
+    'max_idle': 300,     # seconds an idle connection is kept above min_size
+    'check_after': 30,   # seconds idle before a checkout pings the server
+    'timeout': 30,       # seconds to wait for a free connection
+}
+
+_config = None
+_config_lock = threading.Lock()
+_pool = None
+_pool_lock = threading.Lock()
+_local = threading.local()
+_stream_ids = itertools.count()
+# connection -> names of the statements prepared on it. A connection the pool replaces starts with none
+_prepared = weakref.WeakKeyDictionary()
+_prepared_lock = threading.Lock()
+_statements = {}
+_PARAMETER = re.compile(r'%%|%\((\w+)\)s|%s')
+_COPY_OUT = re.compile(r'\bTO\s+STDOUT\b', re.IGNORECASE)
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    """raised when no connection could be borrowed within the pool timeout"""
+
+
+def load_config():
+    """
+    parses config/db.yml the first time it is needed and caches it for the process
+    :return: dict of connection settings
+    """
+    global _config
+    if _config is None:
+        with _config_lock:
+            if _config is None:
+                with open(CONFIG_PATH, 'r') as file:
+                    config = yaml.load(file, Loader=yaml.FullLoader)
+                if os.environ.get(DATABASE_ENV):
+                    config['database'] = os.environ[DATABASE_ENV]
+                _config = config
+    return _config
+
+
+def use_database(name):
+    """
+    points this process at another database on the same server, closing the pooled connections to the old one
+    :param name: database name
+    """
+    close_pool()
+    load_config()['database'] = name
 
 
 def connect():
-    config = {}
-    yml_path = os.path.join(os.path.dirname(__file__), '../config/db.yml')
-    with open(yml_path, 'r') as file:
-        config = yaml.load(file, Loader=yaml.FullLoader)
+    """
+    opens a new, unpooled connection. Prefer borrow() for anything short-lived
+    """
+    config = load_config()
+    instrumentation.record_connection()
     return psycopg2.connect(dbname=config['database'],
                             user=config['user'],
                             password=config['password'],
@@ -15,39 +84,489 @@ def connect():
                             port=config['port'])
 
 
+class ConnectionPool:
+    """
+    thread-safe pool of connections.
+    Connections are health checked on checkout and idle ones above min_size are closed after max_idle seconds.
+    """
+
+    def __init__(self, min_size=1, max_size=10, max_idle=300, check_after=30, timeout=30, connect_fn=connect):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError('pool sizes must satisfy 0 <= min_size <= max_size and max_size >= 1')
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.timeout = timeout
+        self._connect = connect_fn
+        self._idle = []  # (connection, time it was returned), most recently used last
+        self._size = 0
+        self._closed = False
+        self.pid = os.getpid()
+        self._cond = threading.Condition()
+        for i in range(min_size):
+            self._idle.append((self._open(), time.monotonic()))
+
+    def _open(self):
+        conn = self._connect()
+        with self._cond:
+            self._size += 1
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.check_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _evict_idle(self):
+        """closes connections that have sat idle longer than max_idle, keeping min_size alive. Caller holds the lock"""
+        now = time.monotonic()
+        keep = []
+        evicted = []
+        # the oldest connections are at the front of the list
+        for conn, returned_at in self._idle:
+            if now - returned_at > self.max_idle and self._size - len(evicted) > self.min_size:
+                evicted.append(conn)
+            else:
+                keep.append((conn, returned_at))
+        self._idle = keep
+        self._size -= len(evicted)
+        return evicted
+
+    def getconn(self):
+        """
+        checks a connection out of the pool, opening a new one if the pool is below max_size
+        :return: psycopg2 connection
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            candidate = None
+            with self._cond:
+                if self._closed:
+                    raise psycopg2.InterfaceError('connection pool is closed')
+                evicted = self._evict_idle()
+                if self._idle:
+                    candidate = self._idle.pop()
+                elif self._size < self.max_size:
+                    self._size += 1
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout('no connection available after %s seconds' % self.timeout)
+                    self._cond.wait(remaining)
+                    continue
+            for conn in evicted:
+                conn.close()
+            if candidate is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            conn, returned_at = candidate
+            if self._healthy(conn, returned_at):
+                return conn
+            self._discard(conn)
+
+    def putconn(self, conn):
+        """
+        returns a connection to the pool, rolling back anything left open on it
+        :param conn: connection previously returned by getconn()
+        """
+        if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                conn.close()
+        if conn.closed or self._closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            evicted = self._evict_idle()
+            self._cond.notify()
+        for idle_conn in evicted:
+            idle_conn.close()
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle = self._idle
+            self._idle = []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, returned_at in idle:
+            conn.close()
+
+
+def get_pool():
+    """
+    returns the process-wide connection pool, building it from config on first use.
+    A forked child gets a fresh pool instead of sharing its parent's sockets.
+    """
+    global _pool
+    pool = _pool
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                settings = dict(POOL_DEFAULTS)
+                settings.update(load_config().get('pool') or {})
+                _pool = ConnectionPool(**settings)
+            pool = _pool
+    return pool
+
+
+def close_pool():
+    """closes every pooled connection. The next borrow() builds a new pool"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            if _pool.pid == os.getpid():
+                _pool.closeall()
+            _pool = None
+
+
+@contextmanager
+def borrow():
+    """
+    borrows a pooled connection for the duration of a with block
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    instrumentation.record_checkout()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """
+    cursor that reports each statement, the rows it returned and its time to the operation being profiled, if any.
+    See src/instrumentation.py
+    """
+
+    def _returned(self):
+        # rows affected by a write are not returned; a named cursor's rows are counted as exec_stream yields them
+        return max(self.rowcount, 0) if self.description is not None and self.name is None else 0
+
+    def execute(self, query, vars=None):
+        if not instrumentation.recording():
+            return super().execute(query, vars)
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            instrumentation.record_statement(_statement_sql(query), self._returned(), time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        if not instrumentation.recording():
+            return super().executemany(query, vars_list)
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            instrumentation.record_statement(query, self._returned(), time.perf_counter() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        if not instrumentation.recording():
+            return super().copy_expert(sql, file, size)
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            returned = max(self.rowcount, 0) if _COPY_OUT.search(sql) else 0
+            instrumentation.record_statement(sql, returned, time.perf_counter() - start)
+
+
+def _statement_sql(query):
+    """reports an EXECUTE of a registered prepared statement under the statement's own SQL"""
+    if isinstance(query, str) and query.startswith('EXECUTE '):
+        statement = _statements.get(query.split(None, 2)[1])
+        if statement is not None:
+            return statement.sql
+    return query
+
+
+class Session:
+    """
+    a unit of work: one pooled connection and cursor shared by every helper called inside a transaction() block
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.cursor(cursor_factory=InstrumentedCursor)
+        self.on_end = []
+        self.committed = False
+        # whether a prepared statement has run in this transaction, showing the server still holds them
+        self.prepared_checked = False
+
+
+def current_session():
+    """
+    :return: the Session open on this thread, or None outside of a transaction() block
+    """
+    return getattr(_local, 'session', None)
+
+
+@contextmanager
+def transaction():
+    """
+    runs the with block as a single transaction on one connection and yields its cursor.
+    It commits when the outermost block exits cleanly and rolls back if it raises.
+    Nested blocks, and any exec_* call made inside one, reuse the caller's cursor instead of borrowing another
+    """
+    session = current_session()
+    if session is not None:
+        yield session.cursor
+        return
+    with instrumentation.operation('transaction'), borrow() as conn:
+        session = Session(conn)
+        _local.session = session
+        try:
+            yield session.cursor
+            conn.commit()
+            session.committed = True
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            _local.session = None
+            for callback in session.on_end:
+                callback()
+
+
+def after_transaction(callback):
+    """
+    runs callback once the current transaction has committed or rolled back, or straight away outside of one
+    """
+    session = current_session()
+    if session is None:
+        callback()
+    else:
+        session.on_end.append(callback)
+
+
+def after_commit(callback):
+    """
+    runs callback once the current transaction has committed, and not at all if it rolls back.
+    Outside of a transaction it runs straight away
+    """
+    session = current_session()
+    if session is None:
+        callback()
+    else:
+        session.on_end.append(lambda: session.committed and callback())
+
+
+def transactional(func):
+    """
+    decorator that runs func inside transaction(), joining the caller's transaction if there is one
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with instrumentation.operation(func.__name__), transaction():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class PreparedStatement:
+    """
+    a statement that is PREPAREd once per pooled connection and then run with EXECUTE, so the server skips
+    parsing and planning it on every call. Pass it to the exec_* helpers in place of the SQL text.
+    The SQL uses the usual psycopg2 placeholders, either all %s or all %(name)s
+    """
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        self.names = []
+        self.positional = 0
+        self.text = _PARAMETER.sub(self._number, sql)
+        if self.names and self.positional:
+            raise ValueError('prepared statement %s mixes %%s and %%(name)s placeholders' % name)
+        count = len(self.names) or self.positional
+        self.execute_sql = 'EXECUTE %s (%s)' % (name, ', '.join(['%s'] * count)) if count else 'EXECUTE ' + name
+
+    def _number(self, match):
+        if match.group(0) == '%%':
+            return '%'
+        if match.group(1) is None:
+            self.positional += 1
+            return '$%d' % self.positional
+        if match.group(1) not in self.names:
+            self.names.append(match.group(1))
+        return '$%d' % (self.names.index(match.group(1)) + 1)
+
+    def arguments(self, args):
+        if self.names:
+            return [args[name] for name in self.names]
+        return list(args)
+
+    def _prepare(self, cur, names):
+        # PREPARE is not undone by a rollback, so the statement stays on the connection from here on
+        cur.execute('PREPARE %s AS %s' % (self.name, self.text))
+        names.add(self.name)
+
+    def _retry(self, cur, names, arguments):
+        names.clear()
+        self._prepare(cur, names)
+        cur.execute(self.execute_sql, arguments)
+
+    def execute(self, cur, args):
+        """
+        runs the statement on cur, preparing it first if its connection has not seen it yet.
+        If the server has lost its prepared statements (DISCARD ALL, a proxy handing over another backend), they
+        are forgotten and this one is prepared again and retried once. A failed EXECUTE aborts the transaction, so
+        the first one in a transaction that already did other work runs under a savepoint; every prepared
+        statement goes at once, so later ones in the same transaction need none
+        """
+        if not prepared_statements_enabled():
+            cur.execute(self.sql, args)
+            return
+        conn = cur.connection
+        with _prepared_lock:
+            names = _prepared.setdefault(conn, set())
+        session = current_session()
+        checked = session is not None and session.conn is conn and session.prepared_checked
+        arguments = self.arguments(args)
+        if self.name not in names:
+            self._prepare(cur, names)
+            cur.execute(self.execute_sql, arguments)
+            return
+        if checked:
+            try:
+                cur.execute(self.execute_sql, arguments)
+            except psycopg2.errors.InvalidSqlStatementName:
+                # deallocated within this transaction, too late to retry: the next one prepares them again
+                names.clear()
+                raise
+            return
+        if conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            # the EXECUTE opens the transaction, so rolling it back loses nothing
+            try:
+                cur.execute(self.execute_sql, arguments)
+            except psycopg2.errors.InvalidSqlStatementName:
+                conn.rollback()
+                self._retry(cur, names, arguments)
+        else:
+            # a separate cursor, so the savepoint commands leave cur's results alone
+            savepoints = conn.cursor()
+            savepoints.execute('SAVEPOINT prepared_statement')
+            try:
+                cur.execute(self.execute_sql, arguments)
+            except psycopg2.errors.InvalidSqlStatementName:
+                savepoints.execute('ROLLBACK TO SAVEPOINT prepared_statement')
+                self._retry(cur, names, arguments)
+            savepoints.execute('RELEASE SAVEPOINT prepared_statement')
+        if session is not None and session.conn is conn:
+            session.prepared_checked = True
+
+
+def prepare(name, sql):
+    """
+    registers a statement to run as a server-side prepared statement
+    :param name: unique SQL identifier for the statement
+    :param sql: statement text with psycopg2 placeholders
+    :return: PreparedStatement to pass to exec_get_one, exec_get_all or exec_commit
+    """
+    statement = _statements.get(name)
+    if statement is not None:
+        if statement.sql != sql:
+            raise ValueError('prepared statement %s is already registered with different SQL' % name)
+        return statement
+    statement = _statements[name] = PreparedStatement(name, sql)
+    return statement
+
+
+def prepared_statements_enabled():
+    """
+    :return: prepared_statements from db.yml, default true. Turn it off behind a pooler that does not keep
+             sessions, such as pgbouncer in transaction mode
+    """
+    return load_config().get('prepared_statements', True)
+
+
+def _execute(cur, sql, args):
+    if isinstance(sql, PreparedStatement):
+        sql.execute(cur, args)
+    else:
+        cur.execute(sql, args)
+
+
 def exec_sql_file(path):
     full_path = os.path.join(os.path.dirname(__file__), f'../../{path}')
-    conn = connect()
-    cur = conn.cursor()
-    with open(full_path, 'r') as file:
-        cur.execute(file.read())
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        with open(full_path, 'r') as file:
+            cur.execute(file.read())
 
 
 def exec_get_one(sql, args={}):
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute(sql, args)
-    one = cur.fetchone()
-    conn.close()
+    with transaction() as cur:
+        _execute(cur, sql, args)
+        one = cur.fetchone()
     return one
 
 
 def exec_get_all(sql, args={}):
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute(sql, args)
-    # https://www.psycopg.org/docs/cursor.html#cursor.fetchall
-    list_of_tuples = cur.fetchall()
-    conn.close()
+    with transaction() as cur:
+        _execute(cur, sql, args)
+        # https://www.psycopg.org/docs/cursor.html#cursor.fetchall
+        list_of_tuples = cur.fetchall()
     return list_of_tuples
 
 
 def exec_commit(sql, args={}):
-    conn = connect()
-    cur = conn.cursor()
-    result = cur.execute(sql, args)
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        result = _execute(cur, sql, args)
     return result
+
+
+def exec_stream(sql, args={}, batch_size=1000):
+    """
+    yields the rows of a query from a server-side (named) cursor, fetching batch_size rows per round trip,
+    so memory use does not depend on the size of the result.
+    Inside a transaction() block it reads on that transaction's connection, otherwise it borrows one
+    for as long as the generator is open
+    """
+    session = current_session()
+    if session is not None:
+        yield from _stream(session.conn, sql, args, batch_size)
+        return
+    with borrow() as conn:
+        yield from _stream(conn, sql, args, batch_size)
+
+
+def _stream(conn, sql, args, batch_size):
+    cur = conn.cursor(name='stream_%d_%d' % (os.getpid(), next(_stream_ids)), cursor_factory=InstrumentedCursor)
+    cur.itersize = batch_size
+    returned = 0
+    try:
+        cur.execute(sql, args)
+        for row in cur:
+            returned += 1
+            yield row
+    finally:
+        instrumentation.record_rows(sql, returned)
+        if not conn.closed:
+            cur.close()
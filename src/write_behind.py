@@ -0,0 +1,306 @@
+"""
+Group commit for channel posts and direct messages.
+
+In write-behind mode, post_to_channel() and create_direct_message() return a Future straight away and the write is
+queued. Worker threads take the queued writes in batches, up to max_batch of them or whatever arrived within
+max_delay_ms of the first, and run each batch as one transaction, so a burst of writes pays for one commit instead of
+one each. A Future resolves to the string the chat function returns once its batch has committed. Writes without a
+time_sent are stamped when they are submitted, not when their batch runs.
+
+If any write in a batch raises, the batch is rolled back and its writes are retried one transaction each, so a bad
+write fails alone. More than one worker only pays off when writes rarely share users: a batch locks the unread
+counters of everyone its writes reach, in no particular order, so concurrent batches deadlock on shared counters and
+are run again. Writes from different workers' batches can also commit out of order.
+
+Settings come from the optional write_behind section of config/db.yml:
+
+    write_behind:
+      max_batch: 100             # writes per transaction
+      max_delay_ms: 5            # longest the first write of a batch waits for others
+      max_queue: 10000           # submitting blocks while this many writes are waiting
+      workers: 1                 # threads committing batches
+      synchronous_commit: true   # false commits without waiting for the WAL to reach disk: faster, but a server
+                                 # crash can lose the last moments of committed writes
+
+The queue is flushed when the process exits; call flush() to wait for the writes submitted so far.
+"""
+import atexit
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+from datetime import datetime
+
+import psycopg2.extensions
+
+from src import chat, instrumentation
+from src.swen344_db_utils import load_config, transaction
+
+# defaults for the optional "write_behind" section of config/db.yml
+WRITE_BEHIND_DEFAULTS = {
+    'max_batch': 100,
+    'max_delay_ms': 5,
+    'max_queue': 10000,
+    'workers': 1,
+    'synchronous_commit': True,
+}
+
+# times a batch that lost a deadlock or serialization failure to another worker's batch is run again
+TRANSIENT_RETRIES = 3
+
+_Write = namedtuple('_Write', ['future', 'func', 'args', 'kwargs'])
+# tells a worker to exit once everything queued before it is committed
+_STOP = object()
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def _now():
+    # in the format the chat functions parse, as they would stamp it themselves
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+class WriteBehindQueue:
+    """
+    bounded queue of chat writes, committed in batches by a pool of worker threads
+    """
+
+    def __init__(self, max_batch=100, max_delay_ms=5, max_queue=10000, workers=1, synchronous_commit=True):
+        if max_batch < 1 or max_queue < 1 or workers < 1 or max_delay_ms < 0:
+            raise ValueError('max_batch, max_queue and workers must be at least 1 and max_delay_ms not negative')
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.synchronous_commit = synchronous_commit
+        self._queue = queue.Queue(max_queue)
+        # held across a put, so close() cannot queue the stops ahead of a write still being submitted
+        self._submit_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._pending = 0
+        self._idle = threading.Condition(self._lock)
+        self._batches = 0
+        self._items = 0
+        self._largest_batch = 0
+        self._retried = 0
+        self._failed = 0
+        self._peak_depth = 0
+        self._commit_seconds = 0.0
+        self._workers = [threading.Thread(target=self._run, name='chat-write-behind-%d' % i, daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        queues a write, blocking while the queue is full
+        :param func: chat write function, run in the batch's transaction
+        :return: Future of what func returns
+        """
+        future = Future()
+        with self._submit_lock:
+            if self._closed:
+                raise RuntimeError('cannot submit to a closed write-behind queue')
+            with self._lock:
+                self._pending += 1
+            self._queue.put(_Write(future, func, args, kwargs))
+            depth = self._queue.qsize()
+        with self._lock:
+            self._peak_depth = max(self._peak_depth, depth)
+        return future
+
+    def post_to_channel(self, poster_id, channel, community, message, time_sent=None):
+        """
+        :param time_sent: defaults to when the post is submitted, not when its batch commits
+        :return: Future of the chat.post_to_channel result
+        """
+        return self.submit(chat.post_to_channel, poster_id, channel, community, message, time_sent or _now())
+
+    def create_direct_message(self, message_id, sender_id, receiver_id, time_sent, message):
+        """
+        :param time_sent: defaults to when the message is submitted, not when its batch commits
+        :return: Future of the chat.create_direct_message result
+        """
+        return self.submit(chat.create_direct_message, message_id, sender_id, receiver_id, time_sent or _now(),
+                           message)
+
+    def flush(self, timeout=None):
+        """
+        waits until every write submitted so far has committed or failed
+        :param timeout: seconds to wait, None to wait as long as it takes
+        :return: whether the queue drained in time
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def close(self, wait=True):
+        """
+        stops taking writes. The writes already queued are still committed
+        :param wait: block until they are
+        """
+        with self._submit_lock:
+            if self._closed:
+                return
+            self._closed = True
+        for worker in self._workers:
+            self._queue.put(_STOP)
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def stats(self):
+        """
+        :return: dict of the queue depth now and at its deepest, and the number and sizes of the batches committed
+        """
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'peak_queue_depth': self._peak_depth,
+                'batches': self._batches,
+                'items': self._items,
+                'mean_batch': self._items / self._batches if self._batches else 0.0,
+                'max_batch': self._largest_batch,
+                'retried_batches': self._retried,
+                'failed': self._failed,
+                'commit_seconds': self._commit_seconds,
+            }
+
+    def _next_batch(self):
+        """
+        :return: (writes, whether a stop was taken). Blocks for the first write, then collects more until the
+        batch is full or max_delay has passed
+        """
+        first = self._queue.get()
+        if first is _STOP:
+            return [], True
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                remaining = deadline - time.monotonic()
+                write = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if write is _STOP:
+                return batch, True
+            batch.append(write)
+        return batch, False
+
+    def _run(self):
+        while True:
+            batch, stop = self._next_batch()
+            running = [write for write in batch if write.future.set_running_or_notify_cancel()]
+            if running:
+                self._commit(running)
+            if len(running) < len(batch):
+                self._finished(len(batch) - len(running))
+            if stop:
+                return
+
+    def _transaction(self, writes):
+        """
+        runs writes in one transaction, running it again if it loses a deadlock to another worker's batch
+        :return: list of their results
+        """
+        for attempt in range(TRANSIENT_RETRIES + 1):
+            try:
+                # every write runs the same statements, so only repeats beyond one write's share are an N+1
+                with instrumentation.operation('write_behind_batch',
+                                               instrumentation.n_plus_one_threshold() * len(writes)), \
+                        transaction() as cur:
+                    if not self.synchronous_commit:
+                        cur.execute('SET LOCAL synchronous_commit = off')
+                    return [write.func(*write.args, **write.kwargs) for write in writes]
+            except psycopg2.extensions.TransactionRollbackError:
+                if attempt == TRANSIENT_RETRIES:
+                    raise
+
+    def _commit(self, batch):
+        started = time.perf_counter()
+        try:
+            results = self._transaction(batch)
+        except Exception:
+            self._retry(batch)
+        else:
+            for write, result in zip(batch, results):
+                write.future.set_result(result)
+        self._finished(len(batch), len(batch), time.perf_counter() - started)
+
+    def _retry(self, batch):
+        failed = 0
+        for write in batch:
+            try:
+                result = self._transaction([write])[0]
+            except Exception as error:
+                failed += 1
+                write.future.set_exception(error)
+            else:
+                write.future.set_result(result)
+        with self._lock:
+            self._retried += 1
+            self._failed += failed
+
+    def _finished(self, done, committed=0, seconds=0.0):
+        """
+        :param done: writes taken off the queue, committed or not
+        :param committed: size of the batch committed, 0 for writes that were cancelled
+        """
+        with self._idle:
+            if committed:
+                self._batches += 1
+                self._items += committed
+                self._largest_batch = max(self._largest_batch, committed)
+                self._commit_seconds += seconds
+            self._pending -= done
+            self._idle.notify_all()
+
+
+def get_queue():
+    """
+    :return: the process-wide write-behind queue, built from config on first use and flushed at exit
+    """
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                settings = dict(WRITE_BEHIND_DEFAULTS)
+                settings.update(load_config().get('write_behind') or {})
+                _queue = WriteBehindQueue(**settings)
+    return _queue
+
+
+def shutdown(wait=True):
+    """commits what is queued and stops the workers. The next write starts a new queue"""
+    global _queue
+    with _queue_lock:
+        if _queue is not None:
+            _queue.close(wait)
+            _queue = None
+
+
+atexit.register(shutdown)
+
+
+def post_to_channel(poster_id, channel, community, message, time_sent=None):
+    """
+    write-behind chat.post_to_channel
+    :return: Future of its result
+    """
+    return get_queue().post_to_channel(poster_id, channel, community, message, time_sent)
+
+
+def create_direct_message(message_id, sender_id, receiver_id, time_sent, message):
+    """
+    write-behind chat.create_direct_message
+    :return: Future of its result
+    """
+    return get_queue().create_direct_message(message_id, sender_id, receiver_id, time_sent, message)
+
+
+def flush(timeout=None):
+    """
+    waits for the writes submitted so far to commit
+    :return: whether they did in time
+    """
+    return get_queue().flush(timeout) if _queue is not None else True
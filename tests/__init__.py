@@ -0,0 +1,3 @@
+from tests.fixtures import use_worker_database
+
+use_worker_database()
@@ -0,0 +1,178 @@
+"""
+Seed states for the tests, loaded from snapshots instead of being rebuilt for every test.
+
+The first time a process asks for a seed state (the data sets of chat.populate_tables_db1/2/3), it is built with the
+real populate function and its rows are copied into a schema of its own, fixture_<seed>_<unread mode>. Loading it
+again empties the chat tables and copies the rows back in a single round trip with no DDL, so a test starts in a few
+milliseconds. A test that changed the schema (rebuilt or partitioned the tables) gets the tables rebuilt before the
+next load.
+
+Parallel test workers each run on a database of their own, cloned from a template database holding the migrated
+schema. A worker is named by PYTEST_XDIST_WORKER (pytest -n) or CHAT_TEST_WORKER:
+
+    CHAT_TEST_WORKER=w1 python -m unittest & CHAT_TEST_WORKER=w2 python -m pytest -q
+
+Without one, the tests use the database in config/db.yml.
+"""
+import hashlib
+import os
+
+from psycopg2 import sql
+
+from src import chat
+from src.cache import clear_caches
+from src.migrations import MIGRATIONS, TABLES
+from src.swen344_db_utils import DATABASE_ENV, close_pool, connect, load_config, transaction, use_database
+
+WORKER_ENVS = ('PYTEST_XDIST_WORKER', 'CHAT_TEST_WORKER')
+# key of the advisory lock held on the configured database while a worker builds or clones the template
+TEMPLATE_LOCK = 344021
+
+SEEDS = {
+    'db1': chat.populate_tables_db1,
+    'db2': chat.populate_tables_db2,
+    'db3': chat.populate_tables_db3,
+}
+
+# the migration history is part of the schema, so it is never truncated
+_DATA_TABLES = [table for table in TABLES if table != 'schema_migrations']
+
+# tables, columns and their types in the public schema. Partitions show up as tables, so partitioning changes it
+_SCHEMA_FINGERPRINT = """
+    SELECT md5(string_agg(c.relname || ':' || c.relkind::TEXT || ':' || a.attname || ':' || a.atttypid::TEXT, ','
+                          ORDER BY c.relname, a.attnum))
+    FROM pg_class c JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+    WHERE c.relnamespace = 'public'::REGNAMESPACE AND c.relkind IN ('r', 'p')
+"""
+
+_SERIAL_SEQUENCES = """
+    SELECT pg_get_serial_sequence(quote_ident(table_name), column_name) FROM information_schema.columns
+    WHERE table_schema = 'public' AND table_name = ANY(%s) AND column_default LIKE 'nextval(%%'
+    ORDER BY table_name, column_name
+"""
+
+_worker_database = None
+_schema = None
+# (seed, unread mode) -> SQL that loads its snapshot
+_restores = {}
+
+
+def _worker():
+    return next((os.environ[name] for name in WORKER_ENVS if os.environ.get(name)), None)
+
+
+def _template_name(database):
+    digest = hashlib.sha1(repr(MIGRATIONS).encode()).hexdigest()[:10]
+    return '%s_template_%s' % (database, digest)
+
+
+def _build_template(cur, database, template):
+    cur.execute('SELECT datname FROM pg_database WHERE datname LIKE %s AND datname <> %s',
+                (database.replace('_', r'\_') + r'\_template\_%', template))
+    for stale, in cur.fetchall():
+        cur.execute(sql.SQL('DROP DATABASE IF EXISTS {}').format(sql.Identifier(stale)))
+    cur.execute(sql.SQL('CREATE DATABASE {}').format(sql.Identifier(template)))
+    use_database(template)
+    try:
+        chat.rebuild_tables()
+    finally:
+        # a template cannot be cloned while anything is connected to it
+        close_pool()
+
+
+def use_worker_database():
+    """
+    moves this process onto the database of its test worker, cloning it from the template database first.
+    Does nothing when no worker is named, and only the first call in a process clones
+    :return: name of the worker database, or None
+    """
+    global _worker_database
+    worker = _worker()
+    if worker is None or _worker_database is not None:
+        return _worker_database
+    database = load_config()['database']
+    template = _template_name(database)
+    name = '%s_%s' % (database, worker)
+    conn = connect()
+    conn.autocommit = True
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT pg_advisory_lock(%s)', (TEMPLATE_LOCK,))
+        cur.execute('SELECT 1 FROM pg_database WHERE datname = %s', (template,))
+        if cur.fetchone() is None:
+            _build_template(cur, database, template)
+        cur.execute(sql.SQL('DROP DATABASE IF EXISTS {}').format(sql.Identifier(name)))
+        cur.execute(sql.SQL('CREATE DATABASE {} TEMPLATE {}').format(sql.Identifier(name), sql.Identifier(template)))
+        cur.execute('SELECT pg_advisory_unlock(%s)', (TEMPLATE_LOCK,))
+    finally:
+        conn.close()
+    # processes the tests start (the CLIs) inherit the worker database too
+    os.environ[DATABASE_ENV] = name
+    use_database(name)
+    _worker_database = name
+    return name
+
+
+def _fingerprint(cur):
+    cur.execute(_SCHEMA_FINGERPRINT)
+    return cur.fetchone()[0]
+
+
+def _snapshot(seed, mode):
+    """
+    builds the seed state with its populate function and copies it into fixture_<seed>_<mode>
+    :return: SQL that puts the chat tables back into that state
+    """
+    SEEDS[seed]()
+    schema = 'fixture_%s_%s' % (seed, mode)
+    # DELETE rather than TRUNCATE: seed tables are a few rows, and TRUNCATE swaps out every table and index file
+    restore = ['DELETE FROM ' + table for table in _DATA_TABLES]
+    with transaction() as cur:
+        cur.execute('DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema}'.format(schema=schema))
+        for table in _DATA_TABLES:
+            cur.execute('CREATE TABLE {schema}.{table} AS SELECT * FROM {table}'.format(schema=schema, table=table))
+            if cur.rowcount:
+                restore.append('INSERT INTO {table} SELECT * FROM {schema}.{table}'.format(schema=schema, table=table))
+        cur.execute(_SERIAL_SEQUENCES, (_DATA_TABLES,))
+        for sequence, in cur.fetchall():
+            cur.execute('SELECT last_value, is_called FROM ' + sequence)
+            value, called = cur.fetchone()
+            restore.append("SELECT setval('%s', %d, %s)" % (sequence, value, called))
+    return ';\n'.join(restore)
+
+
+def load_seed(seed):
+    """
+    puts the chat tables into a seed state and clears the lookup caches. Unread posts are seeded for the current
+    unread mode
+    :param seed: one of SEEDS
+    """
+    global _schema
+    key = (seed, chat.get_unread_mode())
+    with transaction() as cur:
+        current = _fingerprint(cur)
+    if _schema is None or current != _schema:
+        chat.rebuild_tables()
+        with transaction() as cur:
+            current = _fingerprint(cur)
+        if current != _schema:
+            _restores.clear()
+            _schema = current
+    if key not in _restores:
+        _restores[key] = _snapshot(*key)
+    else:
+        with transaction() as cur:
+            cur.execute(_restores[key])
+    clear_caches()
+
+
+def populate_tables_db1():
+    load_seed('db1')
+
+
+def populate_tables_db2():
+    load_seed('db2')
+
+
+def populate_tables_db3():
+    load_seed('db3')
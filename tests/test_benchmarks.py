@@ -0,0 +1,42 @@
+import json
+import unittest
+from benchmarks.compare import compare
+from benchmarks.suite import BENCHMARKS, run
+from benchmarks.workload import Workload, generate
+from src.swen344_db_utils import exec_get_one
+
+SMALL = Workload(users=40, communities=3, channels=2, members=15, posts=60, dms=80, suspended=4)
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def fingerprint(self):
+        return exec_get_one(
+            "SELECT (SELECT COUNT(*) FROM memberships), (SELECT COUNT(*) FROM mentions), "
+            "(SELECT md5(string_agg(id || user_id || text || time_sent, ',' ORDER BY id)) FROM channel_posts), "
+            "(SELECT md5(string_agg(message_id || sender_id || receiver_id || message || is_read, ',' "
+            " ORDER BY message_id)) FROM direct_messages)")
+
+    def test_workload_is_deterministic(self):
+        first = generate(SMALL)
+        fingerprint = self.fingerprint()
+        second = generate(SMALL)
+        self.assertEqual(fingerprint, self.fingerprint(), "the same workload writes the same rows")
+        self.assertEqual(first.members, second.members)
+        self.assertEqual(3 * 15, fingerprint[0])
+        self.assertEqual(80, exec_get_one('SELECT COUNT(*) FROM direct_messages')[0])
+
+    def test_different_seeds_differ(self):
+        generate(SMALL)
+        fingerprint = self.fingerprint()
+        generate(SMALL._replace(seed=1))
+        self.assertNotEqual(fingerprint, self.fingerprint())
+
+    def test_suite_results_are_json(self):
+        results = run(SMALL, iterations=2, warmup=1, report=lambda line: None)
+        self.assertEqual({benchmark.name for benchmark in BENCHMARKS}, set(results['results']))
+        self.assertEqual(2, results['results']['post_to_channel']['iterations'])
+        self.assertEqual(SMALL._asdict(), json.loads(json.dumps(results))['workload'])
+        rows = compare(results, results)
+        self.assertEqual(len(BENCHMARKS), len(rows))
+        self.assertFalse(any(row[4] for row in rows), "a run never regresses against itself")
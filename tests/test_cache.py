@@ -0,0 +1,52 @@
+import unittest
+from src.cache import LRUCache
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCache(unittest.TestCase):
+
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache('test', maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'), "b was used least recently")
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(1, cache.stats()['evictions'])
+
+    def test_entries_expire(self):
+        clock = FakeClock()
+        cache = LRUCache('test', ttl=10, clock=clock)
+        cache.set('a', 1)
+        clock.now = 9
+        self.assertEqual(1, cache.get('a'))
+        clock.now = 11
+        self.assertIsNone(cache.get('a'), "the entry outlived its ttl")
+
+    def test_get_or_load_counts_hits_and_misses(self):
+        cache = LRUCache('test')
+        loads = []
+        for i in range(3):
+            self.assertFalse(cache.get_or_load('x', lambda: loads.append('x')))
+        self.assertEqual(1, len(loads), "the loader only runs on a miss")
+        stats = cache.stats()
+        self.assertEqual((2, 1, 1), (stats['hits'], stats['misses'], stats['size']))
+
+    def test_invalidate(self):
+        cache = LRUCache('test')
+        cache.set('a', 1)
+        cache.invalidate('a')
+        self.assertIsNone(cache.get('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,9 @@
 import unittest
+from src import chat
 from src.chat import *
-from src.swen344_db_utils import connect
+from src.cache import cache_stats
+from src.swen344_db_utils import connect, exec_get_all, exec_get_one
+from tests.fixtures import populate_tables_db1, populate_tables_db2, populate_tables_db3
 
 
 class TestChat(unittest.TestCase):
@@ -30,7 +33,7 @@ class TestChat(unittest.TestCase):
         conn = connect()
         cur = conn.cursor()
         # check why this is necessary in CI
-        populate_tables_db1()
+        chat.populate_tables_db1()
         cur.execute('SELECT * FROM users')
         self.assertEqual(5, len(cur.fetchall()), "There should be 5 rows in users table")
         cur.execute('SELECT * FROM direct_messages')
@@ -136,6 +139,183 @@ class TestChat(unittest.TestCase):
         message_list = get_unread_messages('DrMarvin')
         self.assertTrue(len(message_list) == 0, "DrMarvin should have read his unread message")
 
+    def test_conversation_read_watermarks(self):
+        print("Test marking whole conversations read with a watermark")
+        populate_tables_db1()
+        create_direct_message(8, 'Costello1234', 'Abbott1234', '2020-02-12 11:20:00', 'Who is on first?')
+        self.assertEqual([6, 7, 8], sorted(row[0] for row in get_unread_messages('Abbott1234')))
+        self.assertEqual("Messages from Costello1234 marked as read",
+                         mark_conversation_read('Abbott1234', 'Costello1234', up_to=6))
+        self.assertEqual([7, 8], sorted(row[0] for row in get_unread_messages('Abbott1234')))
+        mark_conversation_read('Abbott1234', 'Costello1234', up_to=2)
+        self.assertEqual([7, 8], sorted(row[0] for row in get_unread_messages('Abbott1234')),
+                         "a watermark never moves back")
+        mark_conversation_read('Abbott1234', 'Costello1234')
+        self.assertEqual([7], [row[0] for row in get_unread_messages('Abbott1234')])
+        self.assertEqual(4, exec_get_one('SELECT COUNT(*) FROM direct_messages WHERE is_read = FALSE')[0],
+                         "marking a conversation read doesn't write its messages")
+        rows, cursor = get_messages_from_page('Abbott1234', 'Costello1234')
+        self.assertEqual([True, True, True], [row[-1] for row in rows], "history shows the watermark as read")
+        self.assertEqual("All messages marked as read", mark_all_read('Abbott1234'))
+        self.assertEqual([], get_unread_messages('Abbott1234'))
+        self.assertEqual(1, len(get_unread_messages('Larry1234')), "other receivers are untouched")
+        self.assertEqual("User doesn't exist", mark_all_read('Nobody1234'))
+
+    def test_watermarks_follow_arrival_order(self):
+        print("Test a message sent after a conversation was read is unread, whatever its id")
+        populate_tables_db1()
+        create_direct_message(20, 'Moe1234', 'Abbott1234', None, 'Abbott?')
+        mark_conversation_read('Abbott1234', 'Moe1234')
+        create_direct_message(15, 'Moe1234', 'Abbott1234', None, 'Hello?')
+        self.assertEqual([6, 15], sorted(row[0] for row in get_unread_messages('Abbott1234')))
+        mark_conversation_read('Abbott1234', 'Moe1234', up_to=15)
+        self.assertEqual([6], [row[0] for row in get_unread_messages('Abbott1234')])
+
+    def test_messages_below_watermarks_are_not_counted(self):
+        print("Test a new message only counts as unread when it is above its conversation's watermark")
+        populate_tables_db1()
+        create_direct_message(20, 'Moe1234', 'Abbott1234', None, 'Abbott?')
+        mark_conversation_read('Abbott1234', 'Moe1234')
+        create_direct_message(15, 'Moe1234', 'Abbott1234', None, 'Hello?')
+        self.assertCountsMatch('Abbott1234')
+        # a watermark ahead of the messages, as restoring conversation_reads from a later backup leaves it
+        exec_commit("UPDATE conversation_reads SET last_read_seq = last_read_seq + 10 WHERE receiver_id = 'Abbott1234'")
+        reconcile_unread_counts()
+        create_direct_message(16, 'Moe1234', 'Abbott1234', None, 'Anybody?')
+        self.assertCountsMatch('Abbott1234')
+        self.assertEqual([], reconcile_unread_counts())
+
+    def assertCountsMatch(self, user_id):
+        expected = (len(get_unread_messages(user_id)), get_unread_posts(user_id)[1], get_mentions(user_id)[1])
+        self.assertEqual(expected, tuple(get_unread_counts(user_id)), user_id + "'s counters drifted")
+
+    def _exercise_counters(self):
+        populate_tables_db3()
+        add_user_to_community('lex12345', 'Metropolis')
+        post_to_channel('lex12345', 'DailyPlanet', 'Metropolis', "Hi @clarknotsuperman")
+        post_to_channel('lex12345', 'Random', 'Metropolis', "Anyone?")
+        post_to_channel('clarknotsuperman', 'DailyPlanet', 'Metropolis', "Hi @lex12345")
+        post_to_channel('Moe1234', 'Dialogs', 'Comedy', "Hey @Larry1234 and @Curly1234")
+        create_direct_message(10, 'Moe1234', 'Abbott1234', '2020-02-12 11:20:00', 'Still there?')
+        create_direct_messages([(11, 'Costello1234', 'Abbott1234', None, 'Third base!'),
+                                (12, 'Larry1234', 'Moe1234', None, 'Yes')])
+        for user_id in ('clarknotsuperman', 'lex12345', 'Abbott1234', 'Moe1234', 'Larry1234'):
+            self.assertCountsMatch(user_id)
+        self.assertEqual(UnreadCounts(4, 1, 0), get_unread_counts('Abbott1234'))
+        self.assertEqual([('Metropolis', 'DailyPlanet', 1, 1), ('Metropolis', 'Random', 1, 0)],
+                         get_channel_unread_counts('clarknotsuperman'))
+        read_message(7, 'Abbott1234')
+        read_message(7, 'Abbott1234')
+        mark_conversation_read('Abbott1234', 'Costello1234', up_to=6)
+        mark_channel_read('clarknotsuperman', 'DailyPlanet', 'Metropolis')
+        for user_id in ('clarknotsuperman', 'Abbott1234'):
+            self.assertCountsMatch(user_id)
+        self.assertEqual([('Metropolis', 'DailyPlanet', 0, 1), ('Metropolis', 'Random', 1, 0)],
+                         get_channel_unread_counts('clarknotsuperman'))
+        mark_all_read('Abbott1234')
+        self.assertEqual(UnreadCounts(0, 1, 0), get_unread_counts('Abbott1234'))
+
+    def test_unread_counts(self):
+        print("Test the badge counters follow every write that changes what is unread")
+        self._exercise_counters()
+        self.assertEqual([], reconcile_unread_counts(), "the maintained counters should not have drifted")
+
+    def test_unread_counts_watermark_mode(self):
+        print("Test the badge counters in watermark mode")
+        set_unread_mode('watermark')
+        try:
+            self._exercise_counters()
+            self.assertEqual([], reconcile_unread_counts(), "the maintained counters should not have drifted")
+        finally:
+            set_unread_mode('fanout')
+
+    def test_watermark_posts_write_no_member_counters(self):
+        print("Test posting in watermark mode only writes the channel's counters and the mentioned members'")
+        set_unread_mode('watermark')
+        try:
+            populate_tables_db3()
+            counters = 'SELECT * FROM unread_counts UNION ALL SELECT user_id, channel_id, unread_posts, mentions ' \
+                       'FROM channel_unread_counts ORDER BY 1, 2'
+            before = exec_get_all(counters)
+            post_to_channel('Moe1234', 'Dialogs', 'Comedy', "Why, you")
+            self.assertEqual(before, exec_get_all(counters), "no member's counters are written")
+            post_to_channel('Moe1234', 'Dialogs', 'Comedy', "Hey @Larry1234")
+            self.assertEqual([row for row in before if row[0] != 'Larry1234'],
+                             [row for row in exec_get_all(counters) if row[0] != 'Larry1234'],
+                             "only the mentioned member's are")
+            self.assertEqual((2, 1), get_unread_counts('Larry1234')[1:])
+            self.assertEqual((0, 0), get_unread_counts('Moe1234')[1:], "own posts are not unread")
+            exec_commit('UPDATE channel_post_counts SET posts = posts + 1')
+            self.assertEqual(['Abbott1234', 'Bob12345', 'Costello1234', 'Curly1234', 'DrMarvin', 'Larry1234',
+                              'Moe1234'], reconcile_unread_counts())
+            for user_id in ('Larry1234', 'Moe1234'):
+                self.assertCountsMatch(user_id)
+        finally:
+            set_unread_mode('fanout')
+
+    def test_reconcile_unread_counts(self):
+        print("Test rebuilding drifted counters from the source tables")
+        populate_tables_db1()
+        self.assertEqual(UnreadCounts(2, 0, 0), get_unread_counts('Abbott1234'), "seed messages are counted")
+        exec_commit("UPDATE unread_counts SET unread_messages = 40 WHERE user_id = 'Abbott1234'")
+        exec_commit("INSERT INTO direct_messages (message_id, sender_id, receiver_id, message) "
+                    "VALUES (8, 'Moe1234', 'Curly1234', 'Hi')")
+        self.assertEqual(['Abbott1234', 'Curly1234'], reconcile_unread_counts())
+        self.assertCountsMatch('Abbott1234')
+        self.assertCountsMatch('Curly1234')
+        self.assertEqual([], reconcile_unread_counts())
+
+    def test_inbox(self):
+        print("Test the inbox lists each conversation once, newest first, with its unread count")
+        populate_tables_db3()
+        create_direct_message(10, 'Moe1234', 'Abbott1234', '2020-02-12 11:20:00', 'Still there?')
+        create_direct_messages([(11, 'Costello1234', 'Abbott1234', None, 'Third base!')])
+        inbox, cursor = get_inbox('Abbott1234')
+        self.assertEqual([('Costello1234', 11, 'Costello1234', 'Third base!', 2),
+                          ('Moe1234', 10, 'Moe1234', 'Still there?', 2)],
+                         [(c.other_user, c.last_message_id, c.last_sender, c.last_message, c.unread) for c in inbox])
+        self.assertIsNone(cursor)
+        first, cursor = get_inbox('Abbott1234', limit=1)
+        second, last = get_inbox('Abbott1234', limit=1, cursor=cursor)
+        self.assertEqual(inbox, first + second)
+        self.assertIsNone(last)
+        self.assertEqual([('Abbott1234', 0), ('Larry1234', 0), ('lex12345', 1)],
+                         [(c.other_user, c.unread) for c in get_inbox('Moe1234')[0]], "sent messages are not unread")
+        read_message(10, 'Abbott1234')
+        mark_conversation_read('Abbott1234', 'Costello1234', up_to=6)
+        self.assertEqual([1, 1], [c.unread for c in get_inbox('Abbott1234')[0]])
+        mark_all_read('Abbott1234')
+        self.assertEqual([0, 0], [c.unread for c in get_inbox('Abbott1234')[0]])
+        summaries = exec_get_all('SELECT * FROM conversations ORDER BY user_a, user_b')
+        reconcile_unread_counts()
+        self.assertEqual(summaries, exec_get_all('SELECT * FROM conversations ORDER BY user_a, user_b'),
+                         "the maintained summaries should not have drifted")
+        self.assertEqual(([], None), get_inbox('nobody'))
+
+    def test_inbox_follows_watermarks(self):
+        print("Test the inbox unread counts agree with the unread messages as conversations are read")
+        populate_tables_db1()
+
+        def assertInboxMatches():
+            unread = {}
+            for message in get_unread_messages('Abbott1234'):
+                unread[message[1]] = unread.get(message[1], 0) + 1
+            self.assertEqual(unread, {c.other_user: c.unread for c in get_inbox('Abbott1234')[0] if c.unread})
+
+        create_direct_message(20, 'Moe1234', 'Abbott1234', None, 'Abbott?')
+        mark_conversation_read('Abbott1234', 'Moe1234')
+        create_direct_message(15, 'Moe1234', 'Abbott1234', None, 'Hello?')
+        assertInboxMatches()
+        mark_conversation_read('Abbott1234', 'Costello1234', up_to=6)
+        exec_commit("UPDATE conversation_reads SET last_read_seq = last_read_seq + 10 WHERE receiver_id = 'Abbott1234'")
+        reconcile_unread_counts()
+        create_direct_message(16, 'Moe1234', 'Abbott1234', None, 'Anybody?')
+        create_direct_message(17, 'Costello1234', 'Abbott1234', None, 'Third base!')
+        assertInboxMatches()
+        summaries = exec_get_all('SELECT * FROM conversations ORDER BY user_a, user_b')
+        reconcile_unread_counts()
+        self.assertEqual(summaries, exec_get_all('SELECT * FROM conversations ORDER BY user_a, user_b'))
+
     def test_unread_posts(self):
         print("Test that posts are being sent and kept from being sent to channels correctly")
         populate_tables_db3()
@@ -150,3 +330,193 @@ class TestChat(unittest.TestCase):
         post_to_channel('Moe1234', 'Dialogs', 'Comedy', "Hey @clarknotsuperman are you here?")
         mentions, nummentions = get_mentions('clarknotsuperman')
         self.assertTrue(nummentions == 1, "only 1 mention should have been found")
+
+    def test_post_fans_out_to_every_member(self):
+        print("Test that a post is unread for every other member of the community")
+        populate_tables_db3()
+        post_to_channel('Moe1234', 'Dialogs', 'Comedy', "Hi @Larry1234 and @Curly1234!")
+        members = get_users_in_community('Comedy')
+        for user_id in members:
+            post, numposts = get_unread_posts(user_id)
+            expected = 0 if user_id == 'Moe1234' else 1
+            self.assertEqual(expected, numposts, user_id + " has the wrong number of unread posts")
+        self.assertEqual(1, get_mentions('Larry1234')[1], "Larry should have been mentioned")
+
+    def test_unread_posts_watermark_mode(self):
+        print("Test unread posts computed from per-channel read watermarks")
+        set_unread_mode('watermark')
+        try:
+            populate_tables_db3()
+            add_user_to_community('lex12345', 'Metropolis')
+            post_to_channel('lex12345', 'DailyPlanet', 'Metropolis', "Hi guys!")
+            post_to_channel('lex12345', 'Random', 'Metropolis', "Anyone?")
+            self.assertEqual(0, exec_get_one('SELECT COUNT(*) FROM unread_posts')[0], "no unread rows are written")
+            post, numposts = get_unread_posts('clarknotsuperman')
+            self.assertEqual(2, numposts, "2 unread posts should have been found")
+            self.assertEqual(0, get_unread_posts('lex12345')[1], "the poster has no unread posts")
+            mark_channel_read('clarknotsuperman', 'DailyPlanet', 'Metropolis')
+            self.assertEqual(1, get_unread_posts('clarknotsuperman')[1], "only Random should still be unread")
+            add_user_to_community('Moe1234', 'Metropolis')
+            self.assertEqual(0, get_unread_posts('Moe1234')[1], "posts from before joining are not unread")
+        finally:
+            set_unread_mode('fanout')
+
+    def test_migrate_unread_posts_to_watermarks(self):
+        print("Test moving fan-out unread rows over to read watermarks")
+        populate_tables_db3()
+        add_user_to_community('lex12345', 'Metropolis')
+        post_to_channel('lex12345', 'DailyPlanet', 'Metropolis', "Hi guys!")
+        post_to_channel('lex12345', 'DailyPlanet', 'Metropolis', "Still there?")
+        mark_channel_read('clarknotsuperman', 'DailyPlanet', 'Metropolis')
+        post_to_channel('lex12345', 'DailyPlanet', 'Metropolis', "Hello?")
+        post_to_channel('Moe1234', 'Dialogs', 'Comedy', "Hey all")
+        before = {user: get_unread_posts(user)[0] for user in ('clarknotsuperman', 'Larry1234', 'lex12345')}
+        self.assertEqual(1, len(before['clarknotsuperman']), "marking the channel read cleared the older posts")
+        try:
+            migrate_unread_posts_to_watermarks()
+            for user, posts in before.items():
+                self.assertEqual(posts, get_unread_posts(user)[0], user + " has different unread posts after migrating")
+        finally:
+            set_unread_mode('fanout')
+
+    def test_cached_lookups_are_invalidated_by_writes(self):
+        print("Test that cached lookups see the writes made through the chat API")
+        populate_tables_db3()
+        self.assertFalse(user_exists('shemp@rit.edu'))
+        self.assertFalse(community_exists('Stooges'))
+        create_user('Shemp1234', 'Shemp', 5855550000, 'shemp@rit.edu', '1991-05-16 00:00:00', None, None, None)
+        add_community('Stooges', ['Slapstick'])
+        self.assertTrue(user_exists('shemp@rit.edu'), "the cached miss should have been dropped")
+        self.assertTrue(channel_exists('Slapstick', 'Stooges'))
+        self.assertEqual([], get_users_in_community('Stooges'))
+        add_user_to_community('Shemp1234', 'Stooges')
+        self.assertEqual(['Shemp1234'], get_users_in_community('Stooges'), "the roster should have been reloaded")
+        hits = cache_stats()['rosters']['hits']
+        get_users_in_community('Stooges')
+        self.assertEqual(hits + 1, cache_stats()['rosters']['hits'])
+
+    def test_paginated_and_streamed_history(self):
+        print("Test paging and streaming through a long conversation")
+        populate_tables_db1()
+        read_csv('data/whos_on_first.csv')
+        everything = exec_get_all("SELECT message_id FROM direct_messages WHERE sender_id = 'Costello1234' "
+                                  "AND receiver_id = 'Abbott1234' ORDER BY time_sent, message_id")
+        paged = []
+        rows, cursor = get_messages_from_page('Abbott1234', 'Costello1234', limit=10)
+        while True:
+            self.assertTrue(len(rows) <= 10)
+            paged.extend(row[0] for row in rows)
+            if cursor is None:
+                break
+            rows, cursor = get_messages_from_page('Abbott1234', 'Costello1234', limit=10, cursor=cursor)
+        self.assertEqual([row[0] for row in everything], paged, "paging should visit every message once, in order")
+        streamed = [row[0] for row in iter_messages_from('Abbott1234', 'Costello1234', batch_size=7)]
+        self.assertEqual(paged, streamed)
+        unread = [row[0] for row in iter_unread_messages('Abbott1234')]
+        self.assertEqual(len(get_unread_messages('Abbott1234')), len(unread))
+        self.assertEqual(unread[:5], [row[0] for row in get_unread_messages_page('Abbott1234', limit=5)[0]])
+
+    def test_paginated_posts_and_mentions(self):
+        print("Test paging through unread posts and mentions")
+        populate_tables_db3()
+        add_user_to_community('lex12345', 'Metropolis')
+        for i in range(5):
+            post_to_channel('lex12345', 'DailyPlanet', 'Metropolis', "post %d @clarknotsuperman" % i,
+                            '2020-01-01 00:00:0%d' % i)
+        rows, cursor = get_unread_posts_page('clarknotsuperman', limit=3)
+        more, last = get_unread_posts_page('clarknotsuperman', limit=3, cursor=cursor)
+        self.assertEqual((3, 2, None), (len(rows), len(more), last))
+        self.assertEqual(sorted(get_unread_posts('clarknotsuperman')[0]), [str(row[0]) for row in rows + more])
+        self.assertEqual(5, len(list(iter_mentions('clarknotsuperman', batch_size=2))))
+        self.assertEqual(4, len(get_mentions_page('clarknotsuperman', limit=4)[0]))
+
+    def test_search_channel_posts(self):
+        print("Test searching the posts a user can see")
+        populate_tables_db3()
+        add_user_to_community('lex12345', 'Metropolis')
+        post_to_channel('Moe1234', 'ArgumentClinic', 'Comedy', "Who's on first base?", '2021-01-01 00:00:00')
+        post_to_channel('Curly1234', 'Dialogs', 'Comedy', "first things first, the first baseman", '2021-01-01 00:00:01')
+        post_to_channel('lex12345', 'DailyPlanet', 'Metropolis', "first edition", '2021-01-01 00:00:02')
+        rows, cursor = search_channel_posts('Curly1234', 'first')
+        self.assertEqual(["first things first, the first baseman", "Who's on first base?"], [row[2] for row in rows],
+                         "ranked best match first, and Metropolis posts are not visible to Curly")
+        self.assertIsNone(cursor)
+        self.assertEqual(1, len(search_channel_posts('Curly1234', 'first', channel='ArgumentClinic')[0]))
+        self.assertEqual(["first edition"], [row[2] for row in search_channel_posts('clarknotsuperman', 'first')[0]])
+        self.assertEqual([2], [row[0] for row in search_channel_posts('Curly1234', 'first -base')[0]],
+                         "web search syntax is supported")
+        add_user_to_community('lex12345', 'Comedy')
+        rows, cursor = search_channel_posts('lex12345', 'first', limit=2)
+        more, last = search_channel_posts('lex12345', 'first', limit=2, cursor=cursor)
+        self.assertEqual((2, 1, None), (len(rows), len(more), last))
+        self.assertEqual(3, len({row[0] for row in rows + more}), "pages should not repeat a post")
+
+    def test_search_direct_messages(self):
+        print("Test searching a user's own conversations")
+        populate_tables_db3()
+        rows, cursor = search_direct_messages('Moe1234', 'hi')
+        self.assertEqual({7, 8, 9}, {row[0] for row in rows})
+        self.assertEqual([8, 9], sorted(row[0] for row in search_direct_messages('Moe1234', 'hi', 'lex12345')[0]))
+        self.assertEqual([], search_direct_messages('Curly1234', 'hi')[0], "Curly is in none of those conversations")
+        read_csv('data/whos_on_first.csv')
+        everything = search_direct_messages('Abbott1234', 'who', limit=1000)[0]
+        paged = []
+        rows, cursor = search_direct_messages('Abbott1234', 'who', limit=7)
+        while True:
+            paged.extend(rows)
+            if cursor is None:
+                break
+            rows, cursor = search_direct_messages('Abbott1234', 'who', limit=7, cursor=cursor)
+        self.assertEqual(everything, paged, "paging should visit every match once, in rank order")
+        self.assertEqual(sorted((row[-1] for row in paged), reverse=True), [row[-1] for row in paged])
+
+    def test_bulk_operations(self):
+        print("Test creating users, channels, memberships and messages in bulk")
+        populate_tables_db1()
+        users = [('bulkuser%04d' % i, 'Bulk', 5855550000 + i, 'bulk%d@rit.edu' % i) for i in range(500)]
+        users += [('bulkuser0000', 'Dupe', 5855550000, 'bulk0@rit.edu'), ('short', 'S', 5855550000, 'short@rit.edu'),
+                  ('Moe12345', 'Moe', 5855550000, 'moe@rit.edu')]
+        results = create_users(users)
+        self.assertEqual(["User added successfully"] * 500, results[:500])
+        self.assertEqual(["User already exists", "Username needs to be between 8 to 30 characters",
+                          "User already exists"], results[500:])
+        self.assertTrue(user_exists('bulk499@rit.edu'))
+
+        add_community('Bulk', [])
+        results = add_channels(['general', 'random', 'general'], 'Bulk')
+        self.assertEqual(["general was added to Bulk", "random was added to Bulk", "general exists"], results)
+        self.assertEqual(["The community doesn't exist"], add_channels(['general'], 'Nowhere'))
+
+        members = [user[0] for user in users[:500]]
+        results = add_users_to_community(members + ['bulkuser0001', 'nobody1234'], 'Bulk')
+        self.assertEqual(members[1] + " is already a member of Bulk", results[500])
+        self.assertEqual("The user doesn't exist", results[501])
+        self.assertEqual(500, len(get_users_in_community('Bulk')))
+
+        results = create_direct_messages([(None, 'bulkuser0001', 'bulkuser0002', None, 'hi'),
+                                          (None, 'bulkuser0002', 'bulkuser0001', '2020-01-01 00:00:00', 'hello'),
+                                          (None, 'Larry1234', 'Moe1234', '2020-01-01 00:00:00', 'fired'),
+                                          (None, 'nobody1234', 'Moe1234', None, '?')])
+        self.assertEqual("Message sent successfully", results[0])
+        self.assertEqual("Message sent successfully", results[1])
+        self.assertTrue(results[2].startswith("larry@rit.edu is currently suspended"), results[2])
+        self.assertEqual("User nobody1234 doesn't exist", results[3])
+        self.assertEqual(1, len(get_unread_messages('bulkuser0001')))
+
+        # rows taking their id from the sequence go past the explicit ids in the same batch
+        last = exec_get_one('SELECT MAX(message_id) FROM direct_messages')[0]
+        results = create_direct_messages([(None, 'bulkuser0001', 'bulkuser0002', None, 'first'),
+                                          (last + 1, 'bulkuser0002', 'bulkuser0001', None, 'second'),
+                                          (None, 'bulkuser0001', 'bulkuser0002', None, 'third')])
+        self.assertEqual(["Message sent successfully"] * 3, results)
+        ids = exec_get_all("SELECT message_id FROM direct_messages WHERE message IN ('first', 'second', 'third')")
+        self.assertEqual(3, len({row[0] for row in ids}))
+
+        # taken ids fail alone instead of rolling back the batch
+        results = create_direct_messages([(1, 'bulkuser0001', 'bulkuser0002', None, 'taken'),
+                                          (last + 10, 'bulkuser0001', 'bulkuser0002', None, 'once'),
+                                          (last + 10, 'bulkuser0002', 'bulkuser0001', None, 'twice')])
+        self.assertEqual(["Message 1 already exists", "Message sent successfully",
+                          "Message %d already exists" % (last + 10)], results)
+        self.assertEqual([('once',)], exec_get_all('SELECT message FROM direct_messages WHERE message_id = %s',
+                                                   (last + 10,)))
@@ -0,0 +1,59 @@
+import asyncio
+import unittest
+from src import chat, chat_async
+from src.cache import cache_stats
+from tests.fixtures import populate_tables_db3
+
+
+class TestChatAsync(unittest.TestCase):
+
+    def setUp(self):
+        populate_tables_db3()
+
+    def test_same_results_as_sync(self):
+        async def scenario():
+            sent = await chat_async.create_direct_message(10, 'Moe1234', 'Curly1234', None, 'Nyuk nyuk')
+            missing = await chat_async.user_exists('nobody@rit.edu')
+            unread = await chat_async.get_unread_messages('Curly1234')
+            return sent, missing, unread
+        sent, missing, unread = asyncio.run(scenario())
+        self.assertEqual("Message sent successfully", sent)
+        self.assertFalse(missing)
+        self.assertEqual(chat.get_unread_messages('Curly1234'), unread)
+
+    def test_unread_counts(self):
+        async def scenario():
+            await chat_async.create_direct_message(10, 'Moe1234', 'Curly1234', None, 'Nyuk nyuk')
+            drifted = await chat_async.reconcile_unread_counts()
+            counts = await chat_async.get_unread_counts('Curly1234')
+            channels = await chat_async.get_channel_unread_counts('Curly1234')
+            return drifted, counts, channels
+        drifted, counts, channels = asyncio.run(scenario())
+        self.assertEqual([], drifted, "the send kept the counters up to date")
+        self.assertEqual(chat.get_unread_counts('Curly1234'), counts)
+        self.assertEqual(chat.get_channel_unread_counts('Curly1234'), channels)
+
+    def test_user_checks_are_warmed_concurrently(self):
+        before = cache_stats()
+        sent = asyncio.run(chat_async.create_direct_message(10, 'Moe1234', 'Curly1234', None, 'Nyuk nyuk'))
+        self.assertEqual("Message sent successfully", sent)
+        after = cache_stats()
+        for name in ('emails_by_id', 'users_by_email'):
+            self.assertEqual(before[name]['misses'] + 2, after[name]['misses'], name + " are loaded while warming")
+            self.assertEqual(before[name]['hits'] + 2, after[name]['hits'], "and read from the cache after")
+
+    def test_concurrent_posts(self):
+        async def scenario():
+            await chat_async.add_user_to_community('lex12345', 'Metropolis')
+            results = await asyncio.gather(*(
+                chat_async.post_to_channel('lex12345', 'DailyPlanet', 'Metropolis', 'post %d' % i,
+                                           '2020-01-01 00:00:00') for i in range(20)))
+            posts = [row async for row in chat_async.iter_unread_posts('clarknotsuperman', batch_size=3)]
+            return results, posts
+        results, posts = asyncio.run(scenario())
+        self.assertEqual(["Message sent to channel"] * 20, results)
+        self.assertEqual(20, len(posts))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import unittest
+from datetime import datetime
+from src import chat, partitions
+from src.migrations import TABLES
+from src.swen344_db_utils import exec_get_all, exec_get_one
+from tests.fixtures import SEEDS, load_seed
+
+
+def dump():
+    """:return: every row of every chat table, and the next message id"""
+    rows = {table: sorted(exec_get_all('SELECT * FROM ' + table), key=repr)
+            for table in TABLES if table != 'schema_migrations'}
+    return rows, exec_get_one("SELECT nextval(pg_get_serial_sequence('direct_messages', 'message_id'))")[0]
+
+
+class TestFixtures(unittest.TestCase):
+
+    def test_snapshots_match_populate(self):
+        for seed, populate in sorted(SEEDS.items()):
+            populate()
+            expected = dump()
+            load_seed(seed)
+            chat.post_to_channel('Abbott1234', 'Dialogs', 'Comedy', 'changes the state', '2020-01-01 00:00:00')
+            load_seed(seed)
+            self.assertEqual(expected, dump(), seed)
+
+    def test_schema_changes_are_rebuilt(self):
+        load_seed('db3')
+        partitions.partition_tables('year', ahead=0, at=datetime(2020, 3, 15))
+        load_seed('db1')
+        self.assertFalse(exec_get_one("SELECT relkind = 'p' FROM pg_class WHERE oid = 'direct_messages'::REGCLASS")[0])
+        self.assertEqual(7, exec_get_one('SELECT COUNT(*) FROM direct_messages')[0])
@@ -0,0 +1,105 @@
+import unittest
+from datetime import datetime, timedelta
+from src.chat import get_channel_history, post_to_channel
+from src.history import ChannelHistory, PostRecord, get_history
+from src.swen344_db_utils import exec_get_all, transaction
+from tests.fixtures import populate_tables_db3
+
+START = datetime(2020, 1, 1)
+
+
+def rows(count, first=1):
+    """:return: channel_posts rows for posts first..first+count-1, newest first"""
+    return [(i, 1, 'post %d' % i, 'Moe1234', START + timedelta(minutes=i))
+            for i in reversed(range(first, first + count))]
+
+
+class TestHistory(unittest.TestCase):
+
+    def setUp(self):
+        populate_tables_db3()
+
+    def walk(self, limit):
+        """:return: every post id in Dialogs, paging back from the newest"""
+        ids = []
+        page, cursor = get_channel_history('Dialogs', 'Comedy', limit)
+        ids[:0] = [row[0] for row in page]
+        while cursor:
+            page, cursor = get_channel_history('Dialogs', 'Comedy', limit, cursor)
+            ids[:0] = [row[0] for row in page]
+        return ids
+
+    def test_history_pages_match_the_database(self):
+        for i in range(7):
+            post_to_channel('Moe1234', 'Dialogs', 'Comedy', 'Soitenly %d' % i, '2020-01-01 00:0%d:00' % (6 - i))
+        expected = [row[0] for row in exec_get_all(
+            "SELECT channel_posts.id FROM channel_posts JOIN channels ON channels.id = channel_posts.channel_id "
+            "WHERE channels.name = 'Dialogs' ORDER BY time_sent, channel_posts.id")]
+        self.assertEqual(expected, self.walk(3))
+        before = get_history().stats()
+        self.assertEqual(expected, self.walk(3), "the newest posts are served from memory")
+        after = get_history().stats()
+        self.assertEqual(before['hits'] + 3, after['hits'])
+        self.assertEqual(before['misses'], after['misses'])
+        self.assertGreater(after['bytes'], 0)
+        self.assertEqual(([], None), get_channel_history('Nowhere', 'Comedy'))
+
+    def test_limit_must_be_positive(self):
+        for before in (None, (START, 1)):
+            with self.assertRaises(ValueError):
+                get_channel_history('Dialogs', 'Comedy', 0, before)
+
+    def test_new_posts_are_added_when_they_commit(self):
+        get_channel_history('Dialogs', 'Comedy')
+        post_to_channel('Moe1234', 'Dialogs', 'Comedy', 'Why I oughta')
+        self.assertEqual('Why I oughta', get_channel_history('Dialogs', 'Comedy', 1)[0][0][2])
+        with self.assertRaises(ZeroDivisionError), transaction():
+            post_to_channel('Moe1234', 'Dialogs', 'Comedy', 'Rolled back')
+            self.assertEqual('Rolled back', get_channel_history('Dialogs', 'Comedy', 1)[0][0][2],
+                             "the writing transaction sees its own post")
+            1 / 0
+        self.assertEqual('Why I oughta', get_channel_history('Dialogs', 'Comedy', 1)[0][0][2])
+
+    def test_ring_keeps_the_newest_posts(self):
+        history = ChannelHistory(capacity=3)
+        key = ('Comedy', 'Dialogs')
+        history.load(key, rows(5), history.version(key))
+        page, cursor = history.page(key, 2)
+        self.assertEqual([4, 5], [row[0] for row in page])
+        self.assertEqual([3], [row[0] for row in history.page(key, 1, cursor)[0]])
+        self.assertIsNone(history.page(key, 2, cursor), "the page reaches past the ring")
+        self.assertIsNone(history.page(key, 2, (START + timedelta(minutes=3), 3)), "older posts are not held")
+        history.add(key, PostRecord(*rows(1, 6)[0]))
+        history.add(key, PostRecord(*rows(1, 6)[0]))
+        history.add(key, PostRecord(7, 1, 'late', 'Moe1234', START + timedelta(minutes=4, seconds=30)))
+        self.assertEqual([7, 5, 6], [row[0] for row in history.page(key, 3)[0]], "posts are kept in time order")
+
+    def test_complete_channels_answer_every_page(self):
+        history = ChannelHistory(capacity=3)
+        key = ('Comedy', 'Dialogs')
+        history.load(key, rows(2), history.version(key))
+        page, cursor = history.page(key, 5)
+        self.assertEqual([1, 2], [row[0] for row in page])
+        self.assertIsNone(cursor, "the channel has no older posts")
+
+    def test_loads_that_raced_a_write_are_dropped(self):
+        history = ChannelHistory(capacity=3)
+        key = ('Comedy', 'Dialogs')
+        version = history.version(key)
+        history.add(key, PostRecord(*rows(1, 6)[0]))
+        history.load(key, rows(5), version)
+        self.assertIsNone(history.page(key, 1))
+
+    def test_least_recently_used_channels_are_evicted(self):
+        history = ChannelHistory(capacity=10)
+        for channel in ('a', 'b'):
+            history.load(('Comedy', channel), rows(10), history.version(('Comedy', channel)))
+        history.max_bytes = history.stats()['bytes']
+        history.page(('Comedy', 'a'), 1)
+        history.load(('Comedy', 'c'), rows(10), history.version(('Comedy', 'c')))
+        self.assertIsNone(history.page(('Comedy', 'b'), 1))
+        self.assertIsNotNone(history.page(('Comedy', 'a'), 1))
+        stats = history.stats()
+        self.assertEqual((2, 1), (stats['channels'], stats['evictions']))
+        self.assertLessEqual(stats['bytes'], history.max_bytes)
+        self.assertEqual(2 / 3, stats['hit_rate'])
@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+from src import suspensions
+from src.chat import create_direct_message, get_inbox, get_last_message_id, get_unread_counts, get_unread_messages
+from src.importer import import_conversation, WHOS_ON_FIRST_SPEAKERS
+from src.swen344_db_utils import exec_commit, exec_get_all, exec_get_one
+from tests.fixtures import populate_tables_db1
+
+
+class TestImporter(unittest.TestCase):
+
+    def setUp(self):
+        populate_tables_db1()
+
+    def write_transcript(self, text):
+        file = tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False)
+        file.write(text)
+        file.close()
+        self.addCleanup(os.remove, file.name)
+        return file.name
+
+    def test_import_in_chunks_after_seeded_ids(self):
+        result = import_conversation('data/whos_on_first.csv', WHOS_ON_FIRST_SPEAKERS, chunk_size=50)
+        self.assertEqual("Imported 184 messages", result)
+        ids = [row[0] for row in exec_get_all('SELECT message_id FROM direct_messages ORDER BY message_id')]
+        self.assertEqual(list(range(1, 192)), ids, "imported ids should follow the 7 seeded messages")
+        self.assertEqual(191, get_last_message_id())
+        first = exec_get_one('SELECT sender_id, receiver_id FROM direct_messages WHERE message_id = 8')
+        self.assertEqual(('Abbott1234', 'Costello1234'), first, "Abbott speaks first")
+        for user_id in ('Abbott1234', 'Costello1234'):
+            self.assertEqual(len(get_unread_messages(user_id)), get_unread_counts(user_id).messages,
+                             "imported messages are counted")
+        latest = get_inbox('Abbott1234')[0][0]
+        self.assertEqual(('Costello1234', 191), (latest.other_user, latest.last_message_id))
+        self.assertEqual(len(get_unread_messages('Abbott1234')) - 1, latest.unread,
+                         "imported messages are counted in their conversation")
+
+    def test_unknown_speaker_imports_nothing(self):
+        filename = self.write_transcript('Sender, Message\nAbbott,"Who\'s on first."\nMoe,"Why I oughta"\n')
+        self.assertEqual("Line 3 has unknown speaker Moe", import_conversation(filename))
+        self.assertEqual(7, exec_get_one('SELECT COUNT(*) FROM direct_messages')[0])
+
+    def test_missing_user(self):
+        filename = self.write_transcript('Sender, Message\nShemp,"Hello"\n')
+        result = import_conversation(filename, {'Shemp': ('Shemp1234', 'Moe1234')})
+        self.assertEqual("User Shemp1234 doesn't exist", result)
+
+    def test_suspended_sender(self):
+        exec_commit("UPDATE users SET suspended_since = '2000-01-01', suspended_till = '2999-01-01' "
+                    "WHERE user_id = 'Moe1234'")
+        suspensions.invalidate()
+        filename = self.write_transcript('Sender, Message\nMoe,"Hello"\n')
+        result = import_conversation(filename, {'Moe': ('Moe1234', 'Larry1234')})
+        self.assertEqual("Moe1234 is currently suspended until 2999/01/01 00:00:00", result)
+        sent = create_direct_message(10, 'Moe1234', 'Larry1234', None, 'Hello')
+        self.assertTrue(sent.endswith(" is currently suspended until 2999/01/01 00:00:00"), sent)
+
+    def test_suspensions_agree_with_direct_messages(self):
+        exec_commit("UPDATE users SET suspended_since = '2000-01-01', suspended_till = '2999-01-01' "
+                    "WHERE user_id = 'Moe1234'")
+        suspensions.invalidate()
+        self.assertTrue(suspensions.is_suspended('Moe1234'))
+        # lifted around resume_user, so the cached suspension index still holds it until it is invalidated
+        exec_commit("UPDATE users SET suspended_since = NULL, suspended_till = NULL WHERE user_id = 'Moe1234'")
+        filename = self.write_transcript('Sender, Message\nMoe,"Hello"\n')
+        sent = create_direct_message(10, 'Moe1234', 'Larry1234', None, 'Hello')
+        result = import_conversation(filename, {'Moe': ('Moe1234', 'Larry1234')})
+        self.assertTrue(sent.endswith(" is currently suspended until 2999/01/01 00:00:00"), sent)
+        self.assertEqual("Moe1234 is currently suspended until 2999/01/01 00:00:00", result)
+
+
+if __name__ == '__main__':
+    unittest.main()
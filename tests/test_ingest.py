@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+from src.ingest import ingest
+from src.swen344_db_utils import exec_commit, exec_get_all, exec_get_one
+from tests.fixtures import populate_tables_db1
+
+
+class TestIngest(unittest.TestCase):
+
+    def setUp(self):
+        populate_tables_db1()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        for i in range(3):
+            shutil.copy('data/whos_on_first.csv', os.path.join(self.directory, 'transcript%d.csv' % i))
+        self.lines = []
+
+    def count_messages(self):
+        return exec_get_one('SELECT COUNT(*) FROM direct_messages')[0]
+
+    def test_ingest_directory(self):
+        report = ingest(self.directory, processes=2, writers=2, batch_size=50, queue_size=2, report=self.lines.append)
+        self.assertEqual(3, report.files)
+        self.assertEqual(3 * 184, report.rows)
+        self.assertEqual({}, report.failed)
+        self.assertEqual(7 + 3 * 184, self.count_messages())
+        self.assertEqual(3, len(self.lines), "one progress line per file")
+
+    def test_each_file_keeps_transcript_order(self):
+        with open(os.path.join(self.directory, 'long.csv'), 'w') as file:
+            file.write('Sender, Message\n')
+            for i in range(2000):
+                file.write('%s,line %05d\n' % ('Abbott' if i % 2 else 'Costello', i))
+        report = ingest(self.directory, processes=2, writers=4, batch_size=50, report=self.lines.append)
+        self.assertEqual(4, report.files)
+        lines = [row[0] for row in exec_get_all('SELECT message FROM direct_messages WHERE message LIKE %s '
+                                                'ORDER BY message_id', ('line %',))]
+        self.assertEqual(['line %05d' % i for i in range(2000)], lines, "ids follow the transcript")
+
+    def test_resume_skips_finished_files_and_batches(self):
+        ingest(self.directory, processes=2, batch_size=50, report=self.lines.append)
+        path = os.path.join(self.directory, 'transcript1.csv')
+        # pretend the run stopped after committing the first two batches of transcript1
+        exec_commit('DELETE FROM ingest_manifest WHERE path = %s', (path,))
+        exec_commit('INSERT INTO ingest_batches (path, batch_no, rows) VALUES (%s, 0, 50), (%s, 1, 50)', (path, path))
+        exec_commit('DELETE FROM direct_messages WHERE message_id > %s', (7 + 3 * 184 - 84,))
+        report = ingest(self.directory, processes=2, batch_size=50, report=self.lines.append)
+        self.assertEqual(1, report.files, "only the unfinished file is ingested again")
+        self.assertEqual(84, report.rows, "only its uncommitted batches are loaded")
+        self.assertEqual(7 + 3 * 184, self.count_messages())
+
+    def test_bad_file_is_reported_and_not_loaded(self):
+        with open(os.path.join(self.directory, 'bad.csv'), 'w') as file:
+            file.write('Sender, Message\nMoe,"Why I oughta"\n')
+        report = ingest(self.directory, processes=2, report=self.lines.append)
+        self.assertEqual(3, report.files)
+        self.assertEqual(1, len(report.failed))
+        self.assertEqual(7 + 3 * 184, self.count_messages())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import subprocess
+import sys
+import unittest
+import warnings
+from benchmarks.fanout import COMMUNITY, per_member_fan_out, seed, set_based_fan_out
+from src.chat import post_to_channel
+from src.instrumentation import NPlusOneWarning, normalize_sql, profile
+from src.swen344_db_utils import exec_commit, exec_get_all, exec_stream, transaction
+from tests.fixtures import populate_tables_db3
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_normalize_sql(self):
+        self.assertEqual('SELECT * FROM users WHERE user_id = ? AND email = ?',
+                         normalize_sql("SELECT *\n  FROM users WHERE user_id = %s AND email = 'a@b.edu'"))
+        self.assertEqual(normalize_sql('SELECT 1 FROM t WHERE id IN (1, 2, 3)'),
+                         normalize_sql('SELECT 1 FROM t WHERE id IN (7)'))
+        self.assertEqual(normalize_sql("INSERT INTO t (a, b) VALUES ('x', 1), ('y', 2)"),
+                         normalize_sql("INSERT INTO t (a, b) VALUES ('z', 3)"))
+
+    def test_profile_counts_queries_rows_and_connections(self):
+        populate_tables_db3()
+        with profile('history') as operation:
+            exec_get_all('SELECT * FROM users')
+            exec_get_all('SELECT * FROM users WHERE user_id = %s', ('Moe1234',))
+            exec_get_all('SELECT * FROM users WHERE user_id = %s', ('Larry1234',))
+        self.assertEqual(3, operation.queries)
+        self.assertEqual(3, operation.checkouts, "each exec_* outside a transaction borrows a connection")
+        self.assertEqual(2, len(operation.statements), "the two lookups share a statement shape")
+        stats = operation.statements['SELECT * FROM users WHERE user_id = ?']
+        self.assertEqual((2, 2), (stats.calls, stats.rows))
+        self.assertIsNotNone(operation.seconds)
+        self.assertIn('SELECT * FROM users', operation.report())
+
+    def test_rows_are_the_rows_returned(self):
+        populate_tables_db3()
+        with profile() as operation, transaction():
+            exec_commit("UPDATE users SET email = email WHERE user_id IN ('Moe1234', 'Larry1234')")
+            exec_get_all("UPDATE users SET email = email WHERE user_id = 'Moe1234' RETURNING user_id")
+            streamed = list(exec_stream('SELECT user_id FROM users', batch_size=2))
+        self.assertEqual(1 + len(streamed), operation.rows, "rows a write affected are not returned")
+        self.assertEqual(len(streamed), operation.statements['SELECT user_id FROM users'].rows)
+
+    def test_transaction_borrows_once(self):
+        populate_tables_db3()
+        with profile() as operation, transaction():
+            for user_id in ('Moe1234', 'Larry1234'):
+                exec_get_all('SELECT * FROM users WHERE user_id = %s', (user_id,))
+        self.assertEqual((2, 1), (operation.queries, operation.checkouts))
+
+    def test_post_to_channel_is_not_n_plus_one(self):
+        seed(50)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', NPlusOneWarning)
+            with profile('post', n_plus_one=3) as operation:
+                post_to_channel('bench_user_000000', 'general', COMMUNITY, 'hello', '2020-01-01 00:00:00')
+        self.assertLess(operation.queries, 10)
+
+    def test_per_member_loop_is_detected(self):
+        seed(20)
+        with self.assertWarns(NPlusOneWarning) as caught:
+            with profile('fan out', n_plus_one=5):
+                per_member_fan_out('hello')
+        self.assertIn('INSERT INTO unread_posts (user_id,post_id) VALUES (?...)', str(caught.warning))
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', NPlusOneWarning)
+            with profile('fan out', n_plus_one=5):
+                set_based_fan_out('hello')
+
+    def test_env_var_reports_operations(self):
+        populate_tables_db3()
+        script = 'from src.chat import get_unread_messages; get_unread_messages("Moe1234")'
+        result = subprocess.run([sys.executable, '-c', script], env=dict(os.environ, CHAT_PROFILE='1'),
+                                stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        self.assertIn('get_unread_messages:', result.stderr)
+        self.assertIn('FROM direct_messages WHERE receiver_id = ? AND direct_messages.is_read = FALSE', result.stderr)
@@ -0,0 +1,35 @@
+import unittest
+from src.mentions import MentionIndex, extract_mentions, extract_mentions_batch
+
+MEMBERS = ['Abbott1234', 'Costello1234', 'Moe1234', 'clark.kent']
+
+
+class TestMentions(unittest.TestCase):
+
+    def test_single_mention(self):
+        self.assertEqual(['Moe1234'], extract_mentions("Hey @Moe1234 are you here?", MEMBERS))
+
+    def test_adjacent_mentions(self):
+        self.assertEqual(['Abbott1234', 'Costello1234'], extract_mentions("@Abbott1234 @Costello1234", MEMBERS))
+
+    def test_trailing_punctuation_and_dotted_ids(self):
+        self.assertEqual(['Moe1234', 'clark.kent'], extract_mentions("Thanks @Moe1234, and @clark.kent.", MEMBERS))
+
+    def test_non_members_duplicates_and_emails(self):
+        mentions = extract_mentions("@Moe1234 @Larry1234 @Moe1234 mail moe@rit.edu", MEMBERS)
+        self.assertEqual(['Moe1234'], mentions, "only members are mentioned, once each, and emails never match")
+
+    def test_no_mentions(self):
+        self.assertEqual([], extract_mentions("nobody @ home", MEMBERS))
+
+    def test_batch_matches_single_extraction(self):
+        messages = ["@Abbott1234 who's on first?", "", "no mentions", "@Moe1234\x00@Costello1234",
+                    "end with @Costello1234"]
+        index = MentionIndex(MEMBERS)
+        self.assertEqual([index.extract(message) for message in messages], index.extract_batch(messages))
+        self.assertEqual([['Abbott1234'], [], [], ['Moe1234', 'Costello1234'], ['Costello1234']],
+                         extract_mentions_batch(messages, MEMBERS))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import unittest
+from src.chat import rebuild_tables
+from src.migrations import MIGRATIONS, applied_versions, migrate
+from src.swen344_db_utils import exec_commit, exec_get_all
+
+
+class TestMigrations(unittest.TestCase):
+
+    def setUp(self):
+        rebuild_tables()
+
+    def test_rebuild_applies_every_migration(self):
+        self.assertEqual(sorted(migration.version for migration in MIGRATIONS), applied_versions())
+
+    def test_migrate_is_idempotent(self):
+        self.assertEqual([], migrate(), "nothing should be pending after a rebuild")
+        exec_commit('DELETE FROM schema_migrations')
+        self.assertEqual(sorted(migration.version for migration in MIGRATIONS), migrate(),
+                         "re-running every migration over an existing schema should not fail")
+
+    def test_indexes_built_concurrently(self):
+        exec_commit('DROP INDEX direct_messages_unread_idx')
+        exec_commit('DELETE FROM schema_migrations WHERE version = 2')
+        self.assertEqual([2], migrate(concurrently=True))
+        indexes = exec_get_all("SELECT indexdef FROM pg_indexes WHERE indexname = 'direct_messages_unread_idx'")
+        self.assertEqual(1, len(indexes), "the partial index should have been rebuilt")
+        self.assertIn('WHERE (is_read = false)', indexes[0][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import threading
+import unittest
+from src import notifications
+from src.chat import create_direct_message, post_to_channel
+from src.importer import import_conversation, WHOS_ON_FIRST_SPEAKERS
+from src.swen344_db_utils import connect, load_config, transaction, use_database
+from tests.fixtures import populate_tables_db1, populate_tables_db3
+
+WAIT = 5
+
+
+class TestNotifications(unittest.TestCase):
+
+    def setUp(self):
+        populate_tables_db3()
+        self.addCleanup(notifications.shutdown)
+
+    def subscribe(self, **filters):
+        subscription = notifications.subscribe(**filters)
+        self.addCleanup(subscription.close)
+        return subscription
+
+    def test_events_reach_matching_subscribers(self):
+        curly = self.subscribe(user='Curly1234')
+        larry = self.subscribe(user='Larry1234')
+        dialogs = self.subscribe(community='Comedy', channel='Dialogs')
+        comedy = self.subscribe(community='Comedy')
+        metropolis = self.subscribe(community='Metropolis')
+        everything = self.subscribe()
+        post_to_channel('Moe1234', 'Dialogs', 'Comedy', 'Hey @Curly1234')
+        post_to_channel('Moe1234', 'ArgumentClinic', 'Comedy', 'Is this the right room?')
+        create_direct_message(10, 'Moe1234', 'Curly1234', None, 'Nyuk nyuk')
+        create_direct_message(11, 'Moe1234', 'Larry1234', None, 'Spread out')
+        self.assertEqual(['post', 'post', 'message', 'message'], [everything.get(WAIT).type for _ in range(4)])
+
+        mention = curly.get(WAIT)
+        self.assertEqual(('post', 'Moe1234', 'Comedy', 'Dialogs', ['Curly1234']),
+                         (mention.type, mention.user, mention.community, mention.channel, mention.mentioned))
+        self.assertEqual(('message', 10, 'Moe1234', 'Curly1234'), curly.get(WAIT)[:4])
+        self.assertEqual(('message', 11), larry.get(WAIT)[:2], "Larry was not mentioned")
+        self.assertEqual(mention, dialogs.get(WAIT))
+        self.assertEqual(['Dialogs', 'ArgumentClinic'], [comedy.get(WAIT).channel for _ in range(2)])
+        for subscription in (curly, larry, dialogs, comedy, metropolis):
+            self.assertIsNone(subscription.get(0))
+
+    def test_only_committed_writes_notify(self):
+        moe = self.subscribe(user='Moe1234')
+        with self.assertRaises(ZeroDivisionError), transaction():
+            create_direct_message(10, 'Curly1234', 'Moe1234', None, 'Rolled back')
+            1 / 0
+        with transaction():
+            create_direct_message(11, 'Curly1234', 'Moe1234', None, 'Committed')
+            self.assertIsNone(moe.get(0.2), "events are sent on commit")
+        self.assertEqual(11, moe.get(WAIT).id)
+        self.assertIsNone(moe.get(0.2))
+
+    def test_imports_notify_once_per_pair(self):
+        populate_tables_db1()
+        received = []
+        delivered = threading.Event()
+
+        def collect(event):
+            received.append(event)
+            if len(received) == 2:
+                delivered.set()
+        self.subscribe(user='Abbott1234', callback=collect)
+        self.subscribe(user='Costello1234', callback=collect)
+        import_conversation('data/whos_on_first.csv', WHOS_ON_FIRST_SPEAKERS, chunk_size=50)
+        self.assertTrue(delivered.wait(WAIT))
+        self.assertEqual([('messages', None, 'Abbott1234', 'Costello1234'),
+                          ('messages', None, 'Costello1234', 'Abbott1234')],
+                         sorted(event[:4] for event in received),
+                         "identical events from each chunk are sent once per transaction")
+
+    def test_filters_are_validated(self):
+        with self.assertRaises(ValueError):
+            notifications.subscribe(channel='Dialogs')
+        with self.assertRaises(ValueError):
+            notifications.subscribe(user='Moe1234', community='Comedy')
+
+    def test_callback_subscriptions_are_not_queued(self):
+        subscription = self.subscribe(callback=lambda event: None)
+        with self.assertRaises(TypeError):
+            subscription.get(0)
+        with self.assertRaises(TypeError):
+            next(iter(subscription))
+
+    def test_bad_payloads_are_skipped(self):
+        everything = self.subscribe()
+        conn = connect()
+        conn.autocommit = True
+        for payload in ('not json', '[1]', '{"id": 1}', '{"type": "post", "mentioned": 5}',
+                        '{"type": "post", "id": 1, "sender": "Moe1234"}'):
+            conn.cursor().execute('SELECT pg_notify(%s, %s)', (notifications.CHANNEL, payload))
+        conn.close()
+        self.assertEqual(('post', 1), everything.get(WAIT)[:2], "unknown keys are dropped")
+        create_direct_message(10, 'Moe1234', 'Curly1234', None, 'Nyuk nyuk')
+        self.assertEqual(('message', 10), everything.get(WAIT)[:2], "the listener outlives bad payloads")
+
+    def test_subscribe_restarts_a_stopped_listener(self):
+        self.subscribe()
+        listener = notifications.get_listener()
+        listener._stopped.set()
+        listener._thread.join()
+        curly = self.subscribe(user='Curly1234')
+        create_direct_message(10, 'Moe1234', 'Curly1234', None, 'Nyuk nyuk')
+        self.assertEqual(10, curly.get(WAIT).id)
+
+    def test_subscribe_gives_up_when_the_database_is_down(self):
+        notifications.shutdown()
+        database = load_config()['database']
+        use_database('chat_no_such_database')
+        try:
+            with self.assertRaises(TimeoutError):
+                notifications.subscribe(user='Moe1234', timeout=0.5)
+        finally:
+            notifications.shutdown()
+            use_database(database)
+        moe = self.subscribe(user='Moe1234')
+        create_direct_message(10, 'Curly1234', 'Moe1234', None, 'Hey Moe')
+        self.assertEqual(10, moe.get(WAIT).id)
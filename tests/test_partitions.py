@@ -0,0 +1,114 @@
+import csv
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from src import partitions
+from src.chat import *
+from src.swen344_db_utils import exec_commit, exec_get_all, exec_get_one, load_config, transaction
+from tests.fixtures import populate_tables_db3
+
+NOW = datetime(2020, 3, 15)
+
+
+class TestPartitions(unittest.TestCase):
+
+    def setUp(self):
+        populate_tables_db3()
+
+    def archive_dir(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return directory
+
+    def test_partition_keeps_rows(self):
+        before = exec_get_all('SELECT message_id, sender_id, receiver_id, time_sent, message FROM direct_messages '
+                              'ORDER BY message_id')
+        created = partitions.partition_tables('month', ahead=2, at=NOW)
+        self.assertIn('direct_messages_p2020_02', created, "the seeded messages get a partition")
+        self.assertIn('direct_messages_p2020_05', created, "partitions are made ahead of time")
+        self.assertEqual(before, exec_get_all('SELECT message_id, sender_id, receiver_id, time_sent, message '
+                                              'FROM direct_messages ORDER BY message_id'))
+        self.assertEqual(0, exec_get_one('SELECT COUNT(*) FROM direct_messages_default')[0],
+                         "every seeded row has moved to a period partition")
+        self.assertEqual(2, len(get_unread_messages('Abbott1234')))
+        self.assertEqual([], partitions.partition_tables('month', ahead=2, at=NOW), "already partitioned")
+
+    def test_rows_outside_partitions_are_split_out(self):
+        partitions.partition_tables('year', ahead=0, at=NOW)
+        self.assertEqual("Message sent successfully",
+                         create_direct_message(20, 'Moe1234', 'Curly1234', '2005-06-01 00:00:00', 'Nyuk nyuk'))
+        self.assertEqual(1, exec_get_one('SELECT COUNT(*) FROM direct_messages_default')[0])
+        self.assertEqual(['direct_messages_p2005'], partitions.maintain(ahead=0, at=NOW))
+        self.assertEqual(0, exec_get_one('SELECT COUNT(*) FROM direct_messages_default')[0])
+        rows, cursor = search_direct_messages('Curly1234', 'nyuk')
+        self.assertEqual([20], [row[0] for row in rows], "the search trigger runs on every partition")
+
+    def test_message_ids_stay_unique_across_partitions(self):
+        partitions.partition_tables('year', ahead=0, at=NOW)
+        results = create_direct_messages([(1, 'Moe1234', 'Curly1234', '2020-01-01 00:00:00', 'Nyuk nyuk')])
+        self.assertEqual(["Message 1 already exists"], results, "the primary key only covers one partition")
+        self.assertEqual(1, exec_get_one('SELECT COUNT(*) FROM direct_messages WHERE message_id = 1')[0])
+
+    def test_posts_are_partitioned(self):
+        partitions.partition_tables('quarter', ahead=1, at=NOW)
+        add_user_to_community('lex12345', 'Metropolis')
+        post_to_channel('lex12345', 'DailyPlanet', 'Metropolis', "Hi @clarknotsuperman", '2020-01-05 00:00:00')
+        self.assertEqual(1, get_unread_posts('clarknotsuperman')[1])
+        self.assertEqual(1, exec_get_one('SELECT COUNT(*) FROM channel_posts_p2020_q1')[0])
+
+    def test_archive(self):
+        partitions.partition_tables('year', ahead=0, at=NOW)
+        directory = self.archive_dir()
+        archived = partitions.archive('2000-01-01', directory)
+        self.assertEqual(['direct_messages_p1922', 'direct_messages_p1991', 'direct_messages_p1995'],
+                         [partition.partition for partition in archived])
+        self.assertEqual(5, sum(partition.rows for partition in archived))
+        with gzip.open(os.path.join(directory, 'direct_messages_p1995.csv.gz'), 'rt') as file:
+            rows = list(csv.DictReader(file))
+        self.assertEqual(['3', '4'], [row['message_id'] for row in rows])
+        self.assertNotIn('search_vector', rows[0])
+        self.assertEqual(0, exec_get_one("SELECT COUNT(*) FROM direct_messages WHERE time_sent < '2000-01-01'")[0])
+        self.assertIsNone(exec_get_one("SELECT to_regclass('direct_messages_p1995')")[0], "the partition is dropped")
+        reconcile_unread_counts()
+        self.assertEqual(0, get_unread_counts('Larry1234').messages, "the archived unread message is gone")
+
+    def test_archive_ignores_tables_in_other_schemas(self):
+        partitions.partition_tables('year', ahead=0, at=NOW)
+        with transaction() as cur:
+            cur.execute('CREATE SCHEMA archive_shadow; '
+                        'CREATE TABLE archive_shadow.direct_messages_p1995 (message_id INT, shadow TEXT)')
+        self.addCleanup(exec_commit, 'DROP SCHEMA archive_shadow CASCADE')
+        directory = self.archive_dir()
+        partitions.archive('2000-01-01', directory)
+        with gzip.open(os.path.join(directory, 'direct_messages_p1995.csv.gz'), 'rt') as file:
+            header = next(csv.reader(file))
+        self.assertEqual(1, header.count('message_id'))
+        self.assertNotIn('shadow', header)
+
+    def test_archive_posts_removes_their_unread_rows(self):
+        partitions.partition_tables('month', ahead=0, at=NOW)
+        add_user_to_community('lex12345', 'Metropolis')
+        post_to_channel('lex12345', 'DailyPlanet', 'Metropolis', "Old @clarknotsuperman", '2019-01-05 00:00:00')
+        post_to_channel('lex12345', 'DailyPlanet', 'Metropolis', "New", '2020-03-01 00:00:00')
+        partitions.archive('2019-06-01', self.archive_dir())
+        self.assertEqual(1, get_unread_posts('clarknotsuperman')[1])
+        self.assertEqual(0, get_mentions('clarknotsuperman')[1])
+
+    def test_rebuild_tables_partitions_when_configured(self):
+        config = load_config()
+        config['partitioning'] = {'granularity': 'month', 'ahead': 1}
+        try:
+            rebuild_tables()
+        finally:
+            del config['partitioning']
+        with transaction() as cur:
+            self.assertTrue(partitions.is_partitioned(cur, 'channel_posts'))
+            self.assertTrue(partitions.is_partitioned(cur, 'direct_messages'))
+            self.assertEqual(2, len(partitions.partitions(cur, 'direct_messages')))
+        rebuild_tables()
+        with transaction() as cur:
+            self.assertFalse(partitions.is_partitioned(cur, 'direct_messages'))
@@ -1,5 +1,7 @@
 import unittest
-from src.swen344_db_utils import connect
+import psycopg2
+from src.swen344_db_utils import connect, borrow, close_pool, ConnectionPool, PoolTimeout, transaction, exec_get_all, \
+    exec_get_one, prepare
 
 
 class TestPostgreSQL(unittest.TestCase):
@@ -11,6 +13,98 @@ class TestPostgreSQL(unittest.TestCase):
         self.assertTrue(cur.fetchone()[0].startswith('PostgreSQL'))
         conn.close()
 
+    def test_borrow_reuses_connection(self):
+        with borrow() as conn:
+            first = conn
+        with borrow() as conn:
+            self.assertIs(first, conn, "an idle pooled connection should be reused")
+
+    def test_pool_replaces_broken_connection(self):
+        pool = ConnectionPool(min_size=1, max_size=1, check_after=0)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        conn.close()
+        replacement = pool.getconn()
+        self.assertIsNot(conn, replacement, "a closed connection should not be handed out")
+        cur = replacement.cursor()
+        cur.execute('SELECT 1')
+        self.assertEqual((1,), cur.fetchone())
+        pool.putconn(replacement)
+        pool.closeall()
+
+    def test_pool_times_out_when_exhausted(self):
+        pool = ConnectionPool(min_size=0, max_size=1, timeout=0.1)
+        conn = pool.getconn()
+        self.assertRaises(PoolTimeout, pool.getconn)
+        pool.putconn(conn)
+        pool.closeall()
+
+    def test_pool_evicts_idle_connections(self):
+        pool = ConnectionPool(min_size=0, max_size=2, max_idle=-1)
+        first = pool.getconn()
+        second = pool.getconn()
+        pool.putconn(first)
+        pool.putconn(second)
+        self.assertTrue(first.closed, "idle connections above min_size should be closed")
+        pool.closeall()
+
+    def test_nested_transaction_shares_cursor(self):
+        with transaction() as outer:
+            with transaction() as inner:
+                self.assertIs(outer, inner, "nested blocks should reuse the caller's cursor")
+            outer.execute('SELECT pg_backend_pid()')
+            pid = outer.fetchone()
+            self.assertEqual(pid, exec_get_one('SELECT pg_backend_pid()'), "helpers should run on the same connection")
+
+    def test_transaction_rolls_back_on_error(self):
+        try:
+            with transaction() as cur:
+                cur.execute('CREATE TABLE unit_of_work_probe (x INT)')
+                raise RuntimeError('abort')
+        except RuntimeError:
+            pass
+        self.assertEqual((None,), exec_get_one("SELECT to_regclass('unit_of_work_probe')"),
+                         "nothing from a failed transaction should be committed")
+
+    def test_prepared_statement_placeholders(self):
+        statement = prepare('test_named', "SELECT %(a)s::INT + %(b)s::INT + %(a)s::INT, '100%%'")
+        self.assertEqual("SELECT $1::INT + $2::INT + $1::INT, '100%'", statement.text)
+        self.assertEqual((5, '100%'), exec_get_one(statement, {'a': 1, 'b': 3}))
+        self.assertIs(statement, prepare('test_named', statement.sql), "registering the same statement is harmless")
+        with self.assertRaises(ValueError):
+            prepare('test_named', 'SELECT 1')
+
+    def test_prepared_once_per_connection(self):
+        statement = prepare('test_square', 'SELECT %s::INT * %s::INT')
+        with transaction() as cur:
+            for i in range(3):
+                self.assertEqual((i * i,), exec_get_one(statement, (i, i)))
+            cur.execute("SELECT COUNT(*) FROM pg_prepared_statements WHERE name = 'test_square'")
+            self.assertEqual((1,), cur.fetchone())
+        # a failed transaction does not undo the PREPARE, so the connection keeps the statement
+        with self.assertRaises(psycopg2.Error):
+            with transaction():
+                exec_get_one(statement, (2, 2))
+                exec_get_one('SELECT 1 / 0')
+        self.assertEqual([(16,)], exec_get_all(statement, (4, 4)))
+        # a recycled pool hands out new connections, which prepare the statement again
+        close_pool()
+        self.assertEqual((9,), exec_get_one(statement, (3, 3)))
+
+    def test_prepared_statements_are_prepared_again_when_lost(self):
+        statement = prepare('test_cube', 'SELECT %s::INT * %s::INT * %s::INT')
+        with transaction() as cur:
+            self.assertEqual((8,), exec_get_one(statement, (2, 2, 2)))
+            cur.execute('DEALLOCATE ALL')
+        self.assertEqual((27,), exec_get_one(statement, (3, 3, 3)), "the first statement of a transaction retries")
+        with transaction() as cur:
+            cur.execute('DEALLOCATE ALL')
+        with transaction() as cur:
+            cur.execute('SELECT 1')
+            self.assertEqual((64,), exec_get_one(statement, (4, 4, 4)), "so does one after other work")
+            cur.execute('SELECT 2')
+            self.assertEqual((2,), cur.fetchone(), "the transaction is still usable")
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+from datetime import datetime
+from src.chat import add_community, add_user_to_community, is_suspended, post_to_channel, resume_user, suspend_user
+from src.instrumentation import profile
+from src.suspensions import GLOBAL, SuspensionIndex, suspended_users
+from src import suspensions
+from tests.fixtures import populate_tables_db3
+
+
+def at(year):
+    return datetime(year, 1, 1)
+
+
+class TestSuspensionIndex(unittest.TestCase):
+
+    def test_intervals_are_open(self):
+        index = SuspensionIndex([('moe', 'Comedy', at(2000), at(2010))])
+        self.assertFalse(index.is_suspended('moe', 'Comedy', at(2000)))
+        self.assertTrue(index.is_suspended('moe', 'Comedy', at(2005)))
+        self.assertFalse(index.is_suspended('moe', 'Comedy', at(2010)))
+        self.assertFalse(index.is_suspended('moe', 'Metropolis', at(2005)), "suspensions are per community")
+        self.assertFalse(index.is_suspended('moe', GLOBAL, at(2005)))
+
+    def test_global_suspensions_apply_everywhere(self):
+        index = SuspensionIndex([('moe', GLOBAL, at(2000), at(2010)), ('moe', 'Comedy', at(2005), at(2020))])
+        self.assertTrue(index.is_suspended('moe', 'Metropolis', at(2001)))
+        self.assertEqual(at(2020), index.suspended_until('moe', 'Comedy', at(2006)), "the later end wins")
+        self.assertEqual(at(2010), index.suspended_until('moe', GLOBAL, at(2006)))
+
+    def test_overlapping_intervals_are_merged(self):
+        index = SuspensionIndex([('moe', 'C', at(2000), at(2005)), ('moe', 'C', at(2003), at(2008)),
+                                 ('moe', 'C', at(2010), at(2012)), ('moe', 'C', None, at(2030))])
+        self.assertEqual(2, len(index), "incomplete intervals are ignored and overlapping ones merged")
+        self.assertEqual(at(2008), index.suspended_until('moe', 'C', at(2001)))
+        self.assertFalse(index.is_suspended('moe', 'C', at(2009)))
+        self.assertTrue(index.is_suspended('moe', 'C', at(2011)))
+
+
+class TestSuspensions(unittest.TestCase):
+
+    def setUp(self):
+        populate_tables_db3()
+
+    def test_suspend_and_resume_invalidate_the_index(self):
+        self.assertFalse(is_suspended('Moe1234', 'Dialogs', '2020-06-01 00:00:00', 'Comedy'))
+        suspend_user('Moe1234', 'Comedy', '2021-01-01 00:00:00', '2020-01-01 00:00:00')
+        self.assertTrue(is_suspended('Moe1234', 'Dialogs', '2020-06-01 00:00:00', 'Comedy'))
+        suspend_user('Moe1234', 'Comedy', '2022-01-01 00:00:00', '2021-06-01 00:00:00')
+        self.assertFalse(is_suspended('Moe1234', 'Dialogs', '2020-06-01 00:00:00', 'Comedy'),
+                         "suspending again replaces the interval")
+        self.assertEqual("User is suspended",
+                         post_to_channel('Moe1234', 'Dialogs', 'Comedy', 'hi', '2021-07-01 00:00:00'))
+        resume_user('Moe1234', 'Comedy')
+        self.assertEqual("Message sent to channel",
+                         post_to_channel('Moe1234', 'Dialogs', 'Comedy', 'hi', '2021-07-01 00:00:00'))
+
+    def test_checks_do_not_query(self):
+        suspensions.get_index()
+        with profile() as operation:
+            for i in range(100):
+                is_suspended('Larry1234', 'Dialogs', '2020-06-01 00:00:00', 'Comedy')
+        self.assertEqual(0, operation.queries)
+
+    def test_channel_names_shared_between_communities(self):
+        add_community('Stooges', ['Dialogs'])
+        add_user_to_community('Moe1234', 'Stooges')
+        suspend_user('Moe1234', 'Stooges', '2030-01-01 00:00:00', '2020-01-01 00:00:00')
+        self.assertFalse(is_suspended('Moe1234', 'Dialogs', '2021-01-01 00:00:00', 'Comedy'))
+        self.assertTrue(is_suspended('Moe1234', 'Dialogs', '2021-01-01 00:00:00', 'Stooges'))
+        self.assertEqual("Message sent to channel",
+                         post_to_channel('Moe1234', 'Dialogs', 'Comedy', 'hi', '2021-01-01 00:00:00'))
+        self.assertEqual("User is suspended",
+                         post_to_channel('Moe1234', 'Dialogs', 'Stooges', 'hi', '2021-01-01 00:00:00'))
+
+    def test_batch_check(self):
+        suspend_user('Moe1234', 'Comedy', '2030-01-01 00:00:00', '2020-01-01 00:00:00')
+        suspended = suspended_users(['Abbott1234', 'Moe1234', 'Larry1234', 'Curly1234'], 'Comedy',
+                                    '2021-01-01 00:00:00')
+        self.assertEqual({'Moe1234': at(2030), 'Larry1234': at(2060)}, suspended,
+                         "Larry is suspended globally and Curly's suspension is over")
+        self.assertEqual({'Larry1234'}, set(suspended_users(['Moe1234', 'Larry1234'], GLOBAL, '2021-01-01 00:00:00')))
@@ -0,0 +1,71 @@
+import unittest
+from concurrent.futures import wait
+from datetime import datetime
+from src.chat import get_unread_counts, get_unread_posts
+from src.swen344_db_utils import exec_get_one
+from src.write_behind import WriteBehindQueue
+from tests.fixtures import populate_tables_db3
+
+
+class TestWriteBehind(unittest.TestCase):
+
+    def setUp(self):
+        populate_tables_db3()
+
+    def make_queue(self, **settings):
+        writes = WriteBehindQueue(**settings)
+        self.addCleanup(writes.close)
+        return writes
+
+    def test_writes_are_committed_in_batches(self):
+        writes = self.make_queue(max_batch=10, max_delay_ms=200)
+        futures = [writes.create_direct_message(10 + i, 'Moe1234', 'Curly1234', None, 'Nyuk %d' % i)
+                   for i in range(15)]
+        futures.append(writes.post_to_channel('Moe1234', 'Dialogs', 'Comedy', 'Hey @Curly1234'))
+        futures.append(writes.post_to_channel('Moe1234', 'Nowhere', 'Comedy', 'Hello?'))
+        self.assertTrue(writes.flush(timeout=10))
+        self.assertEqual(["Message sent successfully"] * 15 + ["Message sent to channel", "The channel doesn't exist"],
+                         [future.result() for future in futures])
+        self.assertEqual(15, exec_get_one("SELECT COUNT(*) FROM direct_messages WHERE receiver_id = 'Curly1234'")[0])
+        self.assertEqual(15, get_unread_counts('Curly1234').messages)
+        self.assertEqual(1, get_unread_posts('Curly1234')[1])
+        stats = writes.stats()
+        self.assertEqual(17, stats['items'])
+        self.assertEqual(2, stats['batches'], "the writes are grouped into full batches")
+        self.assertEqual(10, stats['max_batch'])
+        self.assertEqual(0, stats['queue_depth'])
+        self.assertGreater(stats['peak_queue_depth'], 0)
+
+    def test_writes_are_stamped_when_submitted(self):
+        writes = self.make_queue(max_batch=10, max_delay_ms=1500)
+        submitted = datetime.now().replace(microsecond=0)
+        futures = [writes.create_direct_message(10, 'Moe1234', 'Curly1234', None, 'Nyuk nyuk'),
+                   writes.post_to_channel('Moe1234', 'Dialogs', 'Comedy', 'Hey @Curly1234')]
+        queued = datetime.now()
+        wait(futures, timeout=10)
+        self.assertEqual(["Message sent successfully", "Message sent to channel"],
+                         [future.result() for future in futures])
+        for sql in ('SELECT time_sent FROM direct_messages WHERE message_id = 10',
+                    "SELECT time_sent FROM channel_posts WHERE text = 'Hey @Curly1234'"):
+            self.assertTrue(submitted <= exec_get_one(sql)[0] <= queued, "not when the batch committed")
+
+    def test_failed_write_fails_alone(self):
+        writes = self.make_queue(max_batch=5, max_delay_ms=200, synchronous_commit=False)
+        futures = [writes.create_direct_message(message_id, 'Moe1234', 'Larry1234', None, 'Hi')
+                   for message_id in (10, 1, 11)]
+        wait(futures, timeout=10)
+        self.assertEqual("Message sent successfully", futures[0].result())
+        self.assertIsNotNone(futures[1].exception(), "message id 1 is taken")
+        self.assertEqual("Message sent successfully", futures[2].result())
+        self.assertEqual(2, exec_get_one('SELECT COUNT(*) FROM direct_messages WHERE message_id IN (10, 11)')[0])
+        self.assertEqual(1, writes.stats()['retried_batches'])
+        self.assertEqual(1, writes.stats()['failed'])
+
+    def test_close_commits_queued_writes(self):
+        writes = WriteBehindQueue(max_batch=100, max_delay_ms=1000, workers=2)
+        futures = [writes.create_direct_message(10 + i, 'Moe1234', 'Larry1234', None, 'Hi') for i in range(3)]
+        writes.close()
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(3, exec_get_one('SELECT COUNT(*) FROM direct_messages WHERE message_id >= 10')[0])
+        with self.assertRaises(RuntimeError):
+            writes.create_direct_message(20, 'Moe1234', 'Larry1234', None, 'Too late')